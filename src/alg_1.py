@@ -20,6 +20,7 @@ from mrjob.step import MRStep
 from mrjob.protocol import TextValueProtocol
 
 import alg_1_util
+import healpix
 from kmeans import KMeansMR
 from stdev import StdevMR
 
@@ -34,6 +35,27 @@ class Algorithm1MR(KMeansMR, StdevMR):
     TOP_K = 250  # Number of closest objects to draw radii with
     BINS = 15  # Number of bins into which we histogram the points
     STD_CUTOFF = 2.5
+    # Where each outlier's TOP_K distances come from. "reservoir"
+    # compares it to the last MAX_LEN outliers its mapper saw, wherever
+    # they are in the sky. "tree" collects the outliers of each HEALPix
+    # pixel at PARTITION_NSIDE in one reducer, and takes each one's TOP_K
+    # nearest neighbours there from a KD-tree. With PARTITION_HALO, the
+    # outliers of the pixels around it are in the tree too, so clusters
+    # on pixel edges are not split. "tiles" compares every
+    # pair of outliers in the sky: they are split into NUM_TILES tiles by
+    # objid, the outliers of each pair of tiles are compared in one
+    # reducer, and each one's TOP_K nearest in all tiles are merged in
+    # another. Exact and the same on every run, it costs NUM_TILES
+    # copies of each outlier and of its TOP_K distances. A pair's reducer
+    # holds the outliers of two tiles and TOP_K distances for each, about
+    # 3 kB per outlier, so NUM_TILES should grow with the outliers: 32
+    # suits up to ~1M. All three take differences in ra the short way
+    # around (euc_dist_4d's wrap_ra).
+    NEIGHBOURS = "reservoir"
+    # Power of 2. 16 gives 3072 pixels of ~13.4 square degrees
+    PARTITION_NSIDE = 16
+    PARTITION_HALO = True
+    NUM_TILES = 32  # Number of tiles of outliers for "tiles"
 
     OUTPUT_PROTOCOL = TextValueProtocol
 
@@ -41,6 +63,7 @@ class Algorithm1MR(KMeansMR, StdevMR):
         '''
         MRjob mapper init.
         '''
+        self.std_init()
         self.list_len = 0
         self.node_list = []
 
@@ -70,6 +93,84 @@ class Algorithm1MR(KMeansMR, StdevMR):
         '''
         yield from alg_1_util.comb_clust(astr, dist_gen, self.TOP_K, self.BINS)
 
+    def mapper_partition(self, center, astr):
+        '''
+        Mrjob mapper for the "tree" neighbours. Filters for color
+        outliers, and sends each to the reducer of its part of the sky.
+        With PARTITION_HALO set, also sends it to the reducers of the
+        pixels around, as halo.
+        Inputs:
+            center: color centroid. Used to judge color outlier status.
+            astr: AstroObject
+        Yields: HEALPix pixel of the object and AstroObject, and each
+            neighbouring pixel and AstroObject
+        '''
+        if astr.dist_from_center > self.stdev[center] * self.STD_CUTOFF:
+            pix = healpix.ang2pix(self.PARTITION_NSIDE, astr.ra, astr.dec)
+            yield pix, astr
+            if self.PARTITION_HALO:
+                halo = set(healpix.neighbours(self.PARTITION_NSIDE, pix))
+                for halo_pix in sorted(halo - {-1, pix}):
+                    yield halo_pix, astr
+
+    def reducer_tree(self, pix, astr_gen):
+        '''
+        For each outlier in a part of the sky, yield a radius in which a
+        cluster would lie, if one exists, from its nearest neighbours,
+        in the pixel or its halo. Only the pixel's own outliers are
+        yielded, the halo belongs to the pixels around.
+        Inputs:
+            pix: int, HEALPix pixel
+            astr_gen: generator of the outliers in the pixel and its halo
+        Yields: 1 (junk key) and AstroObject w/ radius as attribute
+        '''
+        astr_l = list(astr_gen)
+        own = [healpix.ang2pix(self.PARTITION_NSIDE, astr.ra,
+                               astr.dec) == pix for astr in astr_l]
+        yield from alg_1_util.tree_clust(astr_l, self.TOP_K, self.BINS,
+                                         own)
+
+    def mapper_tiles(self, center, astr):
+        '''
+        Mrjob mapper for the "tiles" neighbours. Filters for color
+        outliers, and sends each to the reducers of all pairs of tiles
+        with its own.
+        Inputs:
+            center: color centroid. Used to judge color outlier status.
+            astr: AstroObject
+        Yields: pair of tiles (lower first) and AstroObject
+        '''
+        if astr.dist_from_center > self.stdev[center] * self.STD_CUTOFF:
+            tile = alg_1_util.tile_of(astr, self.NUM_TILES)
+            for other in range(self.NUM_TILES):
+                yield (min(tile, other), max(tile, other)), astr
+
+    def reducer_tile_pair(self, pair, astr_gen):
+        '''
+        Compares all outliers of a pair of tiles, and keeps the TOP_K
+        nearest of each in the other tile.
+        Inputs:
+            pair: tuple of ints, the two tiles
+            astr_gen: generator of the outliers of both tiles
+        Yields: tile and the distances kept for its outliers, and tile and
+            each of its outliers (from the pair of a tile with itself)
+        '''
+        yield from alg_1_util.pair_clust(pair, list(astr_gen), self.TOP_K,
+                                         self.NUM_TILES)
+
+    def reducer_tile(self, tile, value_gen):
+        '''
+        For each outlier of a tile, yield a radius in which a cluster
+        would lie, if one exists, from its nearest neighbours in all
+        tiles.
+        Inputs:
+            tile: int
+            value_gen: generator of the tile's outliers and the distances
+                kept for them by each pair of tiles
+        Yields: 1 (junk key) and AstroObject w/ radius as attribute
+        '''
+        yield from alg_1_util.tile_clust(value_gen, self.TOP_K, self.BINS)
+
     def mapper_return(self, junk, astr):
         '''
         Filters for AstroObjects with very small cluster radii.
@@ -82,7 +183,16 @@ class Algorithm1MR(KMeansMR, StdevMR):
             yield junk, astr
 
     def reducer_return(self, junk, astr_gen):
-        for astr in astr_gen:
+        '''
+        Yields the AstroObjects with very small cluster radii in objid
+        order, so that the output does not depend on the order the
+        reducers before sent them in.
+        Inputs:
+            junk: int, but not used
+            astr_gen: generator of AstroObjects
+        Yields: junk, str of AstroObject
+        '''
+        for astr in sorted(astr_gen, key=lambda astr: astr.objid):
             yield junk, astr.__repr__()
 
     def steps(self):
@@ -91,13 +201,25 @@ class Algorithm1MR(KMeansMR, StdevMR):
         stdev = self.get_steps_std()
 
         # Filter outliers, and cluster them together
-        cluster = [MRStep(mapper_init=self.mapper_clust_init,
-                          mapper=self.mapper_clust,
-                          combiner=self.combiner_clust)]
+        if self.NEIGHBOURS == "tree":
+            healpix.check_nside(self.PARTITION_NSIDE)
+            cluster = [MRStep(mapper_init=self.std_init,
+                              mapper=self.mapper_partition,
+                              reducer=self.reducer_tree)]
+        elif self.NEIGHBOURS == "tiles":
+            cluster = [MRStep(mapper_init=self.std_init,
+                              mapper=self.mapper_tiles,
+                              reducer=self.reducer_tile_pair),
+                       MRStep(reducer=self.reducer_tile)]
+        else:
+            cluster = [MRStep(mapper_init=self.mapper_clust_init,
+                              mapper=self.mapper_clust,
+                              combiner=self.combiner_clust)]
 
         # Repeat stdev filtering on radius of clusters, and then return
         # objects which have a very small radius
-        final = [MRStep(mapper=self.mapper_return,
+        final = [MRStep(mapper_init=self.std_init,
+                        mapper=self.mapper_return,
                         reducer=self.reducer_return)]
 
         return kmeans + stdev + cluster + stdev + final
@@ -1,7 +1,35 @@
+from itertools import islice
+from multiprocessing import Pool
+import zlib
+
 from numpy.random import randint
-from numpy import histogram, array
+from numpy import histogram, array, empty, fromiter, full, partition, sort
+from numpy import (absolute, arange, ascontiguousarray, bincount, clip,
+                   concatenate, flatnonzero, inf, int64, isnan, linspace,
+                   minimum, nan, nan_to_num, remainder, sign, sqrt,
+                   subtract, take_along_axis, vander, where, zeros)
+from numpy.linalg import pinv
 from scipy.interpolate import UnivariateSpline
-from heapq import heapify
+from scipy.spatial import cKDTree
+
+from astro_object import AstroObject
+
+# Distances read into smallest's buffer at a time, beyond the top k kept
+SELECT_BLOCK = 1 << 14
+# Bisection steps to the first root of a fitted density's slope (see
+# peak_radii), enough for a double's precision
+ROOT_STEPS = 52
+# Periods of (ra, dec, ra motion, dec motion) in tree_clust's KD-tree: ra
+# wraps around at 360, 0 leaves the others unwrapped
+COORD_PERIODS = (360, 0, 0, 0)
+# Rows of a tile pair's block of distances computed at once
+BLOCK_ROWS = 256
+# Blocks of rows pair_top_k gathers the cols' distances of before cutting
+# them back to the k smallest
+COL_BLOCKS = 4
+# Outliers in each tile of tiled_top_k, and of a tile chunked_top_k
+# compares at once
+TILE_SIZE = 2048
 
 
 def cut_list(l, max_len, mult):
@@ -38,12 +66,170 @@ def map_clust(astr, max_len, len_mult, node_list):
     if len(new_node_list) > max_len * len_mult:
         # Now iterate over the nodes and find distances
         for astr2 in new_node_list:
-            dist = astr.euc_dist_4d(astr2)
+            dist = astr.euc_dist_4d(astr2, wrap_ra=True)
             yield astr, dist
 
     node_list[:] = new_node_list
 
 
+def smallest(values, k, block=SELECT_BLOCK):
+    '''
+    Finds the k smallest of a stream of values, reading it lazily. The k
+    smallest so far are kept at the front of a buffer, the rest is filled
+    from the stream a block at a time, and np.partition cuts the buffer
+    back to the k smallest whenever it is full, so memory is bounded by
+    k + block whatever the length of the stream.
+    Inputs:
+        values: iterable of floats
+        k: int, how many to keep
+        block: int, values read at a time
+    Returns numpy array, the k smallest values (all, if fewer), sorted
+    '''
+    values = iter(values)
+    buf = empty(k + block)
+    size = 0
+    while True:
+        new = fromiter(islice(values, len(buf) - size), dtype=float)
+        buf[size:size + len(new)] = new
+        size += len(new)
+        if size < len(buf):
+            break
+        buf[:k] = partition(buf, k - 1)[:k]
+        size = k
+    return sort(buf[:size])[:k]
+
+
+def spline_radius(dists, num_bins):
+    '''
+    Finds the radius of a cluster around an object, from the distances
+    to its nearest outliers: the first peak (or trough) of a degree 4
+    spline fitted to their histogram.
+    Inputs:
+        dists: list or numpy array of distances
+        num_bins: how finely to calculate counts
+    Returns float, the radius, or NaN if the spline has no peak
+    '''
+    counts, edges = histogram(dists, num_bins, density=True)
+    y = array([0] + list(counts))
+    x = array(list(edges))  # get distances
+    # calculate the derivates
+    d1 = UnivariateSpline(x=x, y=y, k=4).derivative().roots()
+    return min(d1) if len(d1) else nan
+
+
+def quadratic_roots(a, b, c):
+    '''
+    Real roots of quadratics a * t ** 2 + b * t + c, or of the lines
+    b * t + c where a is 0.
+    Inputs:
+        a, b, c: numpy arrays of coefficients
+    Returns numpy array of 2 roots per quadratic, NaN where there are
+        fewer
+    '''
+    roots = full((len(a), 2), nan)
+    disc = b ** 2 - 4 * a * c
+    quad = (a != 0) & (disc >= 0)
+    sqrt_disc = sqrt(disc[quad])
+    roots[quad, 0] = (-b[quad] - sqrt_disc) / (2 * a[quad])
+    roots[quad, 1] = (-b[quad] + sqrt_disc) / (2 * a[quad])
+    line = (a == 0) & (b != 0)
+    roots[line, 0] = -c[line] / b[line]
+    return roots
+
+
+def cubic(coefs, t):
+    '''
+    Evaluates cubics, one per row.
+    Inputs:
+        coefs: numpy array, a row of 4 coefficients per cubic, from the
+            constant up
+        t: numpy array, a row of points per cubic
+    Returns numpy array of values, the shape of t
+    '''
+    values = coefs[:, 3:4] * t
+    for i in (2, 1):
+        values = (values + coefs[:, i:i + 1]) * t
+    return values + coefs[:, 0:1]
+
+
+def peak_radii(dists, num_bins):
+    '''
+    spline_radius for many objects at once, with array operations
+    instead of a spline per object. The histogram's points are at the
+    same fractions of each object's range of distances, and FITPACK only
+    adds knots to a spline when a single polynomial leaves a residual
+    above its smoothing factor (by default the number of points), so
+    the spline of most objects is the least squares quartic through the
+    points. Those of all objects are one matrix product, and the first
+    roots of their slopes are bracketed in closed form and found by
+    bisection. Objects the quartic does not fit closely enough, or whose
+    distances are all equal, go through spline_radius.
+    Inputs:
+        dists: 2-D numpy array, the distances of one object per row
+        num_bins: how finely to calculate counts
+    Returns numpy array, radius of each object, NaN where there is none
+    '''
+    num, k = dists.shape
+    low = dists.min(axis=1)
+    high = dists.max(axis=1)
+    span = high - low
+    flat = span == 0
+    span[flat] = 1
+
+    # Histograms, binned as np.histogram bins them: by the fraction of
+    # the range, then moved by one bin where rounding put a value on the
+    # wrong side of one of its edges (from np.linspace)
+    edges = arange(num_bins + 1) * (span / num_bins)[:, None] + \
+        low[:, None]
+    edges[:, -1] = high
+    bins = ((dists - low[:, None]) / span[:, None] *
+            num_bins).astype(int64)
+    bins[bins == num_bins] -= 1
+    bins[dists < take_along_axis(edges, bins, 1)] -= 1
+    bins[(dists >= take_along_axis(edges, bins + 1, 1)) &
+         (bins != num_bins - 1)] += 1
+    bins += arange(num)[:, None] * num_bins
+    counts = bincount(bins.ravel(), minlength=num * num_bins)
+    y = zeros((num, num_bins + 1))
+    y[:, 1:] = counts.reshape(num, num_bins) * num_bins / \
+        (k * span[:, None])
+
+    # Least squares quartics in t, the fraction of the range
+    points = vander(linspace(0, 1, num_bins + 1), 5, increasing=True)
+    coefs = y @ pinv(points).T
+    residual = ((y - coefs @ points.T) ** 2).sum(axis=1)
+
+    # The slope of a quartic, a cubic, is monotone between the roots of
+    # its own derivative, a quadratic. The first such piece of [0, 1]
+    # whose ends differ in sign holds the slope's first root.
+    slope = coefs[:, 1:] * arange(1, 5)
+    curve = slope[:, 1:] * arange(1, 4)
+    ends = zeros((num, 4))
+    ends[:, 1:3] = quadratic_roots(curve[:, 2], curve[:, 1], curve[:, 0])
+    ends[:, 3] = 1
+    ends = sort(clip(nan_to_num(ends, nan=1), 0, 1), axis=1)
+    values = cubic(slope, ends)
+    change = (values[:, :-1] * values[:, 1:] <= 0) & \
+        ((values[:, :-1] != 0) | (values[:, 1:] != 0))
+    piece = change.argmax(axis=1)
+    rows = arange(num)
+
+    # Bisection, the slope being monotone in the piece
+    start, stop = ends[rows, piece], ends[rows, piece + 1]
+    start_sign = sign(values[rows, piece])
+    for _ in range(ROOT_STEPS):
+        middle = (start + stop) / 2
+        right = sign(cubic(slope, middle[:, None])[:, 0]) == start_sign
+        start = where(right, middle, start)
+        stop = where(right, stop, middle)
+    radii = low + (start + stop) / 2 * span
+    radii[~change.any(axis=1)] = nan
+
+    for i in flatnonzero(flat | (residual > num_bins + 1)):
+        radii[i] = spline_radius(dists[i], num_bins)
+    return radii
+
+
 def comb_clust(astr, dist_gen, top_k, num_bins):
     '''
     Takes an AstroObject and a generator of distances from the object
@@ -53,28 +239,19 @@ def comb_clust(astr, dist_gen, top_k, num_bins):
         astr: AstroObject to analyze. Radius is put in dist_from_center
             attribute.
         dist_gen: generator of distances to a set of nearby outliers
-        top_k: how many outliers to examine
+        top_k: how many outliers to examine, the nearest
         num_bins: how finely to calculate counts
     Yields: 1 (junk value), AstroObject w/ dist_from_center attribute
     '''
 
-    heap = [val for val in dist_gen]
-    if not heap:
+    # The top_k nearest, read lazily
+    nearest = smallest(dist_gen, top_k)
+    if not len(nearest):
         return None
-    heapify(heap)
-    cutoff = min(top_k, len(heap))  # ensure we don't have indexerrors
-    heap = heap[:cutoff]
-    counts, edges = histogram([i for i in heap], num_bins, density=True)
-    y = array([0] + list(counts))
-    x = array(list(edges))  # get distances
-    # we need to give some approximate knots
-    # calculate the derivates
-    d1 = UnivariateSpline(x=x, y=y, k=4).derivative().roots()
-    try:
-        astr.dist_from_center = min(d1)
+    radius = peak_radii(nearest[None, :], num_bins)[0]
+    if not isnan(radius):
+        astr.dist_from_center = float(radius)
         yield 1, astr
-    except:
-        pass
 
     # # Pick num clusters / allocate memory so this next line isnt an
     # # issue at a given node. Sort by distance from astr.
@@ -93,3 +270,300 @@ def comb_clust(astr, dist_gen, top_k, num_bins):
     # # NOTE: need a better way to calcualte radius
     # astr.dist_from_center = x[y.index(max(y))]
     # yield 1, astr
+
+
+def tree_clust(astr_l, top_k, num_bins, own=None):
+    '''
+    Draws the radius of each outlier of a part of the sky, as comb_clust
+    does, from the distances to its top_k nearest other outliers there.
+    They are found with a KD-tree over (ra, dec, ra motion, dec motion),
+    periodic in ra, so that its distances are those of
+    AstroObject.euc_dist_4d with wrap_ra, and parts (and their halos)
+    across ra 0/360 are not split.
+    Inputs:
+        astr_l: list of AstroObjects, the outliers of the part of the sky
+            and of its halo
+        top_k: how many outliers to examine
+        num_bins: how finely to calculate counts
+        own: list of bools, True for the outliers of the part itself,
+            whose radii are drawn, False for the halo. None if all are
+            its own
+    Yields: 1 (junk value), AstroObject w/ dist_from_center attribute
+    '''
+    own = full(len(astr_l), True) if own is None else array(own, bool)
+    if len(astr_l) < 2 or not own.any():
+        return None
+    coords = outlier_coords(astr_l)
+    coords[:, 0] %= 360
+    k = min(top_k, len(astr_l) - 1)
+    # The nearest point is the outlier itself
+    tree = cKDTree(coords, boxsize=COORD_PERIODS)
+    dist, _ = tree.query(coords[own], k=k + 1)
+    own_l = [astr for astr, is_own in zip(astr_l, own) if is_own]
+    for astr, radius in zip(own_l, peak_radii(dist[:, 1:], num_bins)):
+        if not isnan(radius):
+            astr.dist_from_center = float(radius)
+            yield 1, astr
+
+
+def outlier_coords(astr_l):
+    '''
+    Positions of AstroObjects in the space AstroObject.euc_dist_4d
+    measures distances in: (ra, dec, ra motion, dec motion).
+    Inputs:
+        astr_l: list of AstroObjects
+    Returns numpy array of shape (len(astr_l), 4)
+    '''
+    return array([[astr.ra, astr.dec, astr.ra_motion, astr.dec_motion]
+                  for astr in astr_l], dtype=float).reshape(-1, 4)
+
+
+def keep_smallest(values, k, axis):
+    '''
+    The k smallest values along an axis of an array, in no order.
+    Inputs:
+        values: numpy array
+        k: int, at most the length of the axis
+        axis: int
+    Returns numpy array, k long along axis
+    '''
+    if k >= values.shape[axis]:
+        return values
+    return partition(values, k - 1, axis=axis).take(range(k), axis=axis)
+
+
+def pair_top_k(rows, cols, k, same=False, block=BLOCK_ROWS):
+    '''
+    Compares all outliers of two tiles, a block of rows of their matrix
+    of distances at a time, and keeps the k smallest squared distances
+    of each outlier to the other tile's. Differences in ra are taken the
+    short way around and the squares are summed as euc_dist_4d (with
+    wrap_ra) does, so their roots are its distances, up to the last bit
+    (x ** 2 in Python is not always x * x). As in smallest, the cols'
+    distances are gathered in a buffer, cut back to the k smallest when
+    it is full.
+    Inputs:
+        rows, cols: numpy arrays of shape (n, 4), positions of the
+            outliers of the two tiles (see outlier_coords)
+        k: int, how many distances to keep for each outlier
+        same: bool, True if rows and cols are the same tile, whose
+            outliers are not compared to themselves
+        block: int, rows computed at once
+    Returns tuple of numpy arrays: the squared distances kept for the
+        rows (one row each, min(k, other outliers) long) and for the
+        cols (None if same)
+    '''
+    width = min(k, len(cols) - same)
+    row_top = empty((len(rows), max(width, 0)))
+    col_buf = empty((0 if same else len(cols), k + COL_BLOCKS * block))
+    size = 0
+    cols_t = ascontiguousarray(cols.T)
+    diff = empty((block, len(cols)))
+    for start in range(0, len(rows), block):
+        part = rows[start:start + block]
+        sq = zeros((len(part), len(cols)))
+        part_diff = diff[:len(part)]
+        for dim in range(4):
+            subtract(part[:, dim, None], cols_t[dim], out=part_diff)
+            if not dim:
+                # ra the short way around, as euc_dist_4d with wrap_ra
+                absolute(part_diff, out=part_diff)
+                remainder(part_diff, 360, out=part_diff)
+                minimum(part_diff, 360 - part_diff, out=part_diff)
+            part_diff *= part_diff
+            sq += part_diff
+        if same:
+            diag = arange(len(part))
+            sq[diag, start + diag] = inf
+        row_top[start:start + len(part)] = keep_smallest(sq, width, 1)
+        if not same:
+            if size + len(part) > col_buf.shape[1]:
+                col_buf[:, :k] = keep_smallest(col_buf[:, :size], k, 1)
+                size = k
+            col_buf[:, size:size + len(part)] = sq.T
+            size += len(part)
+    if same:
+        return row_top, None
+    return row_top, keep_smallest(col_buf[:, :size], min(k, size), 1)
+
+
+def merge_top_k(kept, top, k):
+    '''
+    Merges the distances kept for some outliers with more of them.
+    Inputs:
+        kept: numpy array, the distances kept so far, one row per
+            outlier, or None if there are none yet
+        top: numpy array, more distances, one row per outlier
+        k: int, how many distances to keep for each outlier
+    Returns numpy array, the k smallest of each row of both
+    '''
+    if kept is None:
+        return top
+    both = concatenate((kept, top), axis=1)
+    return keep_smallest(both, min(k, both.shape[1]), 1)
+
+
+def chunked_top_k(rows, cols, k, same=False, chunk=TILE_SIZE):
+    '''
+    pair_top_k for tiles of any size. They are compared chunk outliers
+    of each at a time, so that pair_top_k's buffers stay bounded however
+    many outliers a tile has, and only the k smallest distances of each
+    outlier so far are kept.
+    Inputs:
+        rows, cols, k, same: as for pair_top_k
+        chunk: int, outliers of each tile compared at once
+    Returns tuple of numpy arrays, as pair_top_k
+    '''
+    row_starts = range(0, len(rows), chunk)
+    col_starts = row_starts if same else range(0, len(cols), chunk)
+    row_top = {start: None for start in row_starts}
+    # A tile compared with itself keeps the cols' distances for its rows
+    col_top = row_top if same else {start: None for start in col_starts}
+    for row_start in row_starts:
+        for col_start in col_starts:
+            if same and col_start < row_start:
+                continue
+            tops = pair_top_k(rows[row_start:row_start + chunk],
+                              cols[col_start:col_start + chunk], k,
+                              same and row_start == col_start)
+            row_top[row_start] = merge_top_k(row_top[row_start], tops[0], k)
+            if tops[1] is not None:
+                col_top[col_start] = merge_top_k(col_top[col_start],
+                                                 tops[1], k)
+    row_top = concatenate([row_top[start] for start in row_starts])
+    if same:
+        return row_top, None
+    return row_top, concatenate([col_top[start] for start in col_starts])
+
+
+def tile_radii(parts, top_k, num_bins):
+    '''
+    Finds the radii of a tile's outliers, as comb_clust does, from their
+    top_k nearest squared distances to each tile (from pair_top_k).
+    Inputs:
+        parts: list of numpy arrays, the squared distances kept from
+            each pair of tiles, with one row per outlier in the same order
+        top_k: how many outliers to examine, the nearest
+        num_bins: how finely to calculate counts
+    Returns numpy array, radius of each outlier, NaN where there is none
+    '''
+    sq = concatenate(parts, axis=1)
+    if not sq.shape[1]:
+        return full(len(sq), nan)
+    sq = keep_smallest(sq, min(top_k, sq.shape[1]), 1)
+    return peak_radii(sqrt(sq), num_bins)
+
+
+def tile_of(astr, num_tiles):
+    '''
+    Tile of an outlier for the "tiles" neighbours, from its objid. Unlike
+    hash(), the same in every process.
+    Inputs:
+        astr: AstroObject
+        num_tiles: int, number of tiles
+    Returns int
+    '''
+    return zlib.crc32(astr.objid.encode()) % num_tiles
+
+
+def pair_clust(pair, astr_l, top_k, num_tiles):
+    '''
+    Compares all outliers of a pair of tiles. A tile's outliers are put
+    in objid order, so that the distances kept for them by each pair
+    line up in tile_clust.
+    Inputs:
+        pair: tuple of ints, the two tiles, lower first
+        astr_l: list of AstroObjects, the outliers of both tiles
+        top_k: how many distances to keep for each outlier
+        num_tiles: int, number of tiles
+    Yields: tile and squared distances kept for its outliers, for each
+        tile of the pair. The pair of a tile with itself also yields the
+        tile and each of its outliers.
+    '''
+    tiles = {tile: [] for tile in pair}
+    for astr in astr_l:
+        tiles[tile_of(astr, num_tiles)].append(astr)
+    for tile_l in tiles.values():
+        tile_l.sort(key=lambda astr: astr.objid)
+
+    first, second = pair
+    if first == second:
+        coords = outlier_coords(tiles[first])
+        for astr in tiles[first]:
+            yield first, astr
+        yield first, chunked_top_k(coords, coords, top_k, same=True)[0]
+    elif tiles[first] and tiles[second]:
+        row_top, col_top = chunked_top_k(outlier_coords(tiles[first]),
+                                         outlier_coords(tiles[second]),
+                                         top_k)
+        yield first, row_top
+        yield second, col_top
+
+
+def tile_clust(values, top_k, num_bins):
+    '''
+    Draws the radius of each outlier of a tile, as comb_clust does, from
+    the distances to its top_k nearest outliers in the whole sky.
+    Inputs:
+        values: iterable of the tile's AstroObjects and the squared
+            distances kept for them by each pair of tiles (pair_clust)
+        top_k: how many outliers to examine, the nearest
+        num_bins: how finely to calculate counts
+    Yields: 1 (junk value), AstroObject w/ dist_from_center attribute
+    '''
+    astr_l, parts = [], []
+    for value in values:
+        (astr_l if isinstance(value, AstroObject) else parts).append(value)
+    astr_l.sort(key=lambda astr: astr.objid)
+    for astr, radius in zip(astr_l, tile_radii(parts, top_k, num_bins)):
+        if not isnan(radius):
+            astr.dist_from_center = float(radius)
+            yield 1, astr
+
+
+def pair_task(task):
+    '''
+    pair_top_k for one pair of tiles of tiled_top_k, in a worker.
+    '''
+    first, second, rows, cols, k = task
+    return (first, second) + pair_top_k(rows, cols, k, first == second)
+
+
+def tiled_top_k(coords, k, tile_size=TILE_SIZE, processes=1):
+    '''
+    Exact distances from each outlier to its k nearest others, comparing
+    all pairs of outliers a pair of tiles of tile_size at a time. Pairs
+    of tiles are spread over a pool of processes if processes > 1.
+    Inputs:
+        coords: numpy array of shape (n, 4), positions of the outliers
+            (see outlier_coords)
+        k: int, how many distances to keep for each outlier
+        tile_size: int, outliers in each tile
+        processes: int, number of worker processes
+    Returns numpy array of shape (n, min(k, n - 1)), each row sorted
+    '''
+    starts = range(0, len(coords), tile_size)
+    tasks = [(first, second, coords[first:first + tile_size],
+              coords[second:second + tile_size], k)
+             for first in starts for second in starts if first <= second]
+    parts = {start: None for start in starts}
+
+    def merge(first, second, row_top, col_top):
+        # Only the k smallest of each tile so far are kept
+        for start, top in ((first, row_top), (second, col_top)):
+            if top is not None:
+                parts[start] = merge_top_k(parts[start], top, k)
+
+    if processes <= 1:
+        for task in tasks:
+            merge(*pair_task(task))
+    else:
+        with Pool(processes) as pool:
+            for result in pool.imap_unordered(pair_task, tasks):
+                merge(*result)
+
+    width = min(k, len(coords) - 1)
+    top = empty((len(coords), max(width, 0)))
+    for start in starts:
+        top[start:start + tile_size] = sort(parts[start], axis=1)
+    return sqrt(top)
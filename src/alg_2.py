@@ -15,6 +15,8 @@ than a certain number of stdev's from its color centroid is considered
 an outlier. Then returns those objects.
 """
 
+from copy import copy
+
 from mrjob.job import MRJob
 from mrjob.step import MRStep
 from mrjob.protocol import TextValueProtocol
@@ -22,6 +24,8 @@ import numpy as np
 
 import astro_object
 import alg_2_util
+import healpix
+import quadtree
 from kmeans import KMeansMR
 from stdev import StdevMR
 
@@ -32,13 +36,70 @@ class Algorithm2MR(KMeansMR, StdevMR):
     for clusters within each bin. Then finds color outliers.
     """
 
-    # pass data internally with pickle, use TextValue for readable output
+    # pass data internally with AstroProtocol (from KMeansMR), use
+    # TextValue for readable output
     OUTPUT_PROTOCOL = TextValueProtocol
 
     NUM_ITER = 40  # How many random walks to run
     NUM_JUMPS = 200  # How many jumps to make within each random walk
     SUBDIVS = 60  # How many ra/dec subdivs to make for thresholding
     STD_CUTOFF = 4
+    VECTORIZED = True  # Build prob matrix with array ops, not a loop
+    # If > 0, only allow jumps to this many nearest neighbours and store
+    # the prob matrix as sparse. Needed for bins too big for an NxN
+    # matrix. The "loop" walk needs a dense matrix, so cannot be used.
+    KNN = 0
+    # "batch" runs all walks at once, "loop" is the original walk and
+    # "stationary" computes expected visit counts with no sampling
+    WALK_MODE = "batch"
+    SEED = None  # Random walk seed. Set for reproducible results
+    STAT_TOL = 1e-10  # Convergence tolerance for "stationary"
+    STAT_MAX_ITER = 10000  # Max power iterations for "stationary"
+    # Halo width in degrees. Objects this close to a neighbouring bin
+    # are also sent there, but only used for its random walk, so that
+    # clusters on bin edges are not split. 0 turns halos off.
+    HALO = 0
+    # If > 0 (must be a power of 2), bin objects by HEALPix pixel at this
+    # nside instead of the ra/dec grid, so every bin covers the same area.
+    # 64 gives 49152 bins of ~0.84 square degrees.
+    HEALPIX_NSIDE = 0
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if self.KNN and self.WALK_MODE == "loop":
+            raise ValueError('WALK_MODE "loop" needs a dense matrix, use '
+                             '"batch" or "stationary" with KNN')
+
+    def configure_args(self):
+        super().configure_args()
+        self.add_file_arg(
+            "--partition-map", default=None,
+            help="Quadtree partition map from quadtree.py. If given, bins "
+                 "objects by its partitions instead of the fixed grid.")
+
+    def clust_init(self):
+        '''
+        MRjob mapper and reducer init. Loads the partition map, if one
+        is used.
+        '''
+        self.leaves = None
+        if self.options.partition_map:
+            if self.HEALPIX_NSIDE:
+                raise ValueError("Use either HEALPix or a partition map")
+            self.leaves = quadtree.load_map(self.options.partition_map)
+        if self.HEALPIX_NSIDE:
+            healpix.check_nside(self.HEALPIX_NSIDE)
+
+    def locate(self, ra, dec):
+        '''
+        Finds the key of the bin a position falls in: its HEALPix pixel
+        or partition if using those, otherwise its ra/dec bin on the grid.
+        '''
+        if self.HEALPIX_NSIDE:
+            return healpix.ang2pix(self.HEALPIX_NSIDE, ra, dec)
+        if self.leaves is not None:
+            return quadtree.locate(self.leaves, ra, dec)
+        return alg_2_util.sort_bins(ra, dec, ra_bins, dec_bins)
 
     def mapper_clust(self, _, line):
         '''
@@ -47,7 +108,10 @@ class Algorithm2MR(KMeansMR, StdevMR):
         Inputs:
             line: str, line of csv file
         Yields:
-            tuple containing ra/dec bin of object and object itself
+            tuple containing ra/dec bin of object (or key of its
+            partition, if using a partition map) and object itself.
+            With HALO set, also yields a copy of the object for each
+            neighbouring bin within HALO degrees.
         '''
         # Construct an astro object and push the attributes in:
         astr = astro_object.AstroObject(data_row=line)
@@ -55,10 +119,18 @@ class Algorithm2MR(KMeansMR, StdevMR):
         # yield only if there is an astro object
         if astr.is_complete():
             # sort astro object into bins based on ra and dec values
-            ra_bin, dec_bin = alg_2_util.sort_bins(
-                astr.ra, astr.dec, ra_bins, dec_bins)
+            yield self.locate(astr.ra, astr.dec), astr
+            if not self.HALO:
+                return
 
-            yield (ra_bin, dec_bin), astr
+            self.increment_counter("halo", "core objects")
+            halo = alg_2_util.halo_bins(astr.ra, astr.dec, self.HALO,
+                                        self.locate)
+            for key, shift in halo.items():
+                halo_astr = copy(astr)
+                halo_astr.ra += shift
+                self.increment_counter("halo", "halo copies")
+                yield key, halo_astr
 
     def reducer_clust(self, bounds, astr_gen):
         '''
@@ -70,25 +142,101 @@ class Algorithm2MR(KMeansMR, StdevMR):
         algorithm. If the total visitation count of all objects within
         a cell is higher than the threshold, the cell is considered to
         be a cluster and all objects within are yielded.
+        With HALO set, the random walk also runs over the halo objects
+        from neighbouring bins, but only objects in the bin itself are
+        thresholded and yielded.
         Inputs:
-            bounds: tuple of 2 ints, signifying the ra/dec bin.
+            bounds: tuple of 2 ints, signifying the ra/dec bin, str, the
+                key of a quadtree partition, or int, a HEALPix pixel.
             astr_gen: generator of AstroObjects within the bin
         Yields: None and AstroObject of any object in cluster
         '''
         # random walk needs a list. The size of 'bounds' is chosen so
-        # this is possible / so that there are no memory errors.
+        # this is possible / so that there are no memory errors (with
+        # KNN set, only the list itself has to fit).
         astr_l = []
         for i in astr_gen:
             astr_l.append(i)  # bounds size is chosen so this is possible
+        self.report_load(len(astr_l))
 
         # Build prob matrix and complete random walk for each bin
-        prob_mtrx = alg_2_util.build_adjacency_matrix(astr_l)
-        rand_walk = alg_2_util.random_walk(
-            prob_mtrx, self.NUM_ITER, self.NUM_JUMPS, astr_l)
+        if self.KNN:
+            prob_mtrx = alg_2_util.build_knn_matrix(astr_l, self.KNN)
+        elif self.VECTORIZED:
+            prob_mtrx = alg_2_util.build_adjacency_matrix_vec(astr_l)
+        else:
+            prob_mtrx = alg_2_util.build_adjacency_matrix(astr_l)
+
+        if self.WALK_MODE == "stationary":
+            rand_walk, num_iter = alg_2_util.random_walk_stationary(
+                prob_mtrx, self.NUM_ITER, self.NUM_JUMPS, astr_l,
+                self.STAT_TOL, self.STAT_MAX_ITER)
+            self.report_convergence(num_iter)
+        elif self.WALK_MODE == "batch":
+            rand_walk = alg_2_util.random_walk_batch(
+                prob_mtrx, self.NUM_ITER, self.NUM_JUMPS, astr_l, self.SEED)
+        else:
+            rand_walk = alg_2_util.random_walk(
+                prob_mtrx, self.NUM_ITER, self.NUM_JUMPS, astr_l)
+
+        # Drop the halo, it belongs to the neighbouring bins. Copies
+        # shifted across ra 0/360 are outside the sky range.
+        if self.HALO and rand_walk:
+            rand_walk = [astr for astr in rand_walk if 0 <= astr.ra < 360
+                         and self.locate(astr.ra, astr.dec) == bounds]
 
         # Threshold and filter, and yield any objects which remain
-        yield from alg_2_util.apply_threshold(bounds, rand_walk, NUM_BINS,
-                                              self.SUBDIVS)
+        if self.HEALPIX_NSIDE:
+            yield from self.threshold_healpix(bounds, rand_walk)
+        elif isinstance(bounds, str):
+            yield from alg_2_util.threshold_rect(
+                quadtree.key_rect(bounds), rand_walk, self.SUBDIVS)
+        else:
+            yield from alg_2_util.apply_threshold(bounds, rand_walk, NUM_BINS,
+                                                  self.SUBDIVS)
+
+    def threshold_healpix(self, pix, rand_walk):
+        '''
+        apply_threshold for a HEALPix pixel. The cells are its sub-pixels,
+        so they are equal area and follow the pixel's shape. Splits the
+        pixel into the power of 2 number of cells closest to SUBDIVS.
+        Inputs:
+            pix: int, HEALPix pixel of the bin
+            rand_walk: a list of AstroObjects post random walk
+        Yields: None and AstroObject of any object in a dense cell
+        '''
+        if not rand_walk:
+            return None
+
+        depth = max(1, int(round(np.log2(self.SUBDIVS))))
+        cells = [healpix.sub_pixel(self.HEALPIX_NSIDE, pix, depth,
+                                   astr.ra, astr.dec) for astr in rand_walk]
+        yield from alg_2_util.threshold_cells(
+            cells, rand_walk, (2 ** depth, 2 ** depth))
+
+    def report_load(self, num):
+        '''
+        Adds a bin to the histogram of bin sizes (log2 scale) kept in
+        MRjob counters, to check how evenly the reducers are loaded.
+        Inputs:
+            num: int, number of objects in the bin
+        '''
+        lower = 2 ** (num.bit_length() - 1) if num else 0
+        self.increment_counter("bin sizes", "{:>9}-{}".format(
+            lower, max(2 * lower - 1, 0)))
+
+    def report_convergence(self, num_iter):
+        '''
+        Reports how many power iterations a bin's stationary distribution
+        took through MRjob counters.
+        Inputs:
+            num_iter: int, iterations used, or -1 if it did not converge
+        '''
+        if num_iter < 0:
+            self.increment_counter("stationary", "bins not converged")
+        elif num_iter > 0:
+            self.increment_counter("stationary", "bins converged")
+            self.increment_counter("stationary", "total iterations", num_iter)
 
     def mapper_return(self, center, astr):
         '''
@@ -109,14 +257,17 @@ class Algorithm2MR(KMeansMR, StdevMR):
         '''
         MRjob step definition.
         '''
-        clustering = [MRStep(mapper=self.mapper_clust,
+        clustering = [MRStep(mapper_init=self.clust_init,
+                             mapper=self.mapper_clust,
+                             reducer_init=self.clust_init,
                              reducer=self.reducer_clust)]
 
         # These steps, from the parent classes, find color outliers.
         kmeans = self.get_steps_kmeans()
         std = self.get_steps_std()
 
-        final = [MRStep(mapper=self.mapper_return)]
+        final = [MRStep(mapper_init=self.std_init,
+                        mapper=self.mapper_return)]
         
         return clustering + kmeans + std + final
 
@@ -0,0 +1,362 @@
+"""
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Single machine engine for Algorithm II. Runs the same stages as
+Algorithm2MR, with the same settings, but on columns of numpy arrays
+instead of a stream of AstroObjects, so there is no per-object
+pickling or generator overhead:
+    binning -> per bin random walk and threshold -> k-means -> stdev cut
+
+Every stage works on whole arrays. The only Python loop is over bins,
+each of which is one matrix build, one walk and one threshold. Bins
+are independent, so they are spread over a pool of processes, one per
+core by default. The output is the same as Algorithm2MR's on the fixed
+ra/dec grid with "aggregate" k-means, whatever the number of
+processes. HALO, HEALPIX_NSIDE and partition maps are not supported.
+The input is a csv file, or a store converted from one with
+catalog_store.py, which skips parsing. Run with:
+    >>> python3 alg_2_local.py input_file [processes] > outfile
+"""
+
+from multiprocessing import Pool
+import os
+import sys
+from types import SimpleNamespace
+
+import numpy as np
+
+import alg_2_util
+import catalog_csv
+import catalog_store
+from alg_2 import Algorithm2MR
+from astro_object import AstroObject
+from kmeans import kmeans_cell_sums
+
+NUM_BINS = 360  # How many bins to partition ra/dec into, as in alg_2.py
+
+# Algorithm2MR settings used by cluster_bin
+BIN_SETTINGS = ("KNN", "WALK_MODE", "STAT_TOL", "STAT_MAX_ITER", "NUM_ITER",
+                "NUM_JUMPS", "SEED", "SUBDIVS")
+
+
+def load_catalog(in_file, region=None):
+    '''
+    Reads ALLWISE objects into columns, from a csv file or a store
+    written by catalog_store.py. Keeps the same objects mapper_clust
+    does: rows that parse and pass is_complete().
+    Inputs:
+        in_file: str, path to csv file or store directory
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2) bounds of the
+            patch of sky to keep, or None for the whole file. An indexed
+            store only reads the rows near the patch.
+    Returns dict of column name to numpy array: objid (str), the columns
+        in catalog_csv.FLOAT_COLUMNS, color1 and color2
+    '''
+    if catalog_store.is_store(in_file) and region:
+        catalog = catalog_store.read_region(in_file, region)
+    elif catalog_store.is_store(in_file):
+        catalog = catalog_store.read_catalog(in_file)
+    else:
+        batches = list(catalog_csv.read_batches(in_file))
+        if not batches:
+            batches = [catalog_csv.parse_chunk(b"\n")[0]]
+        catalog = {name: np.concatenate([batch[name] for batch in batches])
+                   for name in batches[0]}
+
+    # is_complete: none of these may be missing or 0
+    complete = catalog["objid"] != ""
+    if region:
+        complete &= catalog_store.in_region(catalog["ra"], catalog["dec"],
+                                            region)
+    for name in ("ra", "dec", "ra_motion", "dec_motion", "color1", "color2"):
+        complete &= catalog[name] != 0
+
+    return select(catalog, complete)
+
+
+def select(catalog, rows):
+    '''
+    Takes the given rows (bool mask or indices) of every column.
+    '''
+    return {name: column[rows] for name, column in catalog.items()}
+
+
+def sort_into_bins(catalog, num_bins):
+    '''
+    Sorts the catalog by ra/dec bin, as sort_bins does for one object.
+    Inputs:
+        catalog: dict of columns, from load_catalog
+        num_bins: int, number of ra and of dec bins
+    Returns tuple of the sorted catalog, numpy int array of shape
+        (number of bins, 2) with the ra/dec bin of each non empty bin,
+        and numpy int array of the row each bin starts at, with the
+        number of rows appended
+    '''
+    ra_bins, dec_bins = alg_2_util.create_bin(0, 360, -90, 90,
+                                              num_bins, num_bins)
+    ra_bin = np.digitize(catalog["ra"], ra_bins) - 1
+    dec_bin = np.digitize(catalog["dec"], dec_bins) - 1
+
+    order = np.lexsort((dec_bin, ra_bin))
+    bins = np.column_stack((ra_bin[order], dec_bin[order]))
+    starts = np.flatnonzero(np.any(bins[1:] != bins[:-1], axis=1)) + 1
+    starts = np.concatenate(([0], starts, [len(bins)]))
+
+    return select(catalog, order), bins[starts[:-1]], starts
+
+
+def walk_bin(coords, job):
+    '''
+    Random walk over one bin, as in Algorithm2MR.reducer_clust.
+    Inputs:
+        coords: numpy array of shape (N, 4), ra, dec, ra motion and dec
+            motion of the bin's objects
+        job: Algorithm2MR class, whose settings to use
+    Returns numpy array of visit counts, or None if there is no walk
+        (bins with fewer than 2 objects)
+    '''
+    if job.KNN:
+        prob_mtrx = alg_2_util.coords_knn_matrix(coords, job.KNN)
+    else:
+        prob_mtrx = alg_2_util.coords_adjacency_matrix(coords)
+    if prob_mtrx is None:
+        return None
+
+    if job.WALK_MODE == "stationary":
+        dist, _ = alg_2_util.stationary_distribution(
+            prob_mtrx, job.STAT_TOL, job.STAT_MAX_ITER)
+        return dist * (job.NUM_ITER * job.NUM_JUMPS)
+
+    # "loop" draws from numpy's global generator, so there is no way to
+    # reproduce it. Use the batch walk.
+    return alg_2_util.walk_visits(prob_mtrx, job.NUM_ITER, job.NUM_JUMPS,
+                                  job.SEED)
+
+
+def threshold_bin(ra, dec, visits, bounds, num_bins, subdivs):
+    '''
+    apply_threshold for one bin.
+    Inputs:
+        ra, dec: numpy arrays, positions of the bin's objects
+        visits: numpy array, their visit counts
+        bounds: ra/dec bin of the bin
+        num_bins: int, number of ra and of dec bins
+        subdivs: int, num ra/dec cells to divide the bin into
+    Returns tuple of numpy int array of shape (N, 2), the cell of each
+        object, and numpy bool array, True for objects in dense cells
+        (None if no threshold could be found)
+    '''
+    ra_l = (360 / num_bins) * bounds[0]
+    ra_u = (360 / num_bins) * (bounds[0] + 1)
+    dec_l = (180 / num_bins) * bounds[1] - 90
+    dec_u = (180 / num_bins) * (bounds[1] + 1) - 90
+    ra_bins, dec_bins = alg_2_util.create_bin(ra_l, ra_u, dec_l, dec_u,
+                                              subdivs, subdivs)
+    cells = np.column_stack((np.digitize(ra, ra_bins) - 1,
+                             np.digitize(dec, dec_bins) - 1))
+
+    return cells, alg_2_util.dense_cell_mask(cells, visits,
+                                             (subdivs, subdivs))
+
+
+def cluster_bin(coords, bounds, job, num_bins):
+    '''
+    Random walk and threshold of one bin. Bins are independent, so this
+    can run in any process.
+    Inputs:
+        coords: numpy array of shape (N, 4), ra, dec, ra motion and dec
+            motion of the bin's objects
+        bounds: ra/dec bin of the bin
+        job: Algorithm2MR class, whose settings to use
+        num_bins: int, number of ra and of dec bins
+    Returns tuple of numpy arrays: visit counts, cells (see
+        threshold_bin) and True for objects in dense cells. None if the
+        bin has no walk or no threshold.
+    '''
+    visits = walk_bin(coords, job)
+    if visits is None:
+        return None
+
+    cells, dense = threshold_bin(coords[:, 0], coords[:, 1], visits,
+                                 bounds, num_bins, job.SUBDIVS)
+    if dense is None:
+        return None
+    return visits, cells, dense
+
+
+def cluster_bins(coords, bins, starts, job, num_bins, processes=1):
+    '''
+    Runs cluster_bin on every bin, in a pool of worker processes if
+    processes > 1. Bins are handed out biggest first, since the work
+    grows with the square of a bin's size and a big bin started last
+    would leave the other workers idle. Results are still yielded in
+    bin order, as soon as each one and all before it are done.
+    Inputs:
+        coords: numpy array of shape (N, 4), sorted by bin
+        bins, starts: from sort_into_bins
+        job: Algorithm2MR class, whose settings to use
+        num_bins: int, number of ra and of dec bins
+        processes: int, number of worker processes
+    Yields: start row, end row and result of cluster_bin of each bin
+    '''
+    if processes > 1:
+        # Workers get the settings, not the class, which may not be
+        # importable by name (e.g. a subclass defined in a function)
+        job = SimpleNamespace(**{name: getattr(job, name)
+                                 for name in BIN_SETTINGS})
+    tasks = [(coords[start:end], bounds, job, num_bins)
+             for bounds, start, end in zip(bins, starts[:-1], starts[1:])]
+
+    if processes <= 1:
+        for task, start, end in zip(tasks, starts[:-1], starts[1:]):
+            yield start, end, cluster_bin(*task)
+        return
+
+    with Pool(processes) as pool:
+        pending = [None] * len(tasks)
+        for i in np.argsort(starts[:-1] - starts[1:], kind="stable"):
+            pending[i] = pool.apply_async(cluster_bin, tasks[i])
+
+        for result, start, end in zip(pending, starts[:-1], starts[1:]):
+            yield start, end, result.get()
+
+
+def find_clusters(catalog, job, num_bins, processes=1):
+    '''
+    Clustering stage: keeps the objects in dense cells of each bin.
+    Inputs:
+        catalog: dict of columns, from load_catalog
+        job: Algorithm2MR class, whose settings to use
+        num_bins: int, number of ra and of dec bins
+        processes: int, number of worker processes for the bins
+    Returns dict of columns of the objects kept, with rand_walk_visits
+        and bin_id (int array of shape (N, 2)) added
+    '''
+    catalog, bins, starts = sort_into_bins(catalog, num_bins)
+    coords = np.column_stack([catalog[name] for name in
+                              ("ra", "dec", "ra_motion", "dec_motion")])
+
+    visits = np.zeros(len(coords))
+    cells = np.zeros((len(coords), 2), dtype=np.int64)
+    keep = np.zeros(len(coords), dtype=bool)
+    for start, end, result in cluster_bins(coords, bins, starts, job,
+                                           num_bins, processes):
+        if result is not None:
+            visits[start:end], cells[start:end], keep[start:end] = result
+
+    catalog["rand_walk_visits"] = visits
+    catalog["bin_id"] = cells
+    return select(catalog, keep)
+
+
+def color_cell_sums(color1, color2, size):
+    '''
+    Sums colors per color cell, as add_to_cell does for one object.
+    Returns numpy array of shape (number of cells, 3) for
+        kmeans_cell_sums
+    '''
+    colors = np.column_stack((color1, color2))
+    if size:
+        colors = np.floor_divide(colors, size).astype(np.int64)
+    _, cell = np.unique(colors, axis=0, return_inverse=True)
+    cell = cell.ravel()
+
+    return np.column_stack((np.bincount(cell),
+                            np.bincount(cell, weights=color1),
+                            np.bincount(cell, weights=color2)))
+
+
+def find_outliers(catalog, job):
+    '''
+    K-means and stdev stages: labels each object with its closest color
+    centroid, and keeps those further than STD_CUTOFF stdevs from it.
+    Inputs:
+        catalog: dict of columns, from find_clusters
+        job: Algorithm2MR class, whose settings to use
+    Returns dict of columns of the outliers, with dist_from_center added
+    '''
+    color1, color2 = catalog["color1"], catalog["color2"]
+    if not len(color1):
+        catalog["dist_from_center"] = np.zeros(0)
+        return catalog
+
+    sums = color_cell_sums(color1, color2, job.KMEANS_CELL)
+    centroids, _ = kmeans_cell_sums(sums, job.START_CENTROIDS,
+                                    job.KMEANS_TOL, job.KMEANS_MAX_ITER)
+
+    centers = np.array(centroids, dtype=float)
+    sq_dists = ((color1[:, np.newaxis] - centers[:, 0]) ** 2 +
+                (color2[:, np.newaxis] - centers[:, 1]) ** 2)
+    center = sq_dists.argmin(axis=1)
+    dist = sq_dists[np.arange(len(center)), center]
+    catalog["dist_from_center"] = dist
+
+    # Population stdev of the distances to each center
+    stdev = np.zeros(len(centers))
+    for i in range(len(centers)):
+        if (center == i).any():
+            stdev[i] = dist[center == i].std()
+
+    return select(catalog, dist > stdev[center] * job.STD_CUTOFF)
+
+
+def to_astro_objects(catalog, stationary=False):
+    '''
+    Builds AstroObjects from columns, e.g. to print results.
+    Inputs:
+        catalog: dict of columns
+        stationary: bool, True if visit counts are expected counts
+            (floats), as with WALK_MODE "stationary"
+    Returns list of AstroObjects
+    '''
+    columns = {name: column.tolist() for name, column in catalog.items()}
+    astr_l = []
+    for i in range(len(columns["objid"])):
+        astr = AstroObject()
+        for name, column in columns.items():
+            setattr(astr, name, column[i])
+        if not stationary:
+            astr.rand_walk_visits = int(astr.rand_walk_visits)
+        astr_l.append(astr)
+
+    return astr_l
+
+
+def run(in_file, job=Algorithm2MR, num_bins=NUM_BINS, processes=1,
+        region=None):
+    '''
+    Runs Algorithm II on a csv file.
+    Inputs:
+        in_file: str, path to csv file or catalog_store.py store
+        job: Algorithm2MR or a subclass, whose settings to use
+        num_bins: int, number of ra and of dec bins
+        processes: int, number of worker processes for the bins
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2) bounds of the
+            patch of sky to search, or None for the whole file
+    Returns list of AstroObjects, the YSO candidates
+    '''
+    if job.HALO or job.HEALPIX_NSIDE:
+        raise ValueError("HALO and HEALPIX_NSIDE are not supported")
+
+    catalog = load_catalog(in_file, region)
+    clusters = find_clusters(catalog, job, num_bins, processes)
+    outliers = find_outliers(clusters, job)
+
+    return to_astro_objects(outliers, job.WALK_MODE == "stationary")
+
+
+def num_cores():
+    '''
+    Number of cores this process may run on.
+    '''
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+if __name__ == "__main__":
+    processes = int(sys.argv[2]) if len(sys.argv) > 2 else num_cores()
+    for astr in run(sys.argv[1], processes=processes):
+        print(astr.__repr__())
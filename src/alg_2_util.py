@@ -7,11 +7,142 @@ Utility functions for algorithm 2 (alg_2.py).
 """
 
 import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist
 from skimage.filters import threshold_minimum
 
 from astro_object import AstroObject
 
 
+def astr_to_array(astr_list):
+    """
+    Pull the 4d coordinates (ra, dec, ra motion, dec motion) of a list
+    of astro objects into a single float array, one row per object.
+    :param astr_list: list of astro objects
+    :return coords: numpy array of shape (len(astr_list), 4)
+    """
+    coords = np.empty((len(astr_list), 4))
+    for i, astr in enumerate(astr_list):
+        coords[i] = (astr.ra, astr.dec, astr.ra_motion, astr.dec_motion)
+
+    return coords
+
+
+def build_adjacency_matrix_vec(astr_list):
+    """
+    Columnar version of build_adjacency_matrix. Computes the pairwise
+    distances, the distance transform, the zeroed diagonal and the row
+    normalization as whole-array operations instead of a Python call
+    per pair. Gives the same probabilities as build_adjacency_matrix
+    to floating point tolerance.
+    :param astro_list: list of astro objects
+    :return norm_trans_matrix: numpy matrix with each row i representing
+        the probability of a jump from object i to j.
+    """
+    # If the list has 0 or 1 object, no travel possible between objects
+    if len(astr_list) <= 1:
+        return None
+
+    coords = astr_to_array(astr_list)
+
+    # Distances between all objects. Work below is done in place so
+    # only one NxN matrix is alive at a time.
+    trans_matrix = cdist(coords, coords)
+
+    # The loop version leaves the distance at 0 for pairs whose lower
+    # index object fails is_complete(). Mirror that so results match.
+    for i, astr in enumerate(astr_list):
+        if not astr.is_complete():
+            trans_matrix[i, i + 1:] = 0
+            trans_matrix[i + 1:, i] = 0
+
+    return distance_to_prob_matrix(trans_matrix)
+
+
+def coords_adjacency_matrix(coords):
+    """
+    build_adjacency_matrix_vec for objects already in an array, as
+    returned by astr_to_array. All objects are taken to be complete.
+    :param coords: numpy array of shape (N, 4)
+    :return norm_trans_matrix: numpy matrix with each row i representing
+        the probability of a jump from object i to j, or None if N <= 1
+    """
+    if len(coords) <= 1:
+        return None
+
+    return distance_to_prob_matrix(cdist(coords, coords))
+
+
+def distance_to_prob_matrix(trans_matrix):
+    """
+    Turns a matrix of distances into jump probabilities, in place.
+    :param trans_matrix: numpy array, NxN distances between objects
+    :return trans_matrix: the same array, row normalized probabilities
+    """
+    # Same transform as transform_distance: 1 / (1 + distance**1.5)
+    np.power(trans_matrix, 1.5, out=trans_matrix)
+    trans_matrix += 1
+    np.reciprocal(trans_matrix, out=trans_matrix)
+
+    # fill the diagonal with zeroes (so 0 prob of jumping to itself)
+    np.fill_diagonal(trans_matrix, val=0)
+
+    # normalize the transformed matrix across rows
+    trans_matrix /= trans_matrix.sum(axis=1)[:, np.newaxis]
+
+    return trans_matrix
+
+
+def build_knn_matrix(astr_list, k):
+    """
+    Sparse version of build_adjacency_matrix. Each object can only jump
+    to its k nearest neighbours in (ra, dec, ra motion, dec motion)
+    space, found with a KD-tree. Jump probabilities use the same
+    distance transform and row normalization as the dense matrix, but
+    the matrix is stored as CSR with exactly k entries per row, so
+    memory grows with N * k instead of N * N.
+    :param astro_list: list of astro objects
+    :param k: int, number of neighbours to keep for each object
+    :return norm_trans_matrix: scipy CSR matrix with each row i
+        representing the probability of a jump from object i to j.
+    """
+    return coords_knn_matrix(astr_to_array(astr_list), k)
+
+
+def coords_knn_matrix(coords, k):
+    """
+    build_knn_matrix for objects already in an array, as returned by
+    astr_to_array.
+    :param coords: numpy array of shape (N, 4)
+    :param k: int, number of neighbours to keep for each object
+    :return norm_trans_matrix: scipy CSR matrix, or None if N <= 1
+    """
+    # If the list has 0 or 1 object, no travel possible between objects
+    size = len(coords)
+    if size <= 1:
+        return None
+    k = min(k, size - 1)
+
+    dist, idx = cKDTree(coords).query(coords, k=k + 1)
+
+    # Drop each object from its own neighbour list. With duplicate
+    # positions it may not come back first, or at all, in which case
+    # the furthest neighbour is dropped instead.
+    own = idx == np.arange(size)[:, np.newaxis]
+    own[~own.any(axis=1), -1] = True
+    dist = dist[~own].reshape(size, k)
+    idx = idx[~own].reshape(size, k)
+
+    # Same transform and normalization as the dense matrix
+    probs = 1 / (1 + dist**1.5)
+    probs /= probs.sum(axis=1)[:, np.newaxis]
+
+    indptr = np.arange(0, size * k + 1, k)
+    return csr_matrix((probs.ravel(), idx.ravel(), indptr),
+                      shape=(size, size))
+
+
 def build_adjacency_matrix(astr_list):
     """
     Build a matrix of probabilities for random walk. Each value at
@@ -133,6 +264,177 @@ def random_walk(prob_mat, iterations, subiter, astr_l):
     return astr_l
 
 
+def random_walk_batch(prob_mat, iterations, subiter, astr_l, seed=None):
+    """
+    Batched version of random_walk. Runs all 'iterations' walks at once,
+    drawing the next object for every walker in one call per jump rather
+    than one np.random.choice per walker per jump. Visit counts are kept
+    in an integer array and only written back to the astro objects at
+    the end.
+    :param prob_mat: numpy array or CSR matrix from build_knn_matrix,
+        probabilities of visting other points
+    :param iterations: int, number of random walks to perform
+    :param subiter: int number of jumps to perform each random walk
+    :param astr_list: list of astro objects
+    :param seed: int or None, seed for the random number generator
+    :return astr_l or None: list of astro objects, with
+        visitation counts updated (None if bad probability matrix input)
+    """
+    if prob_mat is None:
+        return None
+
+    visits = walk_visits(prob_mat, iterations, subiter, seed)
+    for astr, count in zip(astr_l, visits):
+        astr.rand_walk_visits += int(count)
+
+    return astr_l
+
+
+def walk_visits(prob_mat, iterations, subiter, seed=None):
+    """
+    Runs the random walks for random_walk_batch and counts visits.
+    Each step draws the next object for every walker with one
+    searchsorted call on the stacked CDFs of the walkers' rows (see
+    offset_cdf). If the bin has fewer objects than the total number of
+    jumps, the CDFs of all rows are built once up front. Otherwise only
+    the rows the walkers are on are built at each step, which is less
+    work than a full NxN cumulative sum.
+    :param prob_mat: numpy array or CSR matrix from build_knn_matrix,
+        probabilities of visting other points
+    :param iterations: int, number of random walks to perform
+    :param subiter: int number of jumps to perform each random walk
+    :param seed: int or None, seed for the random number generator
+    :return visits: numpy int array, visit count for each object
+    """
+    rand = np.random.RandomState(seed)
+    size = prob_mat.shape[0]
+    if isinstance(prob_mat, csr_matrix):
+        return walk_visits_knn(prob_mat, iterations, subiter, rand)
+
+    precompute = size <= iterations * subiter
+    if precompute:
+        cdf = offset_cdf(prob_mat)
+    walkers = np.arange(iterations)
+
+    # Every walker starts at a random object. Starts are not visits.
+    cur_index = rand.randint(0, size, size=iterations)
+    path = np.empty((subiter, iterations), dtype=np.int64)
+    for j in range(subiter):
+        if precompute:
+            row = cur_index
+        else:
+            cdf = offset_cdf(prob_mat[cur_index])
+            row = walkers
+
+        draws = row + rand.random_sample(iterations)
+        cur_index = np.searchsorted(cdf, draws, side='right') - row * size
+        path[j] = cur_index
+
+    return np.bincount(path.ravel(), minlength=size)
+
+
+def walk_visits_knn(prob_mat, iterations, subiter, rand):
+    """
+    walk_visits for the sparse matrix of build_knn_matrix. Every row
+    has the same number of entries, so the row CDFs are all built once
+    and a draw's position in them is also its position in the CSR
+    column indices.
+    :param prob_mat: CSR matrix from build_knn_matrix
+    :param iterations: int, number of random walks to perform
+    :param subiter: int number of jumps to perform each random walk
+    :param rand: numpy RandomState to draw from
+    :return visits: numpy int array, visit count for each object
+    """
+    size = prob_mat.shape[0]
+    cdf = offset_cdf(prob_mat.data.reshape(size, -1))
+
+    cur_index = rand.randint(0, size, size=iterations)
+    path = np.empty((subiter, iterations), dtype=np.int64)
+    for j in range(subiter):
+        draws = cur_index + rand.random_sample(iterations)
+        cur_index = prob_mat.indices[
+            np.searchsorted(cdf, draws, side='right')]
+        path[j] = cur_index
+
+    return np.bincount(path.ravel(), minlength=size)
+
+
+def offset_cdf(prob_rows):
+    """
+    Builds the CDF of each row of probabilities, offset by its row
+    number, and flattens them into one sorted array. Searching that
+    array for (row number + uniform draw) samples from the row's
+    distribution, so all rows can be sampled in one call.
+    :param prob_rows: 2d numpy array, rows of probabilities
+    :return cdf: 1d numpy array, flattened offset CDFs
+    """
+    cdf = np.cumsum(prob_rows, axis=1)
+
+    # Set the last entry of each row to exactly 1 so that rounding can
+    # never push a draw into the next row.
+    cdf[:, -1] = 1
+    cdf += np.arange(cdf.shape[0])[:, np.newaxis]
+
+    return cdf.ravel()
+
+
+def random_walk_stationary(prob_mat, iterations, subiter, astr_l,
+                           tol=1e-10, max_iter=1000):
+    """
+    Deterministic alternative to random_walk. The expected visit counts
+    of the random walk converge to the stationary distribution of
+    prob_mat, so compute that directly and give each object its
+    expected share of the iterations * subiter jumps.
+    :param prob_mat: numpy array or CSR matrix from build_knn_matrix,
+        probabilities of visting other points
+    :param iterations: int, number of random walks the counts stand in for
+    :param subiter: int number of jumps in each of those random walks
+    :param astr_list: list of astro objects
+    :param tol: float, convergence tolerance (see stationary_distribution)
+    :param max_iter: int, max number of power iterations
+    :return astr_l, num_iter: list of astro objects with visitation
+        counts updated (None if bad probability matrix input), and the
+        number of power iterations used (-1 if it did not converge)
+    """
+    if prob_mat is None:
+        return None, 0
+
+    dist, num_iter = stationary_distribution(prob_mat, tol, max_iter)
+    visits = dist * (iterations * subiter)
+    for astr, count in zip(astr_l, visits):
+        astr.rand_walk_visits += count
+
+    return astr_l, num_iter
+
+
+def stationary_distribution(prob_mat, tol=1e-10, max_iter=1000):
+    """
+    Finds the stationary distribution of a row normalized transition
+    matrix by power iteration, starting from the uniform distribution.
+    Iterates the lazy walk (stay put with probability 1/2), which has
+    the same stationary distribution but always converges, even on
+    periodic graphs.
+    :param prob_mat: numpy array or scipy sparse matrix, row normalized
+    :param tol: float, stop when the L1 change in an iteration is below
+    :param max_iter: int, max number of power iterations
+    :return dist, num_iter: numpy array with the stationary probability
+        of each object, and the number of iterations used (-1 if it did
+        not converge within max_iter)
+    """
+    size = prob_mat.shape[0]
+    dist = np.full(size, 1 / size)
+    trans = prob_mat.T
+
+    for num_iter in range(1, max_iter + 1):
+        new_dist = 0.5 * (dist + trans.dot(dist))
+        change = np.abs(new_dist - dist).sum()
+        dist = new_dist
+        if change < tol:
+            return dist, num_iter
+
+    return dist, -1
+
+
 def create_bin(ra1, ra2, dec1, dec2, n_ra, n_dec):
     """
     Create equally spaced bins for ra and dec coordinate ranges.
@@ -166,6 +468,46 @@ def sort_bins(ra, dec, ra_bins, dec_bins):
     return ra_bin - 1, dec_bin - 1  # -1 due to how digitize bins
 
 
+def halo_bins(ra, dec, margin, locate):
+    '''
+    Finds the bins, other than its own, which lie within margin degrees
+    of a position, by locating the 8 points margin away in ra and/or
+    dec. An object is sent to these bins as halo, so that a cluster on
+    a bin boundary is seen whole by the bins on both sides. Probing 8
+    points bounds the number of halo copies of an object at 8 (3 on a
+    regular grid with margin below the bin size). Bins smaller than the
+    margin may be missed.
+    Probes past ra 0/360 wrap around. The ra of a halo copy sent across
+    the wrap has to be shifted by the returned amount, so that distances
+    to the objects in that bin are right.
+    Inputs:
+        ra, dec: floats, position of the object
+        margin: float, halo width in degrees
+        locate: function taking ra, dec and returning the bin key
+    Returns dict of bin key to ra shift (0, 360 or -360)
+    '''
+    own = locate(ra, dec)
+    halo = {}
+    for d_ra in (-margin, 0, margin):
+        for d_dec in (-margin, 0, margin):
+            probe_dec = dec + d_dec
+            if probe_dec < -90 or probe_dec > 90:
+                continue
+
+            probe_ra = ra + d_ra
+            shift = 0
+            if probe_ra < 0:
+                shift = -360
+            elif probe_ra >= 360:
+                shift = 360
+
+            key = locate(probe_ra - shift, probe_dec)
+            if key != own and key not in halo:
+                halo[key] = -shift
+
+    return halo
+
+
 def apply_threshold(bounds, random_walk, num_bins, subdivs):
     '''
     Partitions the sky into several cells and counts the total number
@@ -196,28 +538,84 @@ def apply_threshold(bounds, random_walk, num_bins, subdivs):
     ra_u = (RA_RANGE / num_bins) * (bounds[0] + 1) + MIN_RA
     dec_u = (DEC_RANGE / num_bins) * (bounds[1] + 1) + MIN_DEC
 
-    # Using the above calculates, partition the objects based on ra/dec
+    yield from threshold_rect((ra_l, ra_u, dec_l, dec_u), random_walk,
+                              subdivs)
+
+
+def threshold_rect(rect, random_walk, subdivs):
+    '''
+    Does the work of apply_threshold for a bin given by its ra/dec
+    edges, so that bins which are not on the fixed grid (e.g. quadtree
+    partitions) can be thresholded too.
+    Inputs:
+        rect: tuple of 4 floats, (ra_l, ra_u, dec_l, dec_u) of the bin
+        random_walk: a list of AstroObjects post random walk.
+        subdivs: int, num ra/dec cells to divide the bin into
+    Yields: AstroObjects within dense cells.
+    '''
+    if not random_walk:
+        return None
+
+    # Using the bin edges, partition the objects based on ra/dec
+    ra_l, ra_u, dec_l, dec_u = rect
     ra_bins, dec_bins = create_bin(ra_l, ra_u, dec_l, dec_u, subdivs, subdivs)
+    cells = [sort_bins(astr.ra, astr.dec, ra_bins, dec_bins)
+             for astr in random_walk]
 
-    # Build matrix of visit counts. Each cell is total counts for all
-    # objects within that ra/dec bin.
-    prob_mtrx = np.zeros((len(ra_bins) - 1, len(dec_bins) - 1))
-    for astr in random_walk:
-        ra_bin, dec_bin = sort_bins(astr.ra, astr.dec, ra_bins, dec_bins)
-        prob_mtrx[ra_bin][dec_bin] += astr.rand_walk_visits
+    yield from threshold_cells(cells, random_walk, (subdivs, subdivs))
+
+
+def threshold_cells(cells, random_walk, shape):
+    '''
+    Thresholds objects which have already been sorted into the cells of
+    a bin, e.g. by threshold_rect or by HEALPix sub-pixel.
+    Inputs:
+        cells: list of (int, int), cell of each object in random_walk
+        random_walk: a list of AstroObjects post random walk.
+        shape: tuple of 2 ints, number of cells in each direction
+    Yields: AstroObjects within dense cells.
+    '''
+    cells = np.array(cells, dtype=np.int64).reshape(-1, 2)
+    visits = np.array([astr.rand_walk_visits for astr in random_walk])
+    for astr, (ra_bin, dec_bin) in zip(random_walk, cells.tolist()):
         astr.bin_id = [ra_bin, dec_bin]
 
+    dense = dense_cell_mask(cells, visits, shape)
+    if dense is None:
+        return None
+
+    # Yield each object in a dense cell.
+    for astr, keep in zip(random_walk, dense):
+        if keep:
+            yield None, astr
+
+
+def dense_cell_mask(cells, visits, shape):
+    '''
+    Array version of the work of threshold_cells.
+    Inputs:
+        cells: numpy int array of shape (N, 2), cell of each object
+        visits: numpy array of N visit counts
+        shape: tuple of 2 ints, number of cells in each direction
+    Returns numpy bool array, True for objects kept, or None if no
+        threshold could be found
+    '''
+    # Build matrix of visit counts. Each cell is total counts for all
+    # objects within that cell.
+    prob_mtrx = np.zeros(shape)
+    np.add.at(prob_mtrx, (cells[:, 0], cells[:, 1]), visits)
+
     # Attempt to threshold and filter.
     try:
         thresh = threshold_minimum(prob_mtrx)
-        clusters = (prob_mtrx >= thresh) * prob_mtrx
-        clusters_idx = np.transpose(np.nonzero(clusters))
-
     except:
         return None
-
-    # Check each object to see if its in a dense cell. If so, yield.
-    # NOTE: Could this be done a more efficient way?
-    for astr in random_walk:
-        if astr.bin_id in clusters_idx:
-            yield None, astr
+    clusters = (prob_mtrx >= thresh) * prob_mtrx
+    clusters_idx = np.transpose(np.nonzero(clusters))
+
+    # An object is kept if its ra cell is the ra cell of any dense cell,
+    # or its dec cell is the dec cell of any dense cell. This is what
+    # the original test, [ra_bin, dec_bin] in clusters_idx, does: numpy
+    # compares element-wise and any() matches either column.
+    return (np.isin(cells[:, 0], clusters_idx[:, 0]) |
+            np.isin(cells[:, 1], clusters_idx[:, 1]))
@@ -5,6 +5,13 @@ from numpy import sqrt
 
 
 class AstroObject:
+    # Fixed attribute layout instead of a per-object __dict__. Objects
+    # are smaller in memory, and pickle as a plain tuple of values (see
+    # __getstate__), which makes them much cheaper to pass between steps.
+    __slots__ = ("objid", "ra", "dec", "ra_motion", "dec_motion", "w1",
+                 "w2", "w3", "w4", "color1", "color2", "bin_id",
+                 "dist_from_center", "rand_walk_visits")
+
     def __init__(self, data_row=None, dic=False):
         """
         A class for an astronomical object from the ALLWISE catalog.
@@ -29,7 +36,6 @@ class AstroObject:
         self.color2 = None
 
         # Used in functions
-        self.k_closest = []
         self.bin_id = None
         self.dist_from_center = None
         self.rand_walk_visits = 0
@@ -64,13 +70,30 @@ class AstroObject:
 
         return True
 
+    @classmethod
+    def fields(cls):
+        '''
+        Names of all attributes of the class, in order, including those
+        added by subclasses.
+        '''
+        rv = []
+        for klass in reversed(cls.__mro__):
+            rv.extend(klass.__dict__.get("__slots__", ()))
+        return rv
+
+    def __getstate__(self):
+        return tuple(getattr(self, field) for field in self.fields())
+
+    def __setstate__(self, state):
+        for field, value in zip(self.fields(), state):
+            setattr(self, field, value)
+
     def package_small(self):
         to_add = ["ra", "dec", "objid", "ra_motion", "color1", "color2",
                   "dec_motion", "dist_from_center"]
-        d = self.__dict__
         rv = {}
         for field in to_add:
-            rv[field] = d[field]
+            rv[field] = getattr(self, field)
 
         return rv
 
@@ -87,13 +110,15 @@ class AstroObject:
 
         return a + b
 
-    def euc_dist_4d(self, other):
+    def euc_dist_4d(self, other, wrap_ra=False):
         """
         This calculates the euclidean distance
         between two objects in 4 dimensional space (ra, dec, ra motion,
         dec motion)
         Inputs:
             other: AstroObject to comapre to.
+            wrap_ra: bool, True to take the difference in ra the short
+                way around, across ra 0/360 if need be
         Outputs:
             - distance between the points (float) in degrees
         """
@@ -112,7 +137,12 @@ class AstroObject:
         pmdec1 = self.dec_motion
         pmdec2 = other.dec_motion
 
-        a = (ra1 - ra2) ** 2
+        ra_diff = ra1 - ra2
+        if wrap_ra:
+            ra_diff = abs(ra_diff) % 360
+            ra_diff = min(ra_diff, 360 - ra_diff)
+
+        a = ra_diff ** 2
         b = (dec1 - dec2) ** 2
         c = (pmra1 - pmra2) ** 2
         d = (pmdec1 - pmdec2) ** 2
@@ -132,7 +162,7 @@ class AstroObject:
         to_check = ["ra", "dec", "objid", "ra_motion",
                     "dec_motion", "color1", "color2"]
         for value in to_check:
-            if not self.__dict__[value]:
+            if not getattr(self, value):
                 return False
         return True
 
@@ -149,14 +179,16 @@ class AstroObject:
     def __repr__(self):
         if self.objid:
             rv = ""
-            for field in self.__dict__.keys():
-                rv += "{}:{},".format(field, self.__dict__[field])
+            for field in self.fields():
+                rv += "{}:{},".format(field, getattr(self, field))
             return rv[:-1]
         else:
             return ""
 
 
 class AstroObjectBig(AstroObject):
+    __slots__ = ("ra_uncert", "dec_uncert", "ra_motion_uncert",
+                 "dec_motion_uncert", "w1_snr", "w2_snr", "w3_snr", "w4_snr")
 
     def __init__(self, data_row=None, dic=False):
         super().__init__(data_row, dic)
@@ -0,0 +1,171 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+MRjob protocol which passes AstroObjects between steps as fixed layout
+binary records instead of pickles.
+
+Every internal step of the k-means, stdev and both algorithm jobs moves
+AstroObjects around, and pickling them was a large share of CPU time.
+The record layout (SCHEMA) is agreed once here, so a record is just the
+values: a bitmask of which fields are set, the catalog id, and packed
+numbers. The (AstroObject, float) pairs used by StdevMR get their own
+record type. Any other key or value (centroid ids, bin keys, ...) falls
+back to pickle.
+
+Records are base64 encoded, as Hadoop streaming splits lines on tabs
+and newlines.
+'''
+
+import pickle
+import struct
+from binascii import a2b_base64, b2a_base64
+
+from astro_object import AstroObject
+
+# Float fields of the record, in order. The catalog id, bin_id and
+# rand_walk_visits are stored separately.
+SCHEMA = ("ra", "dec", "ra_motion", "dec_motion", "w1", "w2", "w3", "w4",
+          "color1", "color2", "dist_from_center")
+
+# Bits of the record's mask. Bit i < len(SCHEMA) is set if SCHEMA[i] is
+# not None, the rest are for the other fields.
+OBJID_BIT = 1 << len(SCHEMA)
+BIN_ID_BIT = OBJID_BIT << 1
+VISITS_FLOAT_BIT = BIN_ID_BIT << 1  # rand_walk_visits is a float, not int
+
+# mask, objid length, floats, bin_id, rand_walk_visits (as double or int)
+HEADER = struct.Struct("<HH")
+BODY = struct.Struct("<{}d2i".format(len(SCHEMA)))
+VISITS_INT = struct.Struct("<q")
+VISITS_FLOAT = struct.Struct("<d")
+DIFF = struct.Struct("<d")
+
+# First byte of an encoded key or value
+ASTRO = b"A"
+ASTRO_DIFF = b"D"
+PICKLE = b"P"
+
+
+def pack_astro(astr):
+    '''
+    Packs an AstroObject into a binary record.
+    Inputs:
+        astr: AstroObject
+    Returns bytes
+    '''
+    mask = 0
+    floats = []
+    for i, field in enumerate(SCHEMA):
+        value = getattr(astr, field)
+        if value is None:
+            floats.append(0.0)
+        else:
+            mask |= 1 << i
+            floats.append(value)
+
+    objid = b""
+    if astr.objid is not None:
+        mask |= OBJID_BIT
+        objid = astr.objid.encode("utf-8")
+
+    bin_id = (0, 0)
+    if astr.bin_id is not None:
+        mask |= BIN_ID_BIT
+        bin_id = astr.bin_id
+
+    if isinstance(astr.rand_walk_visits, int):
+        visits = VISITS_INT.pack(astr.rand_walk_visits)
+    else:
+        mask |= VISITS_FLOAT_BIT
+        visits = VISITS_FLOAT.pack(astr.rand_walk_visits)
+
+    return (HEADER.pack(mask, len(objid)) + objid +
+            BODY.pack(*floats, *bin_id) + visits)
+
+
+def unpack_astro(record, start=0):
+    '''
+    Inverse of pack_astro.
+    Inputs:
+        record: bytes, containing a packed AstroObject
+        start: int, where in record the packed object starts
+    Returns tuple of the AstroObject and the index just past its record
+    '''
+    mask, objid_len = HEADER.unpack_from(record, start)
+    start += HEADER.size
+
+    astr = AstroObject()
+    if mask & OBJID_BIT:
+        astr.objid = record[start:start + objid_len].decode("utf-8")
+    start += objid_len
+
+    values = BODY.unpack_from(record, start)
+    start += BODY.size
+    for i, field in enumerate(SCHEMA):
+        if mask & (1 << i):
+            setattr(astr, field, values[i])
+    if mask & BIN_ID_BIT:
+        astr.bin_id = list(values[-2:])
+
+    if mask & VISITS_FLOAT_BIT:
+        astr.rand_walk_visits = VISITS_FLOAT.unpack_from(record, start)[0]
+    else:
+        astr.rand_walk_visits = VISITS_INT.unpack_from(record, start)[0]
+
+    return astr, start + VISITS_INT.size
+
+
+def encode(value):
+    '''
+    Encodes a key or value for AstroProtocol.
+    Returns bytes, without tabs or newlines
+    '''
+    if type(value) is AstroObject:
+        raw = ASTRO + pack_astro(value)
+    elif (type(value) is tuple and len(value) == 2 and
+          type(value[0]) is AstroObject and isinstance(value[1], float)):
+        raw = ASTRO_DIFF + pack_astro(value[0]) + DIFF.pack(value[1])
+    else:
+        raw = PICKLE + pickle.dumps(value)
+
+    return b2a_base64(raw, newline=False)
+
+
+def decode(encoded):
+    '''
+    Inverse of encode.
+    '''
+    raw = a2b_base64(encoded)
+    kind = raw[:1]
+    if kind == ASTRO:
+        return unpack_astro(raw, 1)[0]
+    if kind == ASTRO_DIFF:
+        astr, end = unpack_astro(raw, 1)
+        return astr, DIFF.unpack_from(raw, end)[0]
+    return pickle.loads(raw[1:])
+
+
+class AstroProtocol:
+    '''
+    MRjob protocol using binary records for AstroObjects. Use it as the
+    INTERNAL_PROTOCOL of a job in place of PickleProtocol. Only exact
+    AstroObjects are packed, subclasses are pickled.
+    '''
+
+    def __init__(self):
+        # Keys usually repeat between lines, so cache the last one
+        self.last_key_encoded = None
+        self.last_key_decoded = None
+
+    def read(self, line):
+        raw_key, raw_value = line.split(b"\t", 1)
+
+        if raw_key != self.last_key_encoded:
+            self.last_key_encoded = raw_key
+            self.last_key_decoded = decode(raw_key)
+        return self.last_key_decoded, decode(raw_value)
+
+    def write(self, key, value):
+        return encode(key) + b"\t" + encode(value)
@@ -0,0 +1,711 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Benchmarks comparing the faster implementations of the pipeline stages
+to the original ones. Run a single benchmark with:
+    >>> python3 benchmarks.py random_walk
+'''
+
+import asyncio
+import heapq
+import os
+import subprocess
+import sys
+import tracemalloc
+from tempfile import TemporaryDirectory
+from time import perf_counter
+
+import numpy as np
+from mrjob.protocol import PickleProtocol
+from scipy.spatial import cKDTree
+
+import alg_1
+import alg_1_util
+import alg_2
+import alg_2_local
+import alg_2_util
+import catalog_csv
+import catalog_store
+import healpix
+import irsa_async
+import merge_strips
+import result_manifest
+import tap_stand_in
+from astro_object import AstroObject
+from astro_protocol import AstroProtocol
+
+# Largest relative difference allowed between the radii of peak_radii
+# and spline_radius in bench_radius
+RADIUS_TOLERANCE = 1e-9
+
+
+class DictAstroObject:
+    '''
+    Stand-in for the AstroObject class before it used __slots__: the
+    same attributes, kept in an instance __dict__.
+    '''
+
+    def __init__(self, astr):
+        for field in astr.fields():
+            setattr(self, field, getattr(astr, field))
+        self.k_closest = []
+
+
+def random_objects(num, seed=0, width=1):
+    '''
+    Builds a list of complete AstroObjects with random positions in a
+    width x width degree patch of sky, random proper motions and random
+    colors.
+    Inputs:
+        num: int, number of objects to build
+        seed: int, seed for the random number generator
+        width: float, size of the patch of sky in degrees
+    Returns list of AstroObjects
+    '''
+    rand = np.random.RandomState(seed)
+    astr_l = []
+    for i in range(num):
+        astr = AstroObject()
+        astr.objid = "J{:012d}".format(i)
+        # Plain floats, as parsed from csv, not numpy scalars
+        astr.ra = rand.uniform(10, 10 + width)
+        astr.dec = rand.uniform(20, 20 + width)
+        astr.ra_motion, astr.dec_motion = rand.normal(0, 50, 2).tolist()
+        astr.w1, astr.w2, astr.w3, astr.w4 = rand.normal(
+            [10, 9.5, 8, 6]).tolist()
+        astr.color1 = astr.w1 - astr.w2
+        astr.color2 = astr.w3 - astr.w4
+        astr_l.append(astr)
+
+    return astr_l
+
+
+def write_csv(astr_l, out_file, header=False):
+    '''
+    Writes AstroObjects as rows of an ALLWISE csv (the 17 columns in
+    irsa_api.columns), with IRSA's precision, after a header row if
+    header. Uncertainties and SNRs are made up.
+    '''
+    with open(out_file, "w") as f:
+        if header:
+            f.write(",".join(catalog_csv.COLUMN_NAMES) + "\n")
+        for astr in astr_l:
+            f.write("{},{:.7f},{:.7f},0.1,0.1,{:.2f},{:.2f},1,1,{:.3f},{:.3f},"
+                    "{:.3f},{:.3f},50,40,20,10\n"
+                    .format(astr.objid, astr.ra, astr.dec, astr.ra_motion,
+                            astr.dec_motion, astr.w1, astr.w2, astr.w3,
+                            astr.w4))
+
+
+def timed(func, *args, **kwargs):
+    '''
+    Runs func once with the given arguments.
+    Returns tuple of (seconds taken, return value of func)
+    '''
+    start = perf_counter()
+    rv = func(*args, **kwargs)
+    return perf_counter() - start, rv
+
+
+def bench_random_walk(sizes=(1000, 2000, 5000, 10000, 20000),
+                      iterations=40, subiter=200):
+    '''
+    Compares alg_2_util.random_walk to alg_2_util.random_walk_batch on
+    bins of increasing size. The probability matrix is built once per
+    size and is not part of the timings.
+    Inputs:
+        sizes: iterable of ints, bin sizes to test
+        iterations, subiter: ints, walk parameters (as in Algorithm2MR)
+    '''
+    print("{:>8} {:>10} {:>10} {:>8}".format("objects", "loop (s)",
+                                             "batch (s)", "speedup"))
+    for size in sizes:
+        astr_l = random_objects(size)
+        prob_mtrx = alg_2_util.build_adjacency_matrix_vec(astr_l)
+
+        loop, _ = timed(alg_2_util.random_walk, prob_mtrx, iterations,
+                        subiter, astr_l)
+        batch, _ = timed(alg_2_util.random_walk_batch, prob_mtrx,
+                         iterations, subiter, astr_l, 0)
+
+        print("{:>8} {:>10.3f} {:>10.3f} {:>7.1f}x".format(
+            size, loop, batch, loop / batch))
+
+
+def bench_astro_object(num=100000):
+    '''
+    Compares the slotted AstroObject to the old __dict__ based class:
+    bytes per object on the wire with PickleProtocol, and objects per
+    second through a map -> reduce round trip (write in the mapper,
+    read in the reducer).
+    Inputs:
+        num: int, number of objects to pass through
+    '''
+    astr_l = random_objects(num)
+    for astr in astr_l:
+        astr.dist_from_center = 0.5
+    protocol = PickleProtocol()
+
+    print("{:>10} {:>14} {:>12}".format("class", "bytes/object",
+                                        "objects/s"))
+    for name, objs in [("__dict__", [DictAstroObject(a) for a in astr_l]),
+                       ("__slots__", astr_l)]:
+        def round_trip():
+            for astr in objs:
+                protocol.read(protocol.write(1, astr))
+
+        secs, _ = timed(round_trip)
+        size = sum(len(protocol.write(1, astr)) for astr in objs) / num
+        print("{:>10} {:>14.1f} {:>12.0f}".format(name, size, num / secs))
+
+
+def bench_protocol(num=100000):
+    '''
+    Compares AstroProtocol to PickleProtocol: bytes per line, and lines
+    per second through a map -> reduce round trip, for the key/value
+    pairs passed between k-means steps and between stdev steps.
+    Inputs:
+        num: int, number of objects to pass through
+    '''
+    astr_l = random_objects(num)
+    for astr in astr_l:
+        astr.dist_from_center = 0.5
+    pairs = {"kmeans": [(1, astr) for astr in astr_l],
+             "stdev diff": [(1, (astr, 0.25)) for astr in astr_l]}
+
+    print("{:>10} {:>14} {:>14} {:>12}".format(
+        "pairs", "protocol", "bytes/line", "lines/s"))
+    for pair_name, kv_pairs in pairs.items():
+        for protocol in [PickleProtocol(), AstroProtocol()]:
+            def round_trip():
+                for key, value in kv_pairs:
+                    protocol.read(protocol.write(key, value))
+
+            secs, _ = timed(round_trip)
+            size = sum(len(protocol.write(key, value))
+                       for key, value in kv_pairs) / num
+            print("{:>10} {:>14} {:>14.1f} {:>12.0f}".format(
+                pair_name, type(protocol).__name__, size, num / secs))
+
+
+def bench_local_engine(sizes=(10000, 50000), width=10):
+    '''
+    Compares Algorithm II on the MRjob inline runner to the single
+    machine engine in alg_2_local.py, end to end from a csv file, and
+    checks that they find the same objects.
+    Inputs:
+        sizes: iterable of ints, numbers of objects to test
+        width: float, size in degrees of the patch of sky the objects
+            are spread over (width ** 2 bins)
+    '''
+    # Set up the grid as alg_2.py does when run as a script
+    alg_2.NUM_BINS = alg_2_local.NUM_BINS
+    alg_2.ra_bins, alg_2.dec_bins = alg_2_util.create_bin(
+        0, 360, -90, 90, alg_2.NUM_BINS, alg_2.NUM_BINS)
+
+    class SeededAlgorithm2MR(alg_2.Algorithm2MR):
+        SEED = 0
+
+    def run_mrjob(in_file):
+        job = SeededAlgorithm2MR(["--no-conf", in_file])
+        with job.make_runner() as runner:
+            runner.run()
+            return b"".join(runner.cat_output()).decode().splitlines()
+
+    def run_local(in_file):
+        return [astr.__repr__()
+                for astr in alg_2_local.run(in_file, SeededAlgorithm2MR)]
+
+    print("{:>8} {:>14} {:>14} {:>8} {:>6}".format(
+        "objects", "mrjob (obj/s)", "local (obj/s)", "speedup", "same"))
+    with TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            in_file = os.path.join(tmp_dir, "objects.csv")
+            write_csv(random_objects(size, width=width), in_file)
+
+            mrjob_secs, mrjob_out = timed(run_mrjob, in_file)
+            local_secs, local_out = timed(run_local, in_file)
+            print("{:>8} {:>14.0f} {:>14.0f} {:>7.1f}x {:>6}".format(
+                size, size / mrjob_secs, size / local_secs,
+                mrjob_secs / local_secs,
+                str(sorted(mrjob_out) == sorted(local_out))))
+
+
+def bench_csv(sizes=(10000, 100000, 1000000)):
+    '''
+    Compares reading a csv file line by line with AstroObject.
+    fill_attributes to catalog_csv.py's chunked parser, giving either
+    columns or AstroObjects, and checks that they read the same objects.
+    Inputs:
+        sizes: iterable of ints, numbers of objects to test
+    '''
+    def read_lines(in_file):
+        with open(in_file) as f:
+            return [AstroObject(data_row=line) for line in f]
+
+    def read_columns(in_file):
+        return sum(len(batch["objid"])
+                   for batch in catalog_csv.read_batches(in_file))
+
+    def read_objects(in_file):
+        return list(catalog_csv.read_objects(in_file))
+
+    print("{:>8} {:>14} {:>16} {:>16} {:>6}".format(
+        "objects", "lines (obj/s)", "columns (obj/s)", "objects (obj/s)",
+        "same"))
+    with TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            in_file = os.path.join(tmp_dir, "objects.csv")
+            write_csv(random_objects(size), in_file)
+
+            lines_secs, lines = timed(read_lines, in_file)
+            columns_secs, _ = timed(read_columns, in_file)
+            objects_secs, objects = timed(read_objects, in_file)
+            same = [astr.__repr__() for astr in lines] == \
+                [astr.__repr__() for astr in objects]
+            print("{:>8} {:>14.0f} {:>16.0f} {:>16.0f} {:>6}".format(
+                size, size / lines_secs, size / columns_secs,
+                size / objects_secs, str(same)))
+
+
+def bench_store(sizes=(100000, 1000000)):
+    '''
+    Compares loading the catalog for alg_2_local.py from a csv file to
+    loading it from a catalog_store.py store, after converting it once,
+    and checks that they give the same columns.
+    Inputs:
+        sizes: iterable of ints, numbers of objects to test
+    '''
+    print("{:>8} {:>13} {:>13} {:>13} {:>8} {:>6}".format(
+        "objects", "convert (s)", "csv (obj/s)", "store (obj/s)",
+        "speedup", "same"))
+    with TemporaryDirectory() as tmp_dir:
+        for size in sizes:
+            in_file = os.path.join(tmp_dir, "objects.csv")
+            store_dir = os.path.join(tmp_dir, "store")
+            write_csv(random_objects(size), in_file)
+
+            convert_secs, _ = timed(catalog_store.write_store, [in_file],
+                                    store_dir)
+            csv_secs, csv_catalog = timed(alg_2_local.load_catalog, in_file)
+            store_secs, store_catalog = timed(alg_2_local.load_catalog,
+                                              store_dir)
+            same = all(np.array_equal(csv_catalog[name], store_catalog[name])
+                       for name in csv_catalog)
+            print("{:>8} {:>13.2f} {:>13.0f} {:>13.0f} {:>7.1f}x {:>6}"
+                  .format(size, convert_secs, size / csv_secs,
+                          size / store_secs, csv_secs / store_secs,
+                          str(same)))
+
+
+def bench_region(size=1000000, width=60,
+                 regions=((20, 21, 30, 31), (20, 30, 30, 40))):
+    '''
+    Compares loading a patch of sky for alg_2_local.py from a csv file,
+    from a store, and from an indexed store, which only reads the rows
+    near the patch, and checks that they give the same objects.
+    Inputs:
+        size: int, number of objects to test
+        width: float, size in degrees of the patch of sky the objects
+            are spread over
+        regions: iterable of (ra1, ra2, dec1, dec2) patches to load
+    '''
+    with TemporaryDirectory() as tmp_dir:
+        in_file = os.path.join(tmp_dir, "objects.csv")
+        store_dir = os.path.join(tmp_dir, "store")
+        indexed_dir = os.path.join(tmp_dir, "indexed")
+        write_csv(random_objects(size, width=width), in_file)
+        catalog_store.write_store([in_file], store_dir)
+        index_secs, _ = timed(catalog_store.write_store, [in_file],
+                              indexed_dir, index=True)
+
+        print("{} objects, converting and indexing took {:.2f}s".format(
+            size, index_secs))
+        print("{:>22} {:>8} {:>10} {:>10} {:>12} {:>10} {:>6}".format(
+            "region", "objects", "csv (s)", "store (s)", "indexed (s)",
+            "rows read", "same"))
+        for region in regions:
+            csv_secs, csv_catalog = timed(alg_2_local.load_catalog, in_file,
+                                          region)
+            store_secs, _ = timed(alg_2_local.load_catalog, store_dir,
+                                  region)
+            indexed_secs, catalog = timed(alg_2_local.load_catalog,
+                                          indexed_dir, region)
+            rows_read = sum(end - start for start, end in
+                            catalog_store.region_rows(indexed_dir, region))
+            same = sorted(csv_catalog["objid"]) == sorted(catalog["objid"])
+            print("{:>22} {:>8} {:>10.3f} {:>10.3f} {:>12.4f} {:>10} {:>6}"
+                  .format(str(region), len(catalog["objid"]), csv_secs,
+                          store_secs, indexed_secs, rows_read, str(same)))
+
+
+def bench_download(strips=12, rows=2000, job_counts=(1, 4, 8)):
+    '''
+    Times irsa_async.py downloading strips from a local TAP stand-in
+    (see tap_stand_in.py) with 1 job at a time, as irsa_api.py runs
+    them, and with more jobs in flight, and checks that every strip is
+    downloaded whole.
+    Inputs:
+        strips: int, number of ra strips to query
+        rows: int, rows in each strip's result
+        job_counts: iterable of ints, most jobs in flight to test
+    '''
+    async def download_all(max_jobs, out_dir):
+        tap = tap_stand_in.StandInTAP(queue_secs=0.2, run_secs=0.5,
+                                      rows=rows, latency=0.02)
+        url = await tap.start()
+        query = url + "?QUERY=SELECT+{}+FROM+allwise_p3as_psd+WHERE+" \
+            "ra>={}+AND+ra<{}&FORMAT=CSV&PHASE=RUN"
+        status_list = [{"info": "", "status": "", "query": query.format(
+            ",".join(catalog_csv.COLUMN_NAMES), 360 / strips * i,
+            360 / strips * (i + 1))} for i in range(strips)]
+        restart_list = await irsa_async.Downloader(out_dir, max_jobs).run(
+            status_list)
+        await tap.stop()
+        return restart_list
+
+    print("{:>9} {:>8} {:>10} {:>9}".format("max jobs", "secs", "rows",
+                                            "restarts"))
+    for max_jobs in job_counts:
+        with TemporaryDirectory() as tmp_dir:
+            secs, restart_list = timed(asyncio.run,
+                                       download_all(max_jobs, tmp_dir))
+            num_rows = sum(len(batch["ra"])
+                           for name in os.listdir(tmp_dir)
+                           if name not in ("query_log.csv",
+                                           result_manifest.MANIFEST)
+                           for batch in catalog_csv.read_batches(
+                               os.path.join(tmp_dir, name)))
+            print("{:>9} {:>8.2f} {:>10} {:>9}".format(
+                max_jobs, secs, num_rows, len(restart_list)))
+
+
+def bench_merge(size=1000000, num_strips=36, dups=100):
+    '''
+    Compares merging downloaded strips with scripts/merge_datafiles.sh,
+    which only concatenates them, to merge_strips.py, which also checks,
+    sorts and dedupes them, with runs as big as a strip and with small
+    runs merged in several passes.
+    Inputs:
+        size: int, number of objects to test
+        num_strips: int, number of ra strips to split them into
+        dups: int, rows of each strip also written to the next one
+    '''
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "..", "scripts", "merge_datafiles.sh")
+    astr_l = random_objects(size, width=60)
+    strip_width = 60 / num_strips
+    strips = [[] for _ in range(num_strips)]
+    for astr in astr_l:
+        strips[min(int((astr.ra - 10) / strip_width), num_strips - 1)] \
+            .append(astr)
+
+    print("{:>22} {:>8} {:>10} {:>7}".format("merge", "secs", "rows",
+                                             "sorted"))
+    with TemporaryDirectory() as tmp_dir:
+        strip_dir = os.path.join(tmp_dir, "strips")
+        os.mkdir(strip_dir)
+        for i, strip in enumerate(strips):
+            extra = strips[i - 1][:dups] if i else []
+            write_csv(strip + extra, os.path.join(
+                strip_dir, "{:07d}.csv".format(i)), header=True)
+
+        out_file = os.path.join(tmp_dir, "merged.csv")
+        runs = (("merge_datafiles.sh", None, None),
+                ("merge_strips", None, merge_strips.RUN_BYTES),
+                ("merge_strips 1 proc", 1, merge_strips.RUN_BYTES),
+                ("merge_strips 1MB runs", None, 1 << 20))
+        for name, processes, run_bytes in runs:
+            if run_bytes is None:
+                secs, _ = timed(subprocess.run, ["bash", script, strip_dir,
+                                                 out_file], check=True)
+            else:
+                secs, _ = timed(merge_strips.merge_strips, [strip_dir],
+                                out_file, processes, run_bytes)
+            ra = [batch["ra"] for batch in
+                  catalog_csv.read_batches(out_file, columns=(("ra", 1),))]
+            ra = np.concatenate(ra)
+            print("{:>22} {:>8.2f} {:>10} {:>7}".format(
+                name, secs, len(ra), str(bool(np.all(np.diff(ra) >= 0)))))
+
+
+def bench_neighbours(background=10000, num_clusters=20, members=50,
+                     width=30, seed=0):
+    '''
+    Compares the neighbours Algorithm I draws cluster radii from: the
+    reservoir of the last outliers a mapper saw (alg_1_util.map_clust,
+    with its distances grouped per object as the combiner does), the
+    nearest outliers in the same part of the sky from a KD-tree
+    (alg_1_util.tree_clust), as with NEIGHBOURS = "tree" (with and
+    without PARTITION_HALO), and the nearest outliers in the whole sky,
+    comparing all pairs a pair of tiles at a time
+    (alg_1_util.tiled_top_k), as "tiles" does. The outliers are spread
+    over a patch of sky across ra 0/360, with some in tight clusters of
+    common proper motion. Checks how many of the objects with the
+    smallest radii (as many as there are cluster members) are cluster
+    members.
+    Inputs:
+        background: int, number of outliers spread over the patch
+        num_clusters: int, number of clusters
+        members: int, number of outliers in each cluster
+        width: float, size of the patch in degrees, centred on ra 0,
+            dec 0
+        seed: int, seed for the random number generator
+    '''
+    rand = np.random.RandomState(seed)
+    num_members = num_clusters * members
+    astr_l = random_objects(background + num_members, seed)
+    ra = rand.uniform(-width / 2, width / 2, background + num_clusters)
+    dec = rand.uniform(-width / 2, width / 2, background + num_clusters)
+    pm = rand.normal(0, 50, (background + num_clusters, 2))
+    for i, astr in enumerate(astr_l):
+        if i < background:
+            astr.ra, astr.dec = ra[i] % 360, dec[i]
+            astr.ra_motion, astr.dec_motion = pm[i]
+            continue
+        center = background + (i - background) // members
+        astr.ra = (ra[center] + rand.normal(0, 0.1)) % 360
+        astr.dec = dec[center] + rand.normal(0, 0.1)
+        astr.ra_motion, astr.dec_motion = pm[center] + rand.normal(0, 2, 2)
+    is_member = {astr.objid: i >= background
+                 for i, astr in enumerate(astr_l)}
+    rand.shuffle(astr_l)
+
+    def reservoir():
+        node_list, dists = [], {}
+        for astr in astr_l:
+            for _, dist in alg_1_util.map_clust(
+                    astr, alg_1.Algorithm1MR.MAX_LEN,
+                    alg_1.Algorithm1MR.LEN_MULT, node_list):
+                dists.setdefault(astr.objid, (astr, []))[1].append(dist)
+        return [out for astr, dist_l in dists.values()
+                for _, out in alg_1_util.comb_clust(
+                    astr, iter(dist_l), alg_1.Algorithm1MR.TOP_K,
+                    alg_1.Algorithm1MR.BINS)]
+
+    def tree(halo=False):
+        nside = alg_1.Algorithm1MR.PARTITION_NSIDE
+        parts = {}
+        for astr in astr_l:
+            pix = healpix.ang2pix(nside, astr.ra, astr.dec)
+            pixels = {pix}
+            if halo:
+                pixels |= set(healpix.neighbours(nside, pix)) - {-1}
+            for part_pix in pixels:
+                parts.setdefault(part_pix, []).append(
+                    (astr, part_pix == pix))
+        return [out for part in parts.values()
+                for _, out in alg_1_util.tree_clust(
+                    [astr for astr, _ in part], alg_1.Algorithm1MR.TOP_K,
+                    alg_1.Algorithm1MR.BINS, [own for _, own in part])]
+
+    def tiles():
+        top = alg_1_util.tiled_top_k(alg_1_util.outlier_coords(astr_l),
+                                     alg_1.Algorithm1MR.TOP_K)
+        radii = alg_1_util.peak_radii(top, alg_1.Algorithm1MR.BINS)
+        for astr, radius in zip(astr_l, radii):
+            astr.dist_from_center = radius
+        return [astr for astr, radius in zip(astr_l, radii)
+                if not np.isnan(radius)]
+
+    print("{:>10} {:>8} {:>8} {:>13}".format("neighbours", "secs", "radii",
+                                             "members found"))
+    for name, func in (("reservoir", reservoir), ("tree", tree),
+                       ("tree halo", lambda: tree(halo=True)),
+                       ("tiles", tiles)):
+        secs, radii = timed(func)
+        radii.sort(key=lambda astr: astr.dist_from_center)
+        found = sum(is_member[astr.objid] for astr in radii[:num_members])
+        print("{:>10} {:>8.2f} {:>8} {:>13.0%}".format(
+            name, secs, len(radii), found / num_members))
+
+
+def bench_top_k(sizes=(1000, 100000, 1000000), k=250):
+    '''
+    Compares ways of taking the k nearest of a key's stream of distances
+    in Algorithm I's combiner: the original (list, heapify, first k
+    entries of the heap), heapq.nsmallest, and alg_1_util.smallest.
+    Checks which give the true k smallest, and measures the most memory
+    each holds at once with tracemalloc (in a second, untimed run).
+    Distances come in random order, and in descending order, the worst
+    case for a heap, where each distance replaces one kept.
+    Inputs:
+        sizes: iterable of ints, numbers of distances of a key
+        k: int, how many to keep, as Algorithm1MR.TOP_K
+    '''
+    def original(dist_gen):
+        heap = [val for val in dist_gen]
+        heapq.heapify(heap)
+        return heap[:min(k, len(heap))]
+
+    methods = (("original", original),
+               ("heapq.nsmallest", lambda dist_gen: heapq.nsmallest(
+                   k, dist_gen)),
+               ("smallest", lambda dist_gen: alg_1_util.smallest(
+                   dist_gen, k)))
+
+    rand = np.random.RandomState(0)
+    print("{:>8} {:>11} {:>16} {:>8} {:>10} {:>8}".format(
+        "size", "order", "method", "secs", "peak (KB)", "correct"))
+    for size in sizes:
+        dists = rand.exponential(1, size).tolist()
+        expected = sorted(dists)[:k]
+        for order in ("random", "descending"):
+            if order == "descending":
+                dists = sorted(dists, reverse=True)
+            for name, func in methods:
+                secs, nearest = timed(func, iter(dists))
+                tracemalloc.start()
+                func(iter(dists))
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                correct = sorted(np.asarray(nearest).tolist()) == expected
+                print("{:>8} {:>11} {:>16} {:>8.3f} {:>10.0f} {:>8}".format(
+                    size, order, name, secs, peak / 1024, str(correct)))
+
+
+def bench_radius(num=100000, k=250, num_bins=15, seed=0):
+    '''
+    Compares drawing Algorithm I's cluster radii with a spline per
+    object (alg_1_util.spline_radius, as comb_clust did) to all at once
+    (alg_1_util.peak_radii), and checks that they find the same radii,
+    to within RADIUS_TOLERANCE. Each object's distances to its k nearest
+    outliers are drawn from a gamma distribution, of a shape and scale
+    of its own. They are also rounded to 0.1, so that many are tied or
+    fall on a bin edge.
+    Inputs:
+        num: int, number of objects
+        k: int, distances per object, as Algorithm1MR.TOP_K
+        num_bins: int, as Algorithm1MR.BINS
+        seed: int, seed for the random number generator
+    '''
+    rand = np.random.RandomState(seed)
+    dists = np.sort(rand.gamma(rand.uniform(1, 5, (num, 1)),
+                               rand.uniform(1, 20, (num, 1)), (num, k)),
+                    axis=1)
+
+    print("{:>10} {:>8} {:>12} {:>10} {:>8} {:>11} {:>15}".format(
+        "distances", "objects", "spline (s)", "batch (s)", "speedup",
+        "same found", "max rel diff"))
+    for name, case in (("continuous", dists),
+                       ("rounded", np.round(dists, 1))):
+        spline_secs, spline = timed(
+            lambda: np.array([alg_1_util.spline_radius(row, num_bins)
+                              for row in case]))
+        peak_secs, peak = timed(alg_1_util.peak_radii, case, num_bins)
+
+        found = ~np.isnan(spline)
+        same_found = np.array_equal(found, ~np.isnan(peak))
+        diff = np.abs(peak[found] - spline[found]) / spline[found]
+        print("{:>10} {:>8} {:>12.2f} {:>10.2f} {:>7.0f}x {:>11} {:>15.1e}"
+              .format(name, num, spline_secs, peak_secs,
+                      spline_secs / peak_secs, str(same_found),
+                      diff.max() if len(diff) else 0))
+        if not same_found or (len(diff) and
+                              diff.max() > RADIUS_TOLERANCE):
+            raise AssertionError("peak_radii and spline_radius disagree "
+                                 "on the {} distances".format(name))
+
+
+def bench_parallel(size=200000, width=10):
+    '''
+    Times the clustering stage of alg_2_local.py with 1, 2, 4, ... worker
+    processes, up to the number of cores, and checks that every run
+    keeps the same objects as the serial one.
+    Inputs:
+        size: int, number of objects to test
+        width: float, size in degrees of the patch of sky the objects
+            are spread over (width ** 2 bins)
+    '''
+    class SeededAlgorithm2MR(alg_2.Algorithm2MR):
+        SEED = 0
+
+    cores = alg_2_local.num_cores()
+    counts = [1]
+    while counts[-1] * 2 <= cores:
+        counts.append(counts[-1] * 2)
+    if counts[-1] != cores:
+        counts.append(cores)
+
+    with TemporaryDirectory() as tmp_dir:
+        in_file = os.path.join(tmp_dir, "objects.csv")
+        write_csv(random_objects(size, width=width), in_file)
+        catalog = alg_2_local.load_catalog(in_file)
+
+    print("{} objects, {} cores".format(size, cores))
+    print("{:>9} {:>10} {:>8} {:>10} {:>6}".format(
+        "processes", "secs", "speedup", "efficiency", "same"))
+    for processes in counts:
+        secs, clusters = timed(alg_2_local.find_clusters, dict(catalog),
+                               SeededAlgorithm2MR, alg_2_local.NUM_BINS,
+                               processes)
+        if processes == 1:
+            serial_secs, serial = secs, clusters
+        same = all(np.array_equal(clusters[name], serial[name])
+                   for name in serial)
+        print("{:>9} {:>10.2f} {:>7.1f}x {:>9.0%} {:>6}".format(
+            processes, secs, serial_secs / secs,
+            serial_secs / secs / processes, str(same)))
+
+
+def bench_tiles(sizes=(10000, 40000), k=250, seed=0):
+    '''
+    Times the exact k nearest distances of all outliers of alg_1_util's
+    tiled_top_k, with 1 process and with one per core, and with a few
+    tile sizes. Checks them against a KD-tree over all the outliers
+    (periodic in ra, as tree_clust's), and that shuffling the outliers
+    does not change any object's distances.
+    Inputs:
+        sizes: iterable of ints, numbers of outliers
+        k: int, how many distances to keep, as Algorithm1MR.TOP_K
+        seed: int, seed for the random number generator
+    '''
+    rand = np.random.RandomState(seed)
+    cores = alg_2_local.num_cores()
+    print("{} cores".format(cores))
+    print("{:>8} {:>6} {:>9} {:>8} {:>12} {:>6} {:>9}".format(
+        "outliers", "tile", "processes", "secs", "pairs/s", "exact",
+        "shuffled"))
+    for size in sizes:
+        coords = alg_1_util.outlier_coords(random_objects(size, seed, 360))
+        wrapped = coords.copy()
+        wrapped[:, 0] %= 360
+        ref, _ = cKDTree(wrapped, boxsize=alg_1_util.COORD_PERIODS).query(
+            wrapped, k=k + 1)
+        order = rand.permutation(size)
+        for tile_size, processes in ((1024, 1), (4096, 1),
+                                     (alg_1_util.TILE_SIZE, 1),
+                                     (alg_1_util.TILE_SIZE, cores)):
+            secs, top = timed(alg_1_util.tiled_top_k, coords, k, tile_size,
+                              processes)
+            shuffled = alg_1_util.tiled_top_k(coords[order], k, tile_size,
+                                              processes)
+            print("{:>8} {:>6} {:>9} {:>8.2f} {:>12.3g} {:>6} {:>9}".format(
+                size, tile_size, processes, secs, size * size / secs,
+                str(np.allclose(top, ref[:, 1:], rtol=0, atol=1e-12)),
+                str(np.array_equal(shuffled, top[order]))))
+
+
+BENCHMARKS = {"random_walk": bench_random_walk,
+              "astro_object": bench_astro_object,
+              "protocol": bench_protocol,
+              "local_engine": bench_local_engine,
+              "parallel": bench_parallel,
+              "csv": bench_csv,
+              "store": bench_store,
+              "region": bench_region,
+              "download": bench_download,
+              "merge": bench_merge,
+              "neighbours": bench_neighbours,
+              "top_k": bench_top_k,
+              "radius": bench_radius,
+              "tiles": bench_tiles}
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or sorted(BENCHMARKS)
+    for name in names:
+        print("== {}".format(name))
+        BENCHMARKS[name]()
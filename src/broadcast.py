@@ -0,0 +1,194 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Side channel for the small statistics one MRjob step computes and later
+steps need (color centroids, means and stdevs). Class attributes set in
+a reducer only reach later steps with the inline runner, where every
+task runs in the same process. Here the reducer that computes a
+statistic saves it to a directory every task can read, and later steps
+load it in their mapper_init.
+
+The directory is given with --stats-dir. It can be a local path, for
+the local runner or a filesystem all nodes mount, or a URI such as
+gs://bucket/stats or hdfs:///tmp/stats, which is accessed with the
+hadoop command on the cluster's nodes. Without it the statistics are
+only kept in the class attributes, which is enough for the inline
+runner.
+
+Each entry of a statistic (e.g. the stdev of one center) is saved in
+its own pickle file. So reducers computing different entries never
+write the same file (the chained k-means steps update one centroid per
+reducer), and a job that computes a statistic twice (Algorithm I runs
+the stdev step twice) keeps entries from the first run that the second
+one does not replace, as the class attributes did. Files left from an
+earlier job are deleted when the job starts.
+'''
+
+from copy import copy
+import glob
+import io
+import os
+import pickle
+import subprocess
+import tempfile
+
+from mrjob.job import MRJob
+
+SUFFIX = ".pickle"
+
+
+def is_uri(path):
+    return "://" in path
+
+
+def entry_path(stats_dir, name, key):
+    '''
+    Path of the file holding one entry of a statistic. key "*" gives a
+    pattern matching all of its entries.
+    '''
+    if isinstance(key, tuple):
+        key = "_".join(str(part) for part in key)
+    file_name = "{}-{}{}".format(name, key, SUFFIX)
+    if is_uri(stats_dir):
+        return stats_dir.rstrip("/") + "/" + file_name
+    return os.path.join(stats_dir, file_name)
+
+
+def task_partition():
+    '''
+    Number of the running map or reduce task within its step. A task
+    that is retried keeps its number, so saving under it replaces what
+    a failed attempt saved instead of adding to it.
+    '''
+    return int(os.environ.get("mapreduce_task_partition",
+                              os.environ.get("mapred_task_partition", 0)))
+
+
+def read_stats(stats_dir, name):
+    '''
+    Reads a statistic saved by write_stats.
+    Inputs:
+        stats_dir: str, directory or URI shared by all tasks of the job
+        name: str, name of the statistic
+    Returns dict, empty if the statistic was never saved
+    '''
+    pattern = entry_path(stats_dir, name, "*")
+    if is_uri(stats_dir):
+        # Prints all the entry files one after the other
+        result = subprocess.run(["hadoop", "fs", "-cat", pattern],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.DEVNULL)
+        f = io.BytesIO(result.stdout if result.returncode == 0 else b"")
+        stats = {}
+        while f.tell() < len(f.getvalue()):
+            key, value = pickle.load(f)
+            stats[key] = value
+        return stats
+
+    stats = {}
+    for path in glob.glob(pattern):
+        with open(path, "rb") as f:
+            key, value = pickle.load(f)
+            stats[key] = value
+    return stats
+
+
+def write_stats(stats_dir, name, stats):
+    '''
+    Saves entries of a statistic, replacing any saved before under the
+    same keys. Each file is replaced in one step, so readers never see
+    it half written.
+    Inputs:
+        stats_dir: str, directory or URI shared by all tasks of the job
+        name: str, name of the statistic
+        stats: dict of entries to save
+    '''
+    if is_uri(stats_dir):
+        subprocess.run(["hadoop", "fs", "-mkdir", "-p", stats_dir],
+                       check=True)
+    else:
+        os.makedirs(stats_dir, exist_ok=True)
+
+    for key, value in stats.items():
+        path = entry_path(stats_dir, name, key)
+        if is_uri(stats_dir):
+            with tempfile.NamedTemporaryFile(suffix=SUFFIX) as f:
+                pickle.dump((key, value), f)
+                f.flush()
+                subprocess.run(["hadoop", "fs", "-put", "-f", f.name, path],
+                               check=True)
+            continue
+
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            pickle.dump((key, value), f)
+        os.replace(tmp_path, path)
+
+
+def clear_stats(stats_dir):
+    '''
+    Deletes all statistics saved in stats_dir. Other files are kept.
+    '''
+    pattern = entry_path(stats_dir, "*", "*")
+    if is_uri(stats_dir):
+        subprocess.run(["hadoop", "fs", "-rm", "-f", pattern],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+
+    for path in glob.glob(pattern):
+        os.remove(path)
+
+
+class BroadcastMRJob(MRJob):
+    '''
+    Base for jobs whose steps pass statistics on to later steps. A
+    statistic is a dict or list class attribute of the job (e.g. stdev
+    or centroids), which save_stats updates and load_stats overwrites
+    with what was saved.
+    '''
+
+    def configure_args(self):
+        super().configure_args()
+        self.add_passthru_arg(
+            "--stats-dir", default=None,
+            help="Directory or URI all tasks can read and write, used to "
+                 "pass centroids, means and stdevs to later steps. Needed "
+                 "by every runner but inline.")
+
+    def make_runner(self):
+        # Only runs in the driver, before any step
+        if self.options.stats_dir:
+            clear_stats(self.options.stats_dir)
+        return super().make_runner()
+
+    def save_stats(self, name, stats):
+        '''
+        Updates entries of a statistic, and saves them for later steps.
+        Inputs:
+            name: str, name of the attribute holding the statistic
+            stats: dict of keys (or list indices) to new values
+        '''
+        attr = getattr(self, name)
+        for key, value in stats.items():
+            attr[key] = value
+        if self.options.stats_dir:
+            write_stats(self.options.stats_dir, name, stats)
+
+    def load_stats(self, name):
+        '''
+        Overwrites entries of a statistic with those saved by earlier
+        steps. Entries never saved keep their default. Call from a
+        mapper_init or reducer_init.
+        Inputs:
+            name: str, name of the attribute holding the statistic
+        '''
+        if not self.options.stats_dir:
+            return
+
+        # Copy, so the class attribute's defaults are left alone
+        attr = copy(getattr(self, name))
+        for key, value in read_stats(self.options.stats_dir, name).items():
+            attr[key] = value
+        setattr(self, name, attr)
@@ -0,0 +1,275 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Streaming reader for ALLWISE csv files, with the columns irsa_api.py
+downloads. Reads the file in large chunks and parses each chunk into
+typed numpy columns at once, instead of splitting and converting one
+line at a time as AstroObject.fill_attributes does:
+    - the rows of a chunk are split into one flat list of fields with a
+      single bytes.split
+    - each column wanted is a strided slice of that list, converted with
+      one map(float) into a numpy array
+so every loop over rows or fields runs in C. Only a column holding a
+value that is not a number is converted again value by value, to find
+the bad rows.
+
+Header rows (e.g. at the top of each downloaded strip) and blank lines
+are skipped. Rows with the wrong number of fields or a value that is
+not a number are reported, by default on stderr, and dropped. Other
+rows give the same values as fill_attributes. Columns asked for as
+nullable (e.g. uncertainties and SNRs, often null in ALLWISE) are not
+checked: a value there that is not a number is read as NaN.
+
+Gives either batches of columns (read_batches) or AstroObjects
+(read_objects).
+'''
+
+from itertools import repeat
+import sys
+
+import numpy as np
+
+from astro_object import AstroObject
+
+CHUNK_BYTES = 1 << 24  # Bytes read from the file at a time
+
+# Fields of each row, as in irsa_api.columns
+COLUMN_NAMES = ("designation", "ra_pm", "dec_pm", "sigra_pm", "sigdec_pm",
+                "pmra", "pmdec", "sigpmra", "sigpmdec", "w1mpro", "w2mpro",
+                "w3mpro", "w4mpro", "w1snr", "w2snr", "w3snr", "w4snr")
+NUM_FIELDS = len(COLUMN_NAMES)
+HEADER_FIELD = COLUMN_NAMES[0].encode()  # First field of header rows
+
+# Float columns AstroObject reads, and their index in a row (see
+# AstroObject.fill_attributes). The objid is field 0.
+FLOAT_COLUMNS = (("ra", 1), ("dec", 2), ("ra_motion", 5), ("dec_motion", 6),
+                 ("w1", 9), ("w2", 10), ("w3", 11), ("w4", 12))
+
+
+def report_row(line_number, row):
+    '''
+    Default handler for malformed rows: prints them to stderr.
+    Inputs:
+        line_number: int, line of the row in the file, from 1
+        row: str, the row
+    '''
+    print("malformed row at line {}: {}".format(line_number, row),
+          file=sys.stderr)
+
+
+def parse_floats(fields):
+    '''
+    Converts fields to floats with float(), as fill_attributes does.
+    Inputs:
+        fields: list of bytes
+    Returns tuple of numpy float array, and numpy bool array that is True
+        where the field is not a number
+    '''
+    try:
+        values = np.fromiter(map(float, fields), dtype=float,
+                             count=len(fields))
+        return values, np.zeros(len(fields), dtype=bool)
+    except ValueError:
+        pass
+
+    values = np.zeros(len(fields))
+    bad = np.zeros(len(fields), dtype=bool)
+    for i, field in enumerate(fields):
+        try:
+            values[i] = float(field)
+        except ValueError:
+            bad[i] = True
+    return values, bad
+
+
+def chunk_rows(chunk, num_fields=NUM_FIELDS):
+    '''
+    Splits whole lines of a csv file into rows, skipping header rows and
+    blank lines.
+    Inputs:
+        chunk: bytes, lines of the file, ending with a newline
+        num_fields: int, number of fields a row should have
+    Returns tuple of:
+        lines: list of bytes, the lines of the chunk
+        rows: numpy int array, indices of the lines that are rows
+        malformed: numpy int array, indices of the lines with the wrong
+            number of fields
+    '''
+    lines = chunk[:-1].split(b"\n")
+    num_commas = np.fromiter(map(bytes.count, lines, repeat(b",")),
+                             dtype=np.int64, count=len(lines))
+    good = num_commas == num_fields - 1
+
+    # Blank lines and headers are neither rows nor errors
+    skip = np.zeros(len(lines), dtype=bool)
+    for i in np.flatnonzero(num_commas == 0):
+        skip[i] = not lines[i].strip()
+    if HEADER_FIELD + b"," in chunk:
+        skip |= good & np.fromiter(
+            map(bytes.startswith, lines, repeat(HEADER_FIELD + b",")),
+            dtype=bool, count=len(lines))
+
+    return (lines, np.flatnonzero(good & ~skip),
+            np.flatnonzero(~good & ~skip))
+
+
+def row_fields(chunk, lines, rows):
+    '''
+    Splits rows into one flat list of fields.
+    Inputs:
+        chunk, lines, rows: a chunk and its split from chunk_rows
+    Returns list of bytes, the fields of each row one after the other
+    '''
+    if len(rows) == len(lines):
+        return chunk[:-1].replace(b"\n", b",").split(b",")
+    return b",".join([lines[i] for i in rows]).split(b",")
+
+
+def parse_chunk(chunk, columns=FLOAT_COLUMNS, num_fields=NUM_FIELDS,
+                nullable=()):
+    '''
+    Parses whole lines of a csv file into columns.
+    Inputs:
+        chunk: bytes, lines of the file, ending with a newline
+        columns: tuple of (name, index in row) of the float columns
+        num_fields: int, number of fields a row should have
+        nullable: tuple of (name, index in row) of float columns whose
+            values that are not numbers are NaN, not malformed
+    Returns tuple of:
+        batch: dict of column name to numpy array: objid (str objects),
+            the float columns, and color1 and color2 if w1 to w4 are
+            among them
+        malformed: list of line indices within the chunk of malformed
+            rows
+    '''
+    lines, rows, wrong_fields = chunk_rows(chunk, num_fields)
+    fields = row_fields(chunk, lines, rows)
+
+    batch = {"objid": np.array(b",".join(fields[::num_fields]).decode()
+                               .split(","), dtype=object)[:len(rows)]}
+    bad = np.zeros(len(rows), dtype=bool)
+    for name, i in columns:
+        batch[name], bad_values = parse_floats(fields[i::num_fields])
+        bad |= bad_values
+    for name, i in nullable:
+        batch[name], null = parse_floats(fields[i::num_fields])
+        batch[name][null] = np.nan
+    if all(name in batch for name in ("w1", "w2", "w3", "w4")):
+        batch["color1"] = batch["w1"] - batch["w2"]
+        batch["color2"] = batch["w3"] - batch["w4"]
+
+    malformed = np.concatenate([wrong_fields, rows[bad]])
+    if bad.any():
+        batch = {name: column[~bad] for name, column in batch.items()}
+    return batch, sorted(malformed.tolist())
+
+
+def read_chunks(f, chunk_bytes=CHUNK_BYTES):
+    '''
+    Reads a binary file in chunks of whole lines.
+    Inputs:
+        f: binary file object
+        chunk_bytes: int, bytes to read at a time
+    Yields: bytes, one or more lines, ending with a newline
+    '''
+    rest = b""
+    while True:
+        data = f.read(chunk_bytes)
+        if not data:
+            break
+        data = rest + data
+        end = data.rfind(b"\n") + 1
+        rest = data[end:]
+        if end:
+            yield data[:end]
+
+    if rest:
+        yield rest + b"\n"
+
+
+def read_batches(in_file, chunk_bytes=CHUNK_BYTES, columns=FLOAT_COLUMNS,
+                 num_fields=NUM_FIELDS, on_error=report_row, nullable=()):
+    '''
+    Reads an ALLWISE csv file in batches of columns.
+    Inputs:
+        in_file: str, path to csv file, or a binary file object
+        chunk_bytes: int, bytes to read at a time
+        columns: tuple of (name, index in row) of the float columns
+        num_fields: int, number of fields a row should have
+        on_error: function called with the line number (from 1) and text
+            of each malformed row
+        nullable: tuple of (name, index in row) of float columns whose
+            values that are not numbers are NaN, not malformed
+    Yields: dict of column name to numpy array (see parse_chunk), of the
+        rows of one chunk
+    '''
+    if isinstance(in_file, str):
+        with open(in_file, "rb") as f:
+            yield from read_batches(f, chunk_bytes, columns, num_fields,
+                                    on_error, nullable)
+        return
+
+    first_line = 1
+    for chunk in read_chunks(in_file, chunk_bytes):
+        batch, malformed = parse_chunk(chunk, columns, num_fields,
+                                       nullable)
+        if malformed:
+            lines = chunk.split(b"\n")
+            for i in malformed:
+                on_error(first_line + i,
+                         lines[i].decode(errors="replace").rstrip("\r"))
+        first_line += chunk.count(b"\n")
+        yield batch
+
+
+def batch_objects(batch):
+    '''
+    Builds AstroObjects from a batch of columns from parse_chunk.
+    Inputs:
+        batch: dict of column name to numpy array
+    Yields: AstroObject
+    '''
+    columns = [batch[name].tolist() for name in
+               ("objid", "ra", "dec", "ra_motion", "dec_motion", "w1", "w2",
+                "w3", "w4", "color1", "color2")]
+    # Sets the attributes directly instead of through __init__, which
+    # is most of the cost of an object
+    new = AstroObject.__new__
+    for (objid, ra, dec, ra_motion, dec_motion, w1, w2, w3, w4, color1,
+         color2) in zip(*columns):
+        astr = new(AstroObject)
+        astr.objid = objid
+        astr.ra = ra
+        astr.dec = dec
+        astr.ra_motion = ra_motion
+        astr.dec_motion = dec_motion
+        astr.w1 = w1
+        astr.w2 = w2
+        astr.w3 = w3
+        astr.w4 = w4
+        astr.color1 = color1
+        astr.color2 = color2
+        astr.bin_id = None
+        astr.dist_from_center = None
+        astr.rand_walk_visits = 0
+        yield astr
+
+
+def read_objects(in_file, chunk_bytes=CHUNK_BYTES, num_fields=NUM_FIELDS,
+                 on_error=report_row):
+    '''
+    Reads an ALLWISE csv file as AstroObjects, the same as building one
+    with AstroObject(data_row=line) for each row. See read_batches for
+    the inputs.
+    Yields: AstroObject
+    '''
+    for batch in read_batches(in_file, chunk_bytes, FLOAT_COLUMNS,
+                              num_fields, on_error):
+        yield from batch_objects(batch)
+
+
+if __name__ == "__main__":
+    for astr in read_objects(sys.argv[1]):
+        print(astr.__repr__())
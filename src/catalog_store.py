@@ -0,0 +1,362 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Binary column store for ALLWISE catalogs, so the csv files irsa_api.py
+downloads are parsed once instead of on every run. A store is a
+directory with one file of raw values per column of irsa_api.columns
+(e.g. ra_pm.bin) and a small header.json giving the number of rows and
+each column's dtype. The header is written last, so a conversion that
+did not finish leaves no readable store.
+
+Reading a store maps the column files with np.memmap: nothing is parsed
+or copied, pages are read from disk as they are used, and processes
+reading the same store share them through the page cache.
+
+A store can be indexed: its rows sorted by NESTED HEALPix pixel (see
+healpix.py) at INDEX_NSIDE, with index.bin giving the first row of
+every pixel. As the sub-pixels of a pixel are numbered consecutively,
+the rows of any pixel at a lower nside are one range too. read_region
+then reads only the rows of the pixels covering a patch of sky (e.g.
+one star forming region, or one Algorithm II bin and its halo), instead
+of the whole catalog.
+
+Convert csv files (e.g. the strips irsa_api.py downloads, each with its
+own header row), with --index to sort and index the store, with:
+    >>> python3 catalog_store.py [--index] store_dir input_file [...]
+'''
+
+import json
+import os
+import sys
+
+import numpy as np
+
+import catalog_csv
+import healpix
+
+HEADER = "header.json"
+INDEX = "index.bin"
+VERSION = 1
+
+# About 14 arcminute pixels, with a 6MB index
+INDEX_NSIDE = 256
+# Most positions region_pixels samples, before it coarsens the pixels
+MAX_SAMPLES = 1 << 20
+# Rows sorted at a time by sort_store
+SORT_BLOCK = 1 << 22
+
+# ALLWISE designations are 19 characters, e.g. J000000.00+000000.0
+OBJID_DTYPE = "S24"
+FLOAT_DTYPE = "<f8"
+
+# Float columns of the store, and their index in a csv row: all but the
+# designation. Rows are checked only in those the algorithms read (see
+# catalog_csv.FLOAT_COLUMNS), as the csv path does. The others, e.g.
+# uncertainties and SNRs, are often null, and are stored as NaN where
+# they are not numbers.
+READ_INDICES = {i for _, i in catalog_csv.FLOAT_COLUMNS}
+STORE_COLUMNS = tuple((name, i) for i, name in
+                      enumerate(catalog_csv.COLUMN_NAMES) if i)
+CHECKED_COLUMNS = tuple((name, i) for name, i in STORE_COLUMNS
+                        if i in READ_INDICES)
+NULLABLE_COLUMNS = tuple((name, i) for name, i in STORE_COLUMNS
+                         if i not in READ_INDICES)
+
+
+def column_path(store_dir, name):
+    return os.path.join(store_dir, name + ".bin")
+
+
+def encode_objids(objid):
+    '''
+    Converts a column of designations to the store's fixed width bytes.
+    Inputs:
+        objid: numpy array of str
+    Returns numpy bytes array
+    '''
+    width = np.dtype(OBJID_DTYPE).itemsize
+    if max(map(len, objid), default=0) > width:
+        raise ValueError("designations longer than {} characters"
+                         .format(width))
+    return objid.astype(OBJID_DTYPE)
+
+
+def read_header(store_dir):
+    with open(os.path.join(store_dir, HEADER)) as f:
+        header = json.load(f)
+    if header["version"] != VERSION:
+        raise ValueError("unsupported store version {}"
+                         .format(header["version"]))
+    return header
+
+
+def write_header(store_dir, header):
+    with open(os.path.join(store_dir, HEADER), "w") as f:
+        json.dump(header, f)
+
+
+def remove_header(store_dir):
+    '''
+    Makes a store unreadable while its files are rewritten.
+    '''
+    header_path = os.path.join(store_dir, HEADER)
+    if os.path.exists(header_path):
+        os.remove(header_path)
+
+
+def write_store(in_files, store_dir, on_error=catalog_csv.report_row,
+                index=False):
+    '''
+    Converts ALLWISE csv files to a store, one after the other, replacing
+    any store already in store_dir.
+    Inputs:
+        in_files: list of str, paths to csv files
+        store_dir: str, directory to write the store to
+        on_error: function called with the line number and text of each
+            malformed row (see catalog_csv.read_batches)
+        index: bool, True to sort and index the store (see sort_store)
+    Returns int, number of rows written
+    '''
+    os.makedirs(store_dir, exist_ok=True)
+    remove_header(store_dir)
+    index_path = os.path.join(store_dir, INDEX)
+    if os.path.exists(index_path):
+        os.remove(index_path)
+
+    names = catalog_csv.COLUMN_NAMES
+    dtypes = {name: FLOAT_DTYPE for name, _ in STORE_COLUMNS}
+    dtypes[names[0]] = OBJID_DTYPE
+
+    num_rows = 0
+    files = {name: open(column_path(store_dir, name), "wb")
+             for name in names}
+    try:
+        for in_file in in_files:
+            for batch in catalog_csv.read_batches(
+                    in_file, columns=CHECKED_COLUMNS, on_error=on_error,
+                    nullable=NULLABLE_COLUMNS):
+                batch[names[0]] = encode_objids(batch.pop("objid"))
+                for name in names:
+                    files[name].write(
+                        batch[name].astype(dtypes[name], copy=False)
+                        .tobytes())
+                num_rows += len(batch[names[0]])
+    finally:
+        for f in files.values():
+            f.close()
+
+    header = {"version": VERSION,
+              "rows": num_rows,
+              "columns": [[name, dtypes[name]] for name in names]}
+    write_header(store_dir, header)
+    if index:
+        sort_store(store_dir)
+    return num_rows
+
+
+def store_pixels(store, nside):
+    '''
+    NESTED pixel of each row of a store.
+    Inputs:
+        store: dict of columns, from read_store
+        nside: int, power of 2
+    Returns numpy int array
+    '''
+    ra, dec = store["ra_pm"], store["dec_pm"]
+    pix = np.empty(len(ra), dtype=np.int64)
+    for start in range(0, len(ra), SORT_BLOCK):
+        end = start + SORT_BLOCK
+        pix[start:end] = healpix.ang2pix_array(nside, ra[start:end],
+                                               dec[start:end])
+    return pix
+
+
+def sort_store(store_dir, nside=INDEX_NSIDE):
+    '''
+    Sorts the rows of a store by NESTED pixel, keeping the order of rows
+    in the same pixel, and writes the index of the first row of each
+    pixel. Columns are rewritten one at a time, a block of rows at a
+    time, so only the sort order has to fit in memory.
+    Inputs:
+        store_dir: str, directory of the store
+        nside: int, power of 2, pixels to index
+    '''
+    healpix.check_nside(nside)
+    header = read_header(store_dir)
+    store = read_store(store_dir)
+    remove_header(store_dir)
+
+    pix = store_pixels(store, nside)
+    order = np.argsort(pix, kind="stable")
+    for name, _ in header["columns"]:
+        tmp_path = column_path(store_dir, name) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            for start in range(0, len(order), SORT_BLOCK):
+                f.write(store[name][order[start:start + SORT_BLOCK]]
+                        .tobytes())
+        os.replace(tmp_path, column_path(store_dir, name))
+
+    offsets = np.searchsorted(pix[order], np.arange(12 * nside ** 2 + 1))
+    offsets.astype("<i8").tofile(os.path.join(store_dir, INDEX))
+    header["index_nside"] = nside
+    write_header(store_dir, header)
+
+
+def read_store(store_dir):
+    '''
+    Maps the columns of a store into memory, read only.
+    Inputs:
+        store_dir: str, directory of the store
+    Returns dict of column name (as in irsa_api.columns) to numpy array
+    '''
+    header = read_header(store_dir)
+    store = {}
+    for name, dtype in header["columns"]:
+        if not header["rows"]:
+            # An empty file cannot be mapped
+            store[name] = np.zeros(0, dtype=dtype)
+            continue
+        store[name] = np.memmap(column_path(store_dir, name), dtype=dtype,
+                                mode="r", shape=(header["rows"],))
+    return store
+
+
+def store_catalog(store):
+    '''
+    Turns columns of a store into the columns catalog_csv.read_batches
+    gives for a csv file. The float columns are not copied, only the
+    designations are decoded.
+    Inputs:
+        store: dict of columns, e.g. from read_store
+    Returns dict of column name to numpy array: objid (str), the columns
+        in catalog_csv.FLOAT_COLUMNS, color1 and color2
+    '''
+    names = catalog_csv.COLUMN_NAMES
+    catalog = {"objid": store[names[0]].astype(str)}
+    for name, i in catalog_csv.FLOAT_COLUMNS:
+        catalog[name] = store[names[i]]
+    catalog["color1"] = catalog["w1"] - catalog["w2"]
+    catalog["color2"] = catalog["w3"] - catalog["w4"]
+    return catalog
+
+
+def read_catalog(store_dir):
+    '''
+    Reads a whole store as columns (see store_catalog).
+    Inputs:
+        store_dir: str, directory of the store
+    Returns dict of column name to numpy array
+    '''
+    return store_catalog(read_store(store_dir))
+
+
+def in_region(ra, dec, region):
+    '''
+    Checks which positions lie in a patch of sky, bounds included below
+    and excluded above, as with ra/dec bins.
+    Inputs:
+        ra, dec: numpy float arrays, positions in degrees
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2) bounds of the
+            patch, ra1 < ra2
+    Returns numpy bool array
+    '''
+    ra1, ra2, dec1, dec2 = region
+    return (ra >= ra1) & (ra < ra2) & (dec >= dec1) & (dec < dec2)
+
+
+def region_pixels(nside, region):
+    '''
+    Finds pixels covering a patch of sky: those of a grid of positions a
+    third of a pixel apart over the patch, and their neighbours, so that
+    pixels just clipped by the patch's edges are included. Pixels may be
+    coarser than nside, so that at most MAX_SAMPLES positions are used
+    for big patches.
+    Inputs:
+        nside: int, power of 2, finest pixels to use
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2), see in_region
+    Returns tuple of nside of the pixels used, and sorted list of NESTED
+        pixel numbers
+    '''
+    ra1, ra2, dec1, dec2 = region
+    while True:
+        step = 58.6 / nside / 3  # Pixels are about 58.6 / nside degrees
+        num_ra = int((ra2 - ra1) / step) + 2
+        num_dec = int((dec2 - dec1) / step) + 2
+        if num_ra * num_dec <= MAX_SAMPLES or nside == 1:
+            break
+        nside //= 2
+
+    ra, dec = np.meshgrid(np.linspace(ra1, ra2, num_ra),
+                          np.linspace(dec1, dec2, num_dec))
+    pixels = set(np.unique(healpix.ang2pix_array(nside, ra.ravel(),
+                                                 dec.ravel())).tolist())
+    for pix in list(pixels):
+        pixels.update(healpix.neighbours(nside, pix))
+    pixels.discard(-1)
+    return nside, sorted(pixels)
+
+
+def region_rows(store_dir, region):
+    '''
+    Finds the rows of an indexed store that may lie in a patch of sky.
+    Inputs:
+        store_dir: str, directory of the store
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2), see in_region
+    Returns list of (start, end) row ranges, in order
+    '''
+    header = read_header(store_dir)
+    index_nside = header["index_nside"]
+    offsets = np.fromfile(os.path.join(store_dir, INDEX), dtype="<i8")
+    nside, pixels = region_pixels(index_nside, region)
+
+    # Index pixels covered by each pixel used
+    depth = (index_nside // nside) ** 2
+    ranges = []
+    for pix in pixels:
+        start, end = offsets[pix * depth], offsets[(pix + 1) * depth]
+        if start == end:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], int(end))
+        else:
+            ranges.append((int(start), int(end)))
+    return ranges
+
+
+def read_region(store_dir, region):
+    '''
+    Reads the objects in a patch of sky from a store, as columns (see
+    store_catalog). An indexed store only reads the rows of the pixels
+    covering the patch, any other store is read whole.
+    Inputs:
+        store_dir: str, directory of the store
+        region: tuple of 4 floats, (ra1, ra2, dec1, dec2), see in_region
+    Returns dict of column name to numpy array
+    '''
+    store = read_store(store_dir)
+    if "index_nside" in read_header(store_dir):
+        ranges = region_rows(store_dir, region)
+        store = {name: np.concatenate([column[start:end]
+                                       for start, end in ranges] or
+                                      [column[:0]])
+                 for name, column in store.items()}
+
+    rows = in_region(store["ra_pm"], store["dec_pm"], region)
+    return store_catalog({name: column[rows]
+                          for name, column in store.items()})
+
+
+def is_store(path):
+    '''
+    Checks whether path is a store written by write_store.
+    '''
+    return os.path.isfile(os.path.join(path, HEADER))
+
+
+if __name__ == "__main__":
+    index = sys.argv[1] == "--index"
+    args = sys.argv[1 + index:]
+    rows = write_store(args[1:], args[0], index=index)
+    print("wrote {} rows to {}".format(rows, args[0]))
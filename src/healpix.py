@@ -0,0 +1,251 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+HEALPix pixelization of the sky (Gorski et al. 2005), in the NESTED
+ordering, for use as spatial keys.
+
+Unlike ra/dec bins, every HEALPix pixel covers the same solid angle, and
+pixels neither shrink to slivers at the poles nor get cut at ra 0/360,
+so each Algorithm II reducer gets about the same area of sky. The sky
+is split into 12 base faces, each an nside x nside grid of pixels
+indexed by (x, y). In the NESTED ordering a pixel's number is its face
+followed by the bits of x and y interleaved, so the 4 ** k sub-pixels
+of a pixel at nside * 2 ** k are numbered consecutively.
+
+Only what the pipeline needs is implemented: position to pixel (also
+for whole arrays of positions), and the 8 neighbours of a pixel.
+'''
+
+from math import radians, sin, sqrt
+
+import numpy as np
+
+# Face adjacency for neighbours(). Rows are indexed by 4 + dx + 3 * dy,
+# where dx and dy (-1, 0 or 1) say whether a step left the face's (x, y)
+# grid below or above its range. Columns are the base face the step
+# started on, -1 means there is no face in that direction.
+FACE_ARRAY = [[8, 9, 10, 11, -1, -1, -1, -1, 10, 11, 8, 9],
+              [5, 6, 7, 4, 8, 9, 10, 11, 9, 10, 11, 8],
+              [-1, -1, -1, -1, 5, 6, 7, 4, -1, -1, -1, -1],
+              [4, 5, 6, 7, 11, 8, 9, 10, 11, 8, 9, 10],
+              [0, 1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11],
+              [1, 2, 3, 0, 0, 1, 2, 3, 5, 6, 7, 4],
+              [-1, -1, -1, -1, 7, 4, 5, 6, -1, -1, -1, -1],
+              [3, 0, 1, 2, 3, 0, 1, 2, 4, 5, 6, 7],
+              [2, 3, 0, 1, -1, -1, -1, -1, 0, 1, 2, 3]]
+# How (x, y) change when crossing into that face, for north polar,
+# equatorial and south polar faces. Bit 1 flips x, bit 2 flips y and
+# bit 4 swaps x and y.
+SWAP_ARRAY = [[0, 0, 3], [0, 0, 6], [0, 0, 0],
+              [0, 0, 5], [0, 0, 0], [5, 0, 0],
+              [0, 0, 0], [6, 0, 0], [3, 0, 0]]
+# Steps to the 8 neighbours, in the order they are returned
+X_OFFSET = [-1, -1, 0, 1, 1, 1, 0, -1]
+Y_OFFSET = [0, 1, 1, 1, 0, -1, -1, -1]
+
+
+def check_nside(nside):
+    '''
+    NESTED pixel numbers need nside to be a power of 2.
+    '''
+    if nside < 1 or nside & (nside - 1):
+        raise ValueError("nside must be a power of 2, got {}".format(nside))
+
+
+def spread_bits(val):
+    '''
+    Moves bit i of val to bit 2i, e.g. 0b111 -> 0b10101.
+    '''
+    rv = 0
+    bit = 0
+    while val:
+        rv |= (val & 1) << (2 * bit)
+        val >>= 1
+        bit += 1
+    return rv
+
+
+def compress_bits(val):
+    '''
+    Inverse of spread_bits. Keeps the even bits of val, packed.
+    '''
+    rv = 0
+    bit = 0
+    while val:
+        rv |= (val & 1) << bit
+        val >>= 2
+        bit += 1
+    return rv
+
+
+def xyf2pix(nside, x, y, face):
+    '''
+    Pixel number of position (x, y) on a base face.
+    '''
+    return face * nside * nside + spread_bits(x) + (spread_bits(y) << 1)
+
+
+def pix2xyf(nside, pix):
+    '''
+    Inverse of xyf2pix.
+    Returns tuple of 3 ints, (x, y, face)
+    '''
+    face, sub = divmod(pix, nside * nside)
+    return compress_bits(sub), compress_bits(sub >> 1), face
+
+
+def ang2pix(nside, ra, dec):
+    '''
+    Finds the pixel a position falls in.
+    Inputs:
+        nside: int, power of 2. The sky has 12 * nside ** 2 pixels
+        ra, dec: floats, position in degrees
+    Returns int, NESTED pixel number
+    '''
+    z = sin(radians(dec))
+    za = abs(z)
+    tt = (ra / 90) % 4  # ra in units of quarter circles, in [0, 4)
+
+    if za <= 2 / 3:
+        # Equatorial region. Find the ascending and descending pixel edge
+        # lines the position is between, the face is where they cross.
+        temp1 = nside * (0.5 + tt)
+        temp2 = nside * z * 0.75
+        jp = int(temp1 - temp2)
+        jm = int(temp1 + temp2)
+        ifp = jp // nside
+        ifm = jm // nside
+        if ifp == ifm:
+            face = ifp | 4
+        elif ifp < ifm:
+            face = ifp
+        else:
+            face = ifm + 8
+        x = jm & (nside - 1)
+        y = nside - (jp & (nside - 1)) - 1
+        return xyf2pix(nside, x, y, face)
+
+    # Polar caps, one face per quarter of ra
+    ntt = min(3, int(tt))
+    tp = tt - ntt
+    tmp = nside * sqrt(3 * (1 - za))
+    jp = min(int(tp * tmp), nside - 1)
+    jm = min(int((1 - tp) * tmp), nside - 1)
+    if z >= 0:
+        return xyf2pix(nside, nside - jm - 1, nside - jp - 1, ntt)
+    return xyf2pix(nside, jp, jm, ntt + 8)
+
+
+def spread_bits_array(val):
+    '''
+    spread_bits for a numpy array of values below 2 ** 32.
+    '''
+    val = val.astype(np.uint64)
+    for shift, mask in ((16, 0x0000FFFF0000FFFF), (8, 0x00FF00FF00FF00FF),
+                        (4, 0x0F0F0F0F0F0F0F0F), (2, 0x3333333333333333),
+                        (1, 0x5555555555555555)):
+        val = (val | (val << np.uint64(shift))) & np.uint64(mask)
+    return val.astype(np.int64)
+
+
+def ang2pix_array(nside, ra, dec):
+    '''
+    ang2pix for numpy arrays of positions.
+    Inputs:
+        nside: int, power of 2
+        ra, dec: numpy float arrays, positions in degrees
+    Returns numpy int array, NESTED pixel numbers
+    '''
+    z = np.sin(np.radians(dec))
+    za = np.abs(z)
+    tt = (np.asarray(ra) / 90) % 4
+
+    # Equatorial region, as in ang2pix
+    temp1 = nside * (0.5 + tt)
+    temp2 = nside * z * 0.75
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+    ifp = jp // nside
+    ifm = jm // nside
+    face = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    x = jm & (nside - 1)
+    y = nside - (jp & (nside - 1)) - 1
+
+    # Polar caps
+    polar = za > 2 / 3
+    ntt = np.minimum(3, tt.astype(np.int64))
+    tp = tt - ntt
+    tmp = nside * np.sqrt(3 * (1 - np.minimum(za, 1)))
+    jp = np.minimum((tp * tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1 - tp) * tmp).astype(np.int64), nside - 1)
+    north = polar & (z >= 0)
+    south = polar & (z < 0)
+    x = np.where(north, nside - jm - 1, np.where(south, jp, x))
+    y = np.where(north, nside - jp - 1, np.where(south, jm, y))
+    face = np.where(north, ntt, np.where(south, ntt + 8, face))
+
+    return face * nside * nside + spread_bits_array(x) + \
+        (spread_bits_array(y) << 1)
+
+
+def neighbours(nside, pix):
+    '''
+    Finds the pixels around a pixel, in O(1).
+    Inputs:
+        nside: int, power of 2
+        pix: int, NESTED pixel number
+    Returns list of 8 ints, the SW, W, NW, N, NE, E, SE and S neighbours.
+        Where 3 faces meet there are only 7, and the missing one is -1.
+    '''
+    x, y, face = pix2xyf(nside, pix)
+    rv = []
+    for d_x, d_y in zip(X_OFFSET, Y_OFFSET):
+        n_x, n_y = x + d_x, y + d_y
+
+        # Work out which face the step lands on
+        direction = 4
+        if n_x < 0:
+            n_x += nside
+            direction -= 1
+        elif n_x >= nside:
+            n_x -= nside
+            direction += 1
+        if n_y < 0:
+            n_y += nside
+            direction -= 3
+        elif n_y >= nside:
+            n_y -= nside
+            direction += 3
+
+        n_face = FACE_ARRAY[direction][face]
+        if n_face < 0:
+            rv.append(-1)
+            continue
+
+        bits = SWAP_ARRAY[direction][face // 4]
+        if bits & 1:
+            n_x = nside - n_x - 1
+        if bits & 2:
+            n_y = nside - n_y - 1
+        if bits & 4:
+            n_x, n_y = n_y, n_x
+        rv.append(xyf2pix(nside, n_x, n_y, n_face))
+
+    return rv
+
+
+def sub_pixel(nside, pix, depth, ra, dec):
+    '''
+    Finds where a position falls within a pixel, on the grid of its
+    2 ** depth x 2 ** depth sub-pixels.
+    Inputs:
+        nside: int, power of 2
+        pix: int, NESTED pixel number the position is in
+        depth: int, number of times to split the pixel in 4
+        ra, dec: floats, position in degrees
+    Returns tuple of 2 ints, (x, y) of the sub-pixel
+    '''
+    sub = ang2pix(nside << depth, ra, dec) - (pix << (2 * depth))
+    return compress_bits(sub), compress_bits(sub >> 1)
@@ -13,6 +13,10 @@ estimations.
 It is advisable to download in 2 steps, using get_data() and
 monitor_queries() in succession, rather than using the main() function.
 This generally results in fewer errors due to the IRSA API's limits.
+
+Results are downloaded through result_manifest.py: a transfer that is
+cut off is resumed from the bytes already on disk, and whole results are
+recorded with their size, sha256 and number of rows in manifest.csv.
 '''
 
 import csv
@@ -21,11 +25,20 @@ import sys
 import pandas as pd
 from time import sleep
 from requests import get
+from requests.exceptions import RequestException
 from xml.etree import ElementTree
 
+import result_manifest
+from result_manifest import ResultError, RowCountError
+
 # Base query
 BASE = "https://irsa.ipac.caltech.edu/TAP/async?QUERY=SELECT+{}+FROM+{}+WHERE+{}&FORMAT=CSV&PHASE=RUN"
 
+# Tries at downloading a result, each resuming where the last stopped
+MAX_RESUMES = 5
+TIMEOUT = 60  # Seconds to wait on a connection before giving up
+BLOCK = 1 << 16  # Bytes written at a time
+
 # Columns to pull
 columns = ["designation",
            "ra_pm",
@@ -195,20 +208,27 @@ def monitor_queries(out_dir):
 
             # Otherwise, get update on progress
             try:
-                status = ElementTree.fromstring(
-                    get(query['info']).content)[2].text
+                job_xml = get(query['info']).content
+                status = ElementTree.fromstring(job_xml)[2].text
             except:
                 print("Warning... cannot connect. Added to restart list.")
                 query["status"] = status
                 restart_list.append(query)
                 continue
 
-            # If completed, write to file.
+            # If completed, write to file, unless already downloaded whole
             if status == "COMPLETED":
-                with get(query['info'] + "/results/result", stream=True) as result:
-                    with open("{}/{}.csv".format(out_dir, query['info'][-7:]), "wb") as f:
-                        for block in result.iter_content(1024):
-                            f.write(block)
+                try:
+                    if not result_manifest.is_done(out_dir, query['info']) \
+                            and not download_result(
+                                query['info'], out_dir,
+                                result_manifest.expected_rows(job_xml)):
+                        # Kept, not restarted: the job is still done
+                        print("Warning... download cut off. Run "
+                              "monitor_queries again to resume it.")
+                except RowCountError as e:
+                    print("Warning... {}. Added to restart list.".format(e))
+                    restart_list.append(query)
                 num_done += 1
                 query["status"] = status
                 continue
@@ -234,6 +254,46 @@ def monitor_queries(out_dir):
     return restart_list
 
 
+def download_result(info, out_dir, rows=None):
+    '''
+    Downloads a completed job's result to out_dir/<id>.csv, resuming
+    from the bytes already downloaded if an earlier transfer was cut
+    off, and adds it to out_dir's manifest (see result_manifest.py).
+    Inputs:
+        info: str, url of the job's status page
+        out_dir: str, directory to download to
+        rows: int, number of rows the job gave for its result, or None
+    Returns bool, True if the result was downloaded whole, False if the
+        transfer was cut off MAX_RESUMES times (what was downloaded is
+        kept, to be resumed)
+    Raises RowCountError if the result has the wrong number of rows
+    '''
+    path = "{}/{}".format(out_dir, result_manifest.result_name(info))
+    for _ in range(MAX_RESUMES):
+        offset = result_manifest.resume_offset(path)
+        # Byte offsets only hold for the file as stored, not compressed
+        headers = {"Accept-Encoding": "identity"}
+        if offset:
+            headers["Range"] = "bytes={}-".format(offset)
+        try:
+            with get(info + "/results/result", headers=headers,
+                     stream=True, timeout=TIMEOUT) as result:
+                start, total = result_manifest.range_start(
+                    result.status_code, result.headers, offset)
+                if start is not None:
+                    with open(path + result_manifest.PART_SUFFIX,
+                              "ab" if start else "wb") as f:
+                        for block in result.iter_content(BLOCK):
+                            f.write(block)
+            result_manifest.finish_result(out_dir, info, total, rows)
+            return True
+        except RowCountError:
+            raise
+        except (RequestException, ResultError) as e:
+            print("Warning... download cut off ({}). Resuming.".format(e))
+    return False
+
+
 def create_log(out_dir, filename, data):
     '''
     Helper function to write csv log files.
@@ -0,0 +1,370 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Concurrent client for IRSA's TAP async jobs, in place of the serial
+init_queries and monitor_queries in irsa_api.py. Each strip's query is
+one asyncio task that submits the job, polls its phase with
+exponential backoff, and downloads the result when it completes, so
+slow strips do not hold up the others. At most MAX_JOBS jobs are in
+flight on IRSA's side at once, and at most MAX_DOWNLOADS results are
+downloaded at once.
+
+Results are written under a temporary name and renamed when complete
+(a transfer that is cut off is resumed from where it stopped, see
+result_manifest.py), and query_log.csv is replaced in one step whenever
+a job changes phase, so an interrupted run never leaves a half written
+result or log. Logs
+have the same format as irsa_api.py's, so either can pick up the
+other's.
+
+HTTP is done with requests, as in irsa_api.py. Its calls block, so
+each runs in a thread of the event loop's executor, which has a thread
+for every job and download that may be in flight at once. See
+tap_stand_in.py for a local server to try it against.
+Run with (same arguments as irsa_api.main):
+    >>> python3 irsa_async.py num_bins min_snr out_dir [max_jobs]
+'''
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import csv
+import os
+import sys
+import tempfile
+from xml.etree import ElementTree
+
+from requests import get
+
+import result_manifest
+from result_manifest import ResultError, RowCountError
+
+MAX_JOBS = 8  # Jobs submitted and not yet finished at once
+MAX_DOWNLOADS = 4  # Results downloaded at once
+POLL_FIRST = 1  # Seconds before a job's first poll
+POLL_FACTOR = 1.5  # Growth of the delay between polls
+POLL_MAX = 60  # Longest delay between polls
+TIMEOUT = 60  # Seconds to wait on a connection before giving up
+# Tries at downloading a result, each resuming where the last stopped
+MAX_RESUMES = 5
+BLOCK = 1 << 16  # Bytes read at a time
+
+DONE_FLAGS = ("COMPLETED", "ERROR", "ABORTED")
+LOG_FIELDS = ("info", "status", "query")
+
+
+class HTTPError(Exception):
+    '''
+    Raised on an unexpected HTTP status.
+    '''
+
+
+class DownloadError(Exception):
+    '''
+    Raised when a result's transfer is cut off MAX_RESUMES times. What
+    was downloaded is kept, to be resumed.
+    '''
+
+
+def blocking_request(url, open_out, request_headers, statuses):
+    '''
+    http_request's GET, which blocks until the whole body is read.
+    '''
+    with get(url, headers=request_headers, stream=True,
+             timeout=TIMEOUT) as response:
+        if response.status_code not in statuses:
+            raise HTTPError("{} for {}".format(response.status_code, url))
+        out = open_out(response.status_code, response.headers) \
+            if open_out else None
+        if out is None:
+            body = response.content
+        else:
+            body = b""
+            for block in response.iter_content(BLOCK):
+                out.write(block)
+        return response.url, response.status_code, response.headers, body
+
+
+async def http_request(url, open_out=None, request_headers=None,
+                       statuses=(200,)):
+    '''
+    GETs a url with requests, following redirects, in a thread of the
+    event loop's executor.
+    Inputs:
+        url: str, http or https url
+        open_out: function of the status and response headers, returning
+            a binary file object to write the body to, or None to return
+            the body. None to always return it
+        request_headers: dict of extra request headers, or None
+        statuses: tuple of ints, HTTP statuses to accept
+    Returns tuple of the final url after redirects, the status, the
+        response headers (case insensitive), and the body (b"" if
+        written to a file)
+    '''
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        None, blocking_request, url, open_out, request_headers, statuses)
+
+
+async def http_get(url, out=None):
+    '''
+    GETs a url, following redirects, see http_request.
+    Returns tuple of the final url after redirects, and the body (b"" if
+        written to out)
+    '''
+    url, _, _, body = await http_request(url, lambda *_: out)
+    return url, body
+
+
+def job_phase(xml):
+    '''
+    Reads the phase (e.g. QUEUED or COMPLETED) from a job's UWS XML.
+    '''
+    for child in ElementTree.fromstring(xml):
+        if child.tag.endswith("phase"):
+            return child.text.strip()
+    raise ValueError("no phase in job XML")
+
+
+def write_log(out_dir, filename, status_list):
+    '''
+    Writes a log in irsa_api.create_log's format, replacing any old one
+    in one step.
+    Inputs:
+        out_dir: str, directory of the log
+        filename: str, name of the log file
+        status_list: list of dicts w/ info, status and query
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=out_dir, suffix=".tmp",
+                                     delete=False, newline="") as f:
+        writer = csv.DictWriter(f, LOG_FIELDS)
+        writer.writeheader()
+        writer.writerows(status_list)
+    os.replace(f.name, os.path.join(out_dir, filename))
+
+
+def result_path(out_dir, info):
+    '''
+    File a job's result is saved to, named as in irsa_api.py.
+    '''
+    return os.path.join(out_dir, result_manifest.result_name(info))
+
+
+async def download(info, out_dir, rows=None):
+    '''
+    Downloads a completed job's result, resuming from the bytes already
+    downloaded if a transfer was cut off, and adds it to out_dir's
+    manifest (see result_manifest.py).
+    Inputs:
+        info: str, url of the job's status page
+        out_dir: str, directory to download to
+        rows: int, number of rows the job gave for its result, or None
+    Returns dict, the result's manifest entry
+    Raises DownloadError if the transfer is cut off MAX_RESUMES times,
+        RowCountError if the result has the wrong number of rows
+    '''
+    path = result_path(out_dir, info)
+    for attempt in range(MAX_RESUMES):
+        offset = result_manifest.resume_offset(path)
+        # Byte offsets only hold for the file as stored, not compressed
+        request_headers = {"Accept-Encoding": "identity"}
+        if offset:
+            request_headers["Range"] = "bytes={}-".format(offset)
+        totals = []
+        try:
+            with open(path + result_manifest.PART_SUFFIX, "ab") as f:
+                def open_part(status, headers):
+                    start, total = result_manifest.range_start(
+                        status, headers, offset)
+                    totals.append(total)
+                    if start == 0:
+                        f.truncate(0)
+                    return f if start is not None else None
+
+                await http_request(info + "/results/result", open_part,
+                                   request_headers, (200, 206, 416))
+            return result_manifest.finish_result(out_dir, info, totals[0],
+                                                 rows)
+        except RowCountError:
+            raise
+        except (OSError, HTTPError, ResultError) as e:
+            # requests' RequestException is an OSError
+            print("Warning... download cut off ({}). Resuming.".format(e))
+    raise DownloadError("download of {} cut off {} times".format(
+        info, MAX_RESUMES))
+
+
+class Downloader:
+    '''
+    Runs a set of IRSA TAP async jobs, a bounded number at a time, and
+    downloads their results to out_dir.
+    '''
+
+    def __init__(self, out_dir, max_jobs=MAX_JOBS,
+                 max_downloads=MAX_DOWNLOADS):
+        self.out_dir = out_dir
+        self.max_jobs = max_jobs
+        self.max_downloads = max_downloads
+        self.jobs = None
+        self.downloads = None
+        self.status_list = []
+        self.restart_list = []
+
+    def update(self, query, status):
+        query["status"] = status
+        write_log(self.out_dir, "query_log.csv", self.status_list)
+
+    async def poll(self, query):
+        '''
+        Waits for a job to finish, polling less and less often.
+        Returns tuple of str, its final phase, and its status page
+        '''
+        delay = POLL_FIRST
+        while True:
+            await asyncio.sleep(delay)
+            _, xml = await http_get(query["info"])
+            status = job_phase(xml)
+            if status in DONE_FLAGS:
+                return status, xml
+            if status != query["status"]:
+                self.update(query, status)
+            delay = min(delay * POLL_FACTOR, POLL_MAX)
+
+    async def run_query(self, query):
+        '''
+        Submits a job (if it has no status page yet), waits for it, and
+        downloads its result. Jobs that fail or cannot be reached, or
+        whose result has the wrong number of rows, are added to
+        restart_list. Jobs whose download is cut off too often are left
+        to be resumed.
+        Inputs:
+            query: dict w/ info (status page url or ""), status and query
+        '''
+        try:
+            async with self.jobs:
+                if not query["info"]:
+                    # Submitting redirects to the job's status page
+                    query["info"], _ = await http_get(query["query"])
+                    self.update(query, "QUEUED")
+                status, xml = await self.poll(query)
+
+            if status != "COMPLETED":
+                print("{}. Added to restarts: {}".format(status,
+                                                         query["info"]))
+                self.restart_list.append(query)
+            elif not result_manifest.is_done(self.out_dir, query["info"]):
+                async with self.downloads:
+                    await download(query["info"], self.out_dir,
+                                   result_manifest.expected_rows(xml))
+        except RowCountError as e:
+            print("Warning... {}. Added to restarts: {}".format(
+                e, query["info"]))
+            status = "ERROR"
+            self.restart_list.append(query)
+        except DownloadError as e:
+            # The job's status is left as it was, so that monitor picks
+            # the download up where it stopped
+            print("Warning... {}. Run monitor to resume it.".format(e))
+            return
+        except (OSError, ValueError, HTTPError, ResultError) as e:
+            print("Warning... cannot connect ({}). Added to restarts: {}"
+                  .format(e, query["info"] or query["query"]))
+            status = "ERROR"
+            self.restart_list.append(query)
+
+        self.update(query, status)
+
+    async def run(self, status_list):
+        '''
+        Runs all the queries, with their info written to query_log.csv.
+        Inputs:
+            status_list: list of dicts w/ info, status and query, e.g.
+                from irsa_api.read_log. Queries with an empty info are
+                submitted, those with a status page are only monitored.
+        Returns list of dicts of failed queries to be restarted
+        '''
+        # Made here, in the loop that runs the queries
+        self.jobs = asyncio.Semaphore(self.max_jobs)
+        self.downloads = asyncio.Semaphore(self.max_downloads)
+        self.status_list = status_list
+        write_log(self.out_dir, "query_log.csv", status_list)
+        with ThreadPoolExecutor(self.max_jobs +
+                                self.max_downloads) as executor:
+            asyncio.get_running_loop().set_default_executor(executor)
+            await asyncio.gather(*[self.run_query(query)
+                                   for query in status_list
+                                   if query["status"] not in DONE_FLAGS])
+        return self.restart_list
+
+
+def fetch(query_list, out_dir, max_jobs=MAX_JOBS,
+          max_downloads=MAX_DOWNLOADS):
+    '''
+    Submits queries and downloads their results.
+    Inputs:
+        query_list: list of query urls, e.g. from irsa_api.build_queries
+        out_dir: str, directory to download to
+        max_jobs, max_downloads: ints, see Downloader
+    Returns list of dicts of failed queries to be restarted, w/ status
+        page url, status and query text
+    '''
+    status_list = [{"info": "", "status": "", "query": query}
+                   for query in query_list]
+    downloader = Downloader(out_dir, max_jobs, max_downloads)
+    return asyncio.run(downloader.run(status_list))
+
+
+def monitor(out_dir, max_jobs=MAX_JOBS, max_downloads=MAX_DOWNLOADS):
+    '''
+    Monitors jobs already submitted (e.g. by irsa_api.get_data with
+    init=True), downloading their results, as irsa_api.monitor_queries
+    does.
+    Inputs:
+        out_dir: str, directory to download to and read query_log.csv from
+        max_jobs, max_downloads: ints, see Downloader
+    Returns list of dicts of failed queries to be restarted
+    '''
+    with open(os.path.join(out_dir, "query_log.csv")) as f:
+        status_list = list(csv.DictReader(f, skipinitialspace=True))
+    downloader = Downloader(out_dir, max_jobs, max_downloads)
+    return asyncio.run(downloader.run(status_list))
+
+
+def get_data(num_bins, min_snr, out_dir, restart=False,
+             catalog="allwise_p3as_psd", debug=0, max_jobs=MAX_JOBS):
+    '''
+    Queries IRSA and downloads the results, as irsa_api.get_data does,
+    with the queries run concurrently. Failed queries are also written
+    to out_dir/restart.csv.
+    Inputs:
+        num_bins: int, num slices to create (36 recommended, 360 fails)
+        min_snr: int, minimum snr in all 4 channels
+        out_dir: str, directory to store data in
+        restart: bool, True if restarting queries in out_dir/restart.csv
+        catalog: str, ident of catalog to search
+        debug: int, debug > 0 means only request subset, len(sub)~debug
+        max_jobs: int, most jobs in flight at once
+    Returns list of dicts of failed queries
+    '''
+    # irsa_api needs pandas, this module does not
+    import irsa_api
+
+    if restart:
+        query_list = irsa_api.read_log(out_dir, "restart.csv", True)
+    else:
+        query_list = irsa_api.build_queries(num_bins, min_snr, catalog)
+        if debug:
+            lower = (len(query_list) // 2) - (debug // 2)
+            upper = (len(query_list) // 2) + (debug // 2)
+            query_list = query_list[lower:upper]
+
+    restart_list = fetch(query_list, out_dir, max_jobs)
+    write_log(out_dir, "restart.csv", restart_list)
+    return restart_list
+
+
+if __name__ == "__main__":
+    get_data(int(sys.argv[1]), float(sys.argv[2]), sys.argv[3],
+             max_jobs=int(sys.argv[4]) if len(sys.argv) > 4 else MAX_JOBS)
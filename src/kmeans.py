@@ -8,37 +8,83 @@ objects as either csv of AstroObject generator input and find centroids
 of their color distribution. From preliminary analysis, there exist 2
 centroids for these color groups, around which color is approx normally
 distributed. Finding these centroids allows for color outlier analysis.
+
+By default the centroids are found in a single pass ("aggregate" mode):
+each mapper sums up the colors of its objects on a fine grid of color
+cells, and one reducer merges the cell sums and runs k-means on them
+in memory until the centroids stop moving. A last map-only pass then
+labels every object with its closest centroid, so the catalog is
+shuffled once instead of once per iteration. "chain" mode does one map
+only pass per iteration, each mapper saving its per-centroid sums for
+the next pass, then the same labelling pass. Either way the iterations
+only work on sums: objects never reach the reducer that runs them, and
+with "chain" they never reach a reducer at all.
 '''
 
-from mrjob.job import MRJob
 from mrjob.step import MRStep
-from mrjob.protocol import PickleProtocol
+import numpy as np
 
 from astro_object import AstroObject
+from astro_protocol import AstroProtocol
+from broadcast import BroadcastMRJob, task_partition
 
 
-class KMeansMR(MRJob):
+class KMeansMR(BroadcastMRJob):
     '''
     MRjob object to find color outliers.
     '''
 
-    INTERNAL_PROTOCOL = PickleProtocol
+    # Pass AstroObjects between steps as binary records, not pickles
+    INTERNAL_PROTOCOL = AstroProtocol
 
     # num kmeans iterations. We set good initial vals so dont need many
     ITERATIONS = 15  
     STD_CUTOFF = 3.5
 
-    centroids = [(0, 0), (0.6, 4)]  # Approx location of centroids
+    # "aggregate" iterates on color cell sums in memory, "chain" runs
+    # ITERATIONS map only passes over the full catalog
+    KMEANS_MODE = "aggregate"
+    # Width of the color cells objects are summed into, in magnitudes.
+    # Objects in a cell count as being at the cell's mean color, so this
+    # is the only approximation. 0 sums up each distinct color exactly.
+    KMEANS_CELL = 0.001
+    KMEANS_TOL = 1e-5  # Stop once no centroid moves further than this
+    KMEANS_MAX_ITER = 300
+    # Objects are spread over this many keys while the sums are merged
+    KMEANS_PARTITIONS = 256
+
+    START_CENTROIDS = ((0, 0), (0.6, 4))  # Approx location of centroids
+    centroids = list(START_CENTROIDS)
+    centroid_sums = {}  # Per-mapper sums of each chained step
     centroids_old = centroids.copy()
     stdev = {}
     means = {}
 
+    def kmeans_init(self):
+        '''
+        MRjob mapper init for steps after a k-means update. Loads the
+        centroids saved by "aggregate" mode, or works them out from the
+        sums saved by the chained steps so far.
+        '''
+        self.load_stats("centroids")
+        self.load_stats("centroid_sums")
+        if self.centroid_sums:
+            self.centroids = replay_sums(self.START_CENTROIDS,
+                                         self.centroid_sums,
+                                         self.options.step_num)
+
+    def mapper_kmeans_init(self):
+        self.kmeans_init()
+        self.sums = [[0, 0.0, 0.0] for _ in self.centroids]
+
     def mapper_kmeans(self, _, line):
         '''
         Calculate which centroid each object is closest to w/ squared
-        eculidian distance, and yield the object coords and centroid.
+        eculidian distance, and add the object's colors to the sums of
+        that centroid. The object is passed on as is, so the chained
+        steps are map only and never shuffle the catalog.
         Yields:
-            centroid: int, index in centroids list of centroid closest
+            None
             values: AstroObject
 
         Note: we are choosing to keep distance from center as an attr
@@ -48,43 +94,237 @@ class KMeansMR(MRJob):
         '''
         centroid, values = map_kmeans(self.centroids, line)
         if values != centroid != None:
-            yield centroid, values
+            sums = self.sums[centroid]
+            sums[0] += 1
+            sums[1] += values.color1
+            sums[2] += values.color2
+            yield None, values
+
+    def mapper_kmeans_final(self):
+        '''
+        Saves this mapper's per-centroid sums. The next step's
+        kmeans_init adds up those of all mappers to move the centroids.
+        '''
+        key = (self.options.step_num, task_partition())
+        self.save_stats("centroid_sums", {key: self.sums})
+
+    def mapper_kmeans_sums_init(self):
+        self.cells = {}
+        self.num_objects = 0
+
+    def mapper_kmeans_sums(self, _, line):
+        '''
+        Local pass of "aggregate" mode. Adds each object's colors to the
+        sums of its color cell, and passes the object on under one of
+        KMEANS_PARTITIONS keys, so no reducer gets the whole catalog.
+        Yields:
+            partition: int
+            values: AstroObject
+        '''
+        astr = to_astro(line)
+        if astr is not None and astr.is_complete():
+            add_to_cell(self.cells, astr, self.KMEANS_CELL)
+            self.num_objects += 1
+            yield self.num_objects % self.KMEANS_PARTITIONS, astr
 
-    def reducer_kmeans_init(self):
-        self.sums = {}
-
-    def reducer_kmeans(self, center, astr_gen):
-        # NOTE: USE YIELD FROM?
-        # get new centroids by averaging the locations of current groups
-        counter = 0
-        color1_sum = 0
-        color2_sum = 0
-        for astr in astr_gen:
-            counter += 1
-            color1_sum += astr.color1
-            color2_sum += astr.color2
-            yield center, astr
-
-            # Assign new centroids and compare to old. If they converge
-            # then skip rest of steps
-        self.centroids[center] = (round(color1_sum / counter, 5),
-                                  round(color2_sum / counter, 5))
+    def mapper_kmeans_sums_final(self):
+        yield CELLS, self.cells
+
+    def reducer_kmeans_sums(self, key, values):
+        '''
+        Merges the cell sums from all mappers and runs k-means on them.
+        Objects are passed through unchanged.
+        '''
+        if key != CELLS:
+            for astr in values:
+                yield None, astr
+            return
+
+        cells = {}
+        for mapper_cells in values:
+            merge_cells(cells, mapper_cells)
+
+        centroids, num_iter = kmeans_cells(cells, self.START_CENTROIDS,
+                                           self.KMEANS_TOL,
+                                           self.KMEANS_MAX_ITER)
+        self.save_stats("centroids", dict(enumerate(centroids)))
+        self.increment_counter("kmeans", "iterations", num_iter)
+        self.increment_counter("kmeans", "color cells", len(cells))
+
+    def mapper_kmeans_label(self, _, astr):
+        '''
+        Final pass of "aggregate" mode. Labels each object with its
+        closest centroid, as in mapper_kmeans.
+        '''
+        centroid, values = map_kmeans(self.centroids, astr)
+        if values != centroid != None:
+            yield centroid, values
 
     def get_steps_kmeans(self):
-        return [MRStep(mapper=self.mapper_kmeans,
-                       reducer_init=self.reducer_kmeans_init,
-                       reducer=self.reducer_kmeans)] * self.ITERATIONS
+        if self.KMEANS_MODE == "chain":
+            return [MRStep(mapper_init=self.mapper_kmeans_init,
+                           mapper=self.mapper_kmeans,
+                           mapper_final=self.mapper_kmeans_final)
+                    ] * self.ITERATIONS + [
+                MRStep(mapper_init=self.kmeans_init,
+                       mapper=self.mapper_kmeans_label)]
+
+        return [MRStep(mapper_init=self.mapper_kmeans_sums_init,
+                       mapper=self.mapper_kmeans_sums,
+                       mapper_final=self.mapper_kmeans_sums_final,
+                       reducer=self.reducer_kmeans_sums),
+                MRStep(mapper_init=self.kmeans_init,
+                       mapper=self.mapper_kmeans_label)]
 
     def steps(self):
         return self.get_steps_kmeans()
 
 
-def map_kmeans(centroids, astr):
-    if isinstance(astr, str):
-        # Parses fresh input from file. Else, assumed to be AstroObject.
-        astr = AstroObject(data_row=astr)
+# Key of the color cell sums in "aggregate" mode
+CELLS = "cells"
+
+
+def to_astro(line):
+    '''
+    Parses fresh input from file. Else, assumed to be AstroObject.
+    Returns AstroObject, or None for anything else
+    '''
+    if isinstance(line, str):
+        line = AstroObject(data_row=line)
 
-    if type(astr) != AstroObject:
+    if type(line) != AstroObject:
+        return None
+    return line
+
+
+def add_to_cell(cells, astr, size):
+    '''
+    Adds an object's colors to the sums of the color cell it falls in.
+    Inputs:
+        cells: dict of cell to list of [count, color1 sum, color2 sum]
+        astr: complete AstroObject
+        size: float, cell width. 0 makes each distinct color a cell.
+    '''
+    if size:
+        cell = (int(astr.color1 // size), int(astr.color2 // size))
+    else:
+        cell = (astr.color1, astr.color2)
+
+    sums = cells.get(cell)
+    if sums is None:
+        cells[cell] = [1, astr.color1, astr.color2]
+    else:
+        sums[0] += 1
+        sums[1] += astr.color1
+        sums[2] += astr.color2
+
+
+def merge_cells(cells, other):
+    '''
+    Adds the cell sums in other to cells, in place.
+    '''
+    for cell, (count, color1_sum, color2_sum) in other.items():
+        sums = cells.get(cell)
+        if sums is None:
+            cells[cell] = [count, color1_sum, color2_sum]
+        else:
+            sums[0] += count
+            sums[1] += color1_sum
+            sums[2] += color2_sum
+
+
+def kmeans_cells(cells, centroids, tol, max_iter):
+    '''
+    Runs k-means on color cells instead of objects. Each iteration
+    assigns whole cells (by their mean color) to the closest centroid
+    and moves each centroid to the mean of its cells' objects.
+    Inputs:
+        cells: dict of cell sums, from add_to_cell/merge_cells
+        centroids: list of (color1, color2) tuples, starting centroids
+        tol: float, stop once no centroid moves further than this
+        max_iter: int, max number of iterations
+    Returns tuple of list of (color1, color2) tuples, the centroids, and
+        int, the number of iterations run
+    '''
+    if not cells:
+        return list(centroids), 0
+
+    return kmeans_cell_sums(np.array(list(cells.values()), dtype=float),
+                            centroids, tol, max_iter)
+
+
+def kmeans_cell_sums(sums, centroids, tol, max_iter):
+    '''
+    kmeans_cells for cell sums already in an array.
+    Inputs:
+        sums: numpy array of shape (number of cells, 3), count, color1
+            sum and color2 sum of each non empty cell
+        centroids, tol, max_iter: as for kmeans_cells
+    Returns tuple of list of (color1, color2) tuples, the centroids, and
+        int, the number of iterations run
+    '''
+    counts = sums[:, 0]
+    means = sums[:, 1:] / counts[:, None]
+    centers = np.array(centroids, dtype=float)
+
+    num_iter = 0
+    while num_iter < max_iter:
+        num_iter += 1
+        sq_dists = ((means[:, None, :] - centers[None, :, :]) ** 2).sum(axis=2)
+        closest = sq_dists.argmin(axis=1)
+
+        new_centers = centers.copy()
+        for i in range(len(centers)):
+            members = closest == i
+            count = counts[members].sum()
+            # A centroid with no objects stays where it is
+            if count:
+                new_centers[i] = sums[members, 1:].sum(axis=0) / count
+
+        moved = np.sqrt(((new_centers - centers) ** 2).sum(axis=1)).max()
+        centers = new_centers
+        if moved <= tol:
+            break
+
+    centroids = [(round(c1, 5), round(c2, 5)) for c1, c2 in centers.tolist()]
+    return centroids, num_iter
+
+
+def replay_sums(centroids, centroid_sums, step_num):
+    '''
+    Works out the centroids after the chained steps before step_num.
+    Each step moves every centroid that had objects to their mean color.
+    Inputs:
+        centroids: sequence of (color1, color2) tuples, the starting
+            centroids
+        centroid_sums: dict of (step number, mapper) to list of
+            [count, color1 sum, color2 sum] per centroid
+        step_num: int, number of the step about to run
+    Returns list of (color1, color2) tuples
+    '''
+    step_totals = {}
+    for (step, _), sums in centroid_sums.items():
+        if step >= step_num:
+            continue
+        totals = step_totals.setdefault(step, [[0, 0.0, 0.0]
+                                               for _ in centroids])
+        for total, mapper_sums in zip(totals, sums):
+            for i in range(3):
+                total[i] += mapper_sums[i]
+
+    centroids = list(centroids)
+    for step in sorted(step_totals):
+        for i, (count, color1_sum, color2_sum) in enumerate(step_totals[step]):
+            if count:
+                centroids[i] = (round(color1_sum / count, 5),
+                                round(color2_sum / count, 5))
+
+    return centroids
+
+
+def map_kmeans(centroids, astr):
+    astr = to_astro(astr)
+    if astr is None:
         return None, None
 
     # Calc closest centroid, yield that centroid and obj colors
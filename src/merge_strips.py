@@ -0,0 +1,348 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Merges the strip files irsa_api.py downloads into one catalog sorted by
+ra, in place of scripts/merge_datafiles.sh. Memory is bounded by
+run_bytes per process, however big the strips are:
+    - each strip is read by one process of a pool, which checks that
+      its header is irsa_api.columns and cuts it into runs of about
+      run_bytes, each sorted by ra and written to a temporary file
+    - the runs are merged by ra with a k-way merge, in several passes
+      if there are more than MAX_RUNS of them, holding one block of
+      BLOCK_BYTES of each run at a time
+Rows are ordered by ra, then designation, so rows of the same object
+(e.g. from a strip downloaded twice, or from strips overlapping at their
+edges) come one after the other and all but the first are dropped. Rows
+with the wrong number of fields or an ra that is not a number are
+reported and dropped, as in catalog_csv.py.
+
+Merge strips (or a directory of them, as downloaded) with:
+    >>> python3 merge_strips.py merged_file input_file [input_file ...]
+'''
+
+from multiprocessing import Pool
+import os
+import re
+import sys
+import tempfile
+
+import numpy as np
+
+import catalog_csv
+import result_manifest
+
+RUN_BYTES = 1 << 26  # Bytes of a strip sorted in memory at a time
+MAX_RUNS = 128  # Most runs merged at once, each with a file open
+BLOCK_BYTES = 1 << 20  # Bytes of each run held at a time in a merge
+
+# Keys runs are sorted by, kept beside each run. ALLWISE designations
+# are 19 characters, e.g. J000000.00+000000.0
+KEY_DTYPE = np.dtype([("ra", "<f8"), ("designation", "S24")])
+
+HEADER = ",".join(catalog_csv.COLUMN_NAMES).encode()
+# Result files in a directory downloaded by irsa_api.py
+RESULT_FILE = re.compile(r"\d{7}\.csv$")
+
+
+def report_row(in_file, line_number, row):
+    '''
+    Default handler for malformed rows: prints them to stderr.
+    Inputs:
+        in_file: str, path to the strip
+        line_number: int, line of the row in the strip, from 1
+        row: str, the row
+    '''
+    print("malformed row at {}:{}: {}".format(in_file, line_number, row),
+          file=sys.stderr)
+
+
+def strip_files(paths):
+    '''
+    Lists the strips to merge. Directories stand for the result files
+    in them, which are first checked against the directory's manifest
+    (see result_manifest.py), if it has one.
+    Inputs:
+        paths: list of str, paths to strips or directories of strips
+    Returns list of str, paths to strips
+    '''
+    in_files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            in_files.append(path)
+            continue
+        bad = result_manifest.check_results(path)
+        if bad:
+            raise ValueError("{} do not match the manifest of {}".format(
+                ", ".join(bad), path))
+        in_files.extend(os.path.join(path, name)
+                        for name in sorted(os.listdir(path))
+                        if RESULT_FILE.match(name))
+    return in_files
+
+
+def check_header(in_file, f):
+    '''
+    Reads the header of a strip and checks it is irsa_api.columns.
+    Inputs:
+        in_file: str, path to the strip, for the error message
+        f: binary file object, at the start of the strip
+    '''
+    header = f.readline().rstrip(b"\r\n")
+    if header != HEADER:
+        raise ValueError("{} has header {!r}, expected {!r}".format(
+            in_file, header.decode(errors="replace"), HEADER.decode()))
+
+
+def sort_chunk(chunk, first_line, in_file, on_error):
+    '''
+    Sorts the rows of a chunk of a strip by ra, then designation.
+    Inputs:
+        chunk: bytes, lines of the strip, ending with a newline
+        first_line: int, line number of the chunk's first line
+        in_file: str, path to the strip, for on_error
+        on_error: function called with in_file, the line number and text
+            of each malformed row
+    Returns tuple of numpy arrays of the sorted rows (bytes objects,
+        without newlines), their ra and their designations
+    '''
+    num_fields = catalog_csv.NUM_FIELDS
+    lines, rows, malformed = catalog_csv.chunk_rows(chunk, num_fields)
+    fields = catalog_csv.row_fields(chunk, lines, rows)
+    ra, bad = catalog_csv.parse_floats(fields[1::num_fields])
+    bad |= ~np.isfinite(ra)
+
+    for i in sorted(malformed.tolist() + rows[bad].tolist()):
+        on_error(in_file, first_line + i,
+                 lines[i].decode(errors="replace").rstrip("\r"))
+
+    # An empty chunk still splits into one (empty) field
+    designation = np.array(fields[::num_fields][:len(rows)], dtype=bytes)
+    if designation.itemsize > KEY_DTYPE["designation"].itemsize:
+        raise ValueError("{} has designations longer than {} characters"
+                         .format(in_file, KEY_DTYPE["designation"].itemsize))
+    order = np.lexsort((designation[~bad], ra[~bad]))
+    rows = np.array(lines, dtype=object)[rows[~bad][order]]
+    if b"\r" in chunk:
+        rows = np.array([row.rstrip(b"\r") for row in rows], dtype=object)
+    return rows, ra[~bad][order], designation[~bad][order]
+
+
+def write_run(blocks, tmp_dir):
+    '''
+    Writes sorted rows to a new run: a text file of the rows, and a
+    binary file of their keys (see KEY_DTYPE), so that merging needs not
+    parse the rows again.
+    Inputs:
+        blocks: iterable of tuples of numpy arrays of rows (bytes objects,
+            without newlines), their ra and their designations
+        tmp_dir: str, directory to write to
+    Returns str, path to the run's text file, or None if it has no rows
+    '''
+    num_rows = 0
+    with tempfile.NamedTemporaryFile("wb", dir=tmp_dir, suffix=".run",
+                                     delete=False) as f, \
+            open(f.name + ".keys", "wb") as keys_file:
+        for rows, ra, designation in blocks:
+            if not len(rows):
+                continue
+            f.write(b"\n".join(rows.tolist()) + b"\n")
+            keys = np.empty(len(rows), dtype=KEY_DTYPE)
+            keys["ra"], keys["designation"] = ra, designation
+            keys.tofile(keys_file)
+            num_rows += len(rows)
+    if not num_rows:
+        remove_run(f.name)
+        return None
+    return f.name
+
+
+def remove_run(run):
+    os.remove(run)
+    os.remove(run + ".keys")
+
+
+def run_rows(run):
+    '''
+    Number of rows of a run.
+    '''
+    return os.path.getsize(run + ".keys") // KEY_DTYPE.itemsize
+
+
+def sort_strip(in_file, tmp_dir, run_bytes=RUN_BYTES, on_error=report_row):
+    '''
+    Checks the header of a strip and cuts it into sorted runs.
+    Inputs:
+        in_file: str, path to the strip
+        tmp_dir: str, directory to write the runs to
+        run_bytes: int, bytes of the strip sorted at a time
+        on_error: function called with in_file, the line number (from 1)
+            and text of each malformed row
+    Returns list of str, paths to the runs
+    '''
+    runs = []
+    with open(in_file, "rb") as f:
+        check_header(in_file, f)
+        first_line = 2
+        for chunk in catalog_csv.read_chunks(f, run_bytes):
+            block = sort_chunk(chunk, first_line, in_file, on_error)
+            first_line += chunk.count(b"\n")
+            run = write_run([block], tmp_dir)
+            if run:
+                runs.append(run)
+    return runs
+
+
+def read_run(run, block_bytes=BLOCK_BYTES):
+    '''
+    Reads a run in blocks of rows.
+    Inputs:
+        run: str, path to the run
+        block_bytes: int, bytes of text to read at a time
+    Yields: tuple of numpy arrays of one block's rows (bytes objects,
+        without newlines), ra (floats) and designations (bytes)
+    '''
+    keys = np.memmap(run + ".keys", dtype=KEY_DTYPE, mode="r")
+    start = 0
+    with open(run, "rb") as f:
+        for chunk in catalog_csv.read_chunks(f, block_bytes):
+            rows = np.array(chunk[:-1].split(b"\n"), dtype=object)
+            block_keys = np.array(keys[start:start + len(rows)])
+            start += len(rows)
+            yield rows, block_keys["ra"], block_keys["designation"]
+
+
+def num_before(ra, designation, bound):
+    '''
+    Counts the rows of a sorted block up to bound, included.
+    Inputs:
+        ra, designation: numpy arrays, keys of the block's rows
+        bound: tuple of (ra, designation)
+    Returns int
+    '''
+    low = np.searchsorted(ra, bound[0], "left")
+    high = np.searchsorted(ra, bound[0], "right")
+    return low + int(np.searchsorted(designation[low:high], bound[1],
+                                     "right"))
+
+
+def merge_runs(runs):
+    '''
+    Merges sorted runs, dropping all but the first row of each object.
+    Rather than one row at a time, runs are read a block at a time, and
+    each round gives all the rows up to the lowest last row of the
+    blocks held, sorted together with numpy, as no row still to be read
+    can come before them.
+    Inputs:
+        runs: list of str, paths to runs
+    Yields: tuple of numpy arrays of rows (bytes objects, without
+        newlines), their ra and their designations, in order
+    '''
+    readers = [read_run(run) for run in runs]
+    blocks = {}  # Reader index to rows, ra and designations left
+    for i, reader in enumerate(readers):
+        blocks[i] = next(reader, None)
+        if blocks[i] is None:
+            del blocks[i]
+
+    last = None  # Designation of the last row given
+    while blocks:
+        bound = min((ra[-1], designation[-1])
+                    for _, ra, designation in blocks.values())
+        taken = []
+        for i in list(blocks):
+            rows, ra, designation = blocks[i]
+            num = num_before(ra, designation, bound)
+            taken.append((rows[:num], ra[:num], designation[:num]))
+            if num < len(rows):
+                blocks[i] = rows[num:], ra[num:], designation[num:]
+            else:
+                # The next block, or none if the run is done
+                blocks[i] = next(readers[i], None)
+                if blocks[i] is None:
+                    del blocks[i]
+
+        rows, ra, designation = (np.concatenate(column)
+                                 for column in zip(*taken))
+        order = np.lexsort((designation, ra))
+        rows, ra, designation = rows[order], ra[order], designation[order]
+        keep = np.ones(len(rows), dtype=bool)
+        keep[1:] = designation[1:] != designation[:-1]
+        keep[0] = designation[0] != last
+        last = designation[-1]
+        yield rows[keep], ra[keep], designation[keep]
+
+
+def merge_passes(runs, tmp_dir):
+    '''
+    Merges runs MAX_RUNS at a time until at most MAX_RUNS are left.
+    Inputs:
+        runs: list of str, paths to runs, which are removed once merged
+        tmp_dir: str, directory to write the new runs to
+    Returns list of str, paths to the runs left
+    '''
+    while len(runs) > MAX_RUNS:
+        merged = []
+        for start in range(0, len(runs), MAX_RUNS):
+            group = runs[start:start + MAX_RUNS]
+            merged.append(write_run(merge_runs(group), tmp_dir))
+            for run in group:
+                remove_run(run)
+        runs = merged
+    return runs
+
+
+def sort_strip_args(args):
+    return sort_strip(*args)
+
+
+def merge_strips(in_files, out_file, processes=None, run_bytes=RUN_BYTES,
+                 tmp_dir=None, on_error=report_row):
+    '''
+    Merges strips into one csv file sorted by ra, with one header row and
+    one row per object. The file is written under a temporary name and
+    renamed when complete.
+    Inputs:
+        in_files: list of str, paths to strips or directories of strips
+            (see strip_files)
+        out_file: str, path to the merged file
+        processes: int, number of processes reading strips, None for one
+            per core
+        run_bytes: int, bytes of a strip each process sorts at a time
+        tmp_dir: str, directory for the runs, by default that of
+            out_file (the runs take as much space as the strips)
+        on_error: picklable function called with the path, line number
+            and text of each malformed row
+    Returns tuple of ints, number of rows written and of duplicate rows
+        dropped
+    '''
+    in_files = strip_files(in_files)
+    out_dir = os.path.dirname(os.path.abspath(out_file))
+    with tempfile.TemporaryDirectory(dir=tmp_dir or out_dir) as run_dir:
+        tasks = [(in_file, run_dir, run_bytes, on_error)
+                 for in_file in in_files]
+        if processes == 1:
+            strip_runs = list(map(sort_strip_args, tasks))
+        else:
+            with Pool(processes) as pool:
+                strip_runs = pool.map(sort_strip_args, tasks)
+
+        runs = [run for runs in strip_runs for run in runs]
+        num_in = sum(map(run_rows, runs))
+        num_rows = 0
+        with tempfile.NamedTemporaryFile("wb", dir=out_dir, suffix=".tmp",
+                                         delete=False) as f:
+            f.write(HEADER + b"\n")
+            for rows, _, _ in merge_runs(merge_passes(runs, run_dir)):
+                if len(rows):
+                    f.write(b"\n".join(rows.tolist()) + b"\n")
+                num_rows += len(rows)
+        os.replace(f.name, out_file)
+    return num_rows, num_in - num_rows
+
+
+if __name__ == "__main__":
+    rows, dups = merge_strips(sys.argv[2:], sys.argv[1])
+    print("wrote {} rows to {}, dropped {} duplicates".format(
+        rows, sys.argv[1], dups))
@@ -0,0 +1,209 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Adaptive quadtree partitioning of the sky for Algorithm II.
+
+The fixed ra/dec grid gives the galactic plane, with millions of
+objects, the same bin size as the poles, which have almost none, so a
+few reducers do nearly all the work. This builds a partition map from a
+sample of the input instead: starting from the whole sky, any cell with
+more than a target number of objects is split into 4 quadrants, until
+every leaf is under the target.
+
+A leaf is identified by its path from the root, a string of quadrant
+digits (0: low ra/low dec, 1: high ra/low dec, 2: low ra/high dec,
+3: high ra/high dec), so its bounds can always be recomputed from its
+key. Build a map with:
+    >>> python3 quadtree.py input_file partition_map.json target [rate]
+and pass it to Algorithm II with --partition-map partition_map.json
+'''
+
+import json
+import sys
+
+import numpy as np
+
+from astro_object import AstroObject
+
+RA_MIN, RA_MAX = 0, 360
+DEC_MIN, DEC_MAX = -90, 90
+MAX_DEPTH = 20  # Cells at this depth are ~1 arcsec, never split further
+
+
+def key_rect(key):
+    '''
+    Calculates the ra/dec bounds of a quadtree cell from its key.
+    Inputs:
+        key: str, quadrant digits from the root to the cell
+    Returns tuple of 4 floats, (ra_l, ra_u, dec_l, dec_u)
+    '''
+    ra_l, ra_u, dec_l, dec_u = RA_MIN, RA_MAX, DEC_MIN, DEC_MAX
+    for digit in key:
+        quad = int(digit)
+        ra_mid = (ra_l + ra_u) / 2
+        dec_mid = (dec_l + dec_u) / 2
+        if quad & 1:
+            ra_l = ra_mid
+        else:
+            ra_u = ra_mid
+        if quad & 2:
+            dec_l = dec_mid
+        else:
+            dec_u = dec_mid
+
+    return ra_l, ra_u, dec_l, dec_u
+
+
+def locate(leaves, ra, dec):
+    '''
+    Finds the leaf of the partition map that a position falls in.
+    Inputs:
+        leaves: set or dict of leaf keys, from load_map
+        ra, dec: floats, position of the object
+    Returns str, key of the leaf
+    '''
+    key = ""
+    ra_l, ra_u, dec_l, dec_u = RA_MIN, RA_MAX, DEC_MIN, DEC_MAX
+    while key not in leaves and len(key) < MAX_DEPTH:
+        ra_mid = (ra_l + ra_u) / 2
+        dec_mid = (dec_l + dec_u) / 2
+        quad = 0
+        if ra >= ra_mid:
+            quad |= 1
+            ra_l = ra_mid
+        else:
+            ra_u = ra_mid
+        if dec >= dec_mid:
+            quad |= 2
+            dec_l = dec_mid
+        else:
+            dec_u = dec_mid
+        key += str(quad)
+
+    return key
+
+
+def build_tree(ra, dec, max_count, key="", max_depth=MAX_DEPTH):
+    '''
+    Recursively splits a cell until each leaf holds at most max_count
+    of the given positions.
+    Inputs:
+        ra, dec: numpy arrays, positions of the (sampled) objects in
+            the cell
+        max_count: float, max number of positions allowed in a leaf
+        key: str, key of the cell being split
+        max_depth: int, cells at this depth are not split further
+    Returns dict mapping leaf key to the number of positions in it
+    '''
+    if len(ra) <= max_count or len(key) >= max_depth:
+        return {key: len(ra)}
+
+    ra_l, ra_u, dec_l, dec_u = key_rect(key)
+    high_ra = ra >= (ra_l + ra_u) / 2
+    high_dec = dec >= (dec_l + dec_u) / 2
+    quads = high_ra * 1 + high_dec * 2
+
+    leaves = {}
+    for quad in range(4):
+        in_quad = quads == quad
+        leaves.update(build_tree(ra[in_quad], dec[in_quad], max_count,
+                                 key + str(quad), max_depth))
+
+    return leaves
+
+
+def sample_positions(in_file, rate):
+    '''
+    Sampling pass over a csv of ALLWISE objects. Keeps every
+    round(1 / rate)'th complete object.
+    Inputs:
+        in_file: str, path to csv file
+        rate: float in (0, 1], fraction of objects to keep
+    Returns tuple of numpy arrays, ra and dec of the sampled objects
+    '''
+    step = max(1, int(round(1 / rate)))
+    ra, dec = [], []
+    with open(in_file) as f:
+        for i, line in enumerate(f):
+            if i % step:
+                continue
+            astr = AstroObject(data_row=line)
+            if astr.is_complete():
+                ra.append(astr.ra)
+                dec.append(astr.dec)
+
+    return np.array(ra), np.array(dec)
+
+
+def build_map(in_file, target, rate=0.01):
+    '''
+    Builds a partition map so that each partition holds at most about
+    'target' objects.
+    Inputs:
+        in_file: str, path to csv file
+        target: int, target max number of objects per partition
+        rate: float in (0, 1], fraction of objects to sample
+    Returns dict with the sample rate, target and a dict of leaf keys to
+        estimated object counts
+    '''
+    ra, dec = sample_positions(in_file, rate)
+    counts = build_tree(ra, dec, target * rate)
+    estimates = {key: int(round(count / rate))
+                 for key, count in counts.items()}
+
+    return {"rate": rate, "target": target, "leaves": estimates}
+
+
+def save_map(partition_map, out_file):
+    '''
+    Writes a partition map from build_map to a json file.
+    '''
+    with open(out_file, "w") as f:
+        json.dump(partition_map, f)
+
+
+def load_map(map_file):
+    '''
+    Reads a partition map written by save_map.
+    Returns dict of leaf keys to estimated object counts
+    '''
+    with open(map_file) as f:
+        return json.load(f)["leaves"]
+
+
+def load_histogram(counts):
+    '''
+    Histograms partition loads in power of 2 buckets, so skew shows up
+    as a long tail. Empty partitions are not counted.
+    Inputs:
+        counts: iterable of ints, number of objects in each partition
+    Returns list of (lower bound, upper bound, number of partitions)
+    '''
+    buckets = np.bincount([int(count).bit_length() for count in counts
+                           if count > 0])
+    start = np.flatnonzero(buckets)[0] if buckets.any() else len(buckets)
+
+    return [(2 ** (i - 1), 2 ** i - 1, int(buckets[i]))
+            for i in range(start, len(buckets))]
+
+
+def print_histogram(hist):
+    '''
+    Prints a histogram from load_histogram.
+    '''
+    print("{:>21} {:>10}".format("objects", "partitions"))
+    for lower, upper, num in hist:
+        print("{:>10}-{:<10} {:>10}".format(lower, upper, num))
+
+
+if __name__ == "__main__":
+    partition_map = build_map(sys.argv[1], int(sys.argv[3]),
+                              float(sys.argv[4]) if len(sys.argv) > 4 else 0.01)
+    save_map(partition_map, sys.argv[2])
+
+    leaves = partition_map["leaves"]
+    print("{} partitions, max estimated load {}".format(
+        len(leaves), max(leaves.values())))
+    print_histogram(load_histogram(leaves.values()))
@@ -0,0 +1,293 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Manifest of the result files downloaded from IRSA, so a download that
+was cut off can be resumed instead of resubmitting its query, and a
+finished one can be checked before it is used.
+
+A result is downloaded to <id>.csv.part, which is kept if the transfer
+is cut off: the next try asks the server (with an HTTP Range header)
+for the bytes after those already on disk. When the transfer is whole,
+the file is renamed to <id>.csv and added to manifest.csv in the same
+directory, with its size, sha256 and number of rows. The number of rows
+is checked against the job's metadata when the job gives it.
+
+Both irsa_api.py and irsa_async.py download through this module. Check
+the files of a directory against its manifest with:
+    >>> python3 result_manifest.py out_dir
+'''
+
+import csv
+import hashlib
+import os
+import re
+import sys
+import tempfile
+from xml.etree import ElementTree
+
+MANIFEST = "manifest.csv"
+MANIFEST_FIELDS = ("file", "bytes", "sha256", "rows")
+PART_SUFFIX = ".part"
+BLOCK = 1 << 20  # Bytes hashed at a time
+HEADER_START = b"designation,"  # Start of a result's header row
+
+# Job metadata that may give the number of rows of a result, by
+# lower case tag or attribute name without namespace
+ROW_NAMES = ("rowcount", "rows", "nrows")
+
+# Content-Range of a partial response: bytes start-end/total
+CONTENT_RANGE = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+# Content-Range of a 416 response: bytes */total
+UNSATISFIED_RANGE = re.compile(r"bytes \*/(\d+)")
+
+
+class ResultError(Exception):
+    '''
+    Raised when a downloaded result does not match what was expected.
+    '''
+
+
+class RowCountError(ResultError):
+    '''
+    Raised when a whole result has a different number of rows than its
+    job gave, so downloading it again will not help.
+    '''
+
+
+def result_name(info):
+    '''
+    Name of the file a job's result is saved to, as in irsa_api.py.
+    Inputs:
+        info: str, url of the job's status page
+    '''
+    return "{}.csv".format(info[-7:])
+
+
+class Digest:
+    '''
+    Size, sha256 and number of rows of a result, computed a block of
+    bytes at a time.
+    '''
+
+    def __init__(self):
+        self.sha256 = hashlib.sha256()
+        self.size = 0
+        self.lines = 0
+        self.start = b""  # First bytes, to recognise a header row
+        self.last = b""  # Last byte, for a last line with no newline
+
+    def update(self, data):
+        if not data:
+            return
+        self.sha256.update(data)
+        self.size += len(data)
+        self.lines += data.count(b"\n")
+        if len(self.start) < len(HEADER_START):
+            self.start = (self.start + data)[:len(HEADER_START)]
+        self.last = data[-1:]
+
+    def rows(self):
+        '''
+        Number of rows, not counting the header row.
+        '''
+        lines = self.lines + (self.last not in (b"", b"\n"))
+        return lines - (self.start == HEADER_START)
+
+    def entry(self, name):
+        return {"file": name, "bytes": self.size,
+                "sha256": self.sha256.hexdigest(), "rows": self.rows()}
+
+
+def file_digest(path):
+    '''
+    Reads a file into a Digest.
+    Inputs:
+        path: str, path to the file
+    Returns Digest
+    '''
+    digest = Digest()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(BLOCK), b""):
+            digest.update(block)
+    return digest
+
+
+def read_manifest(out_dir):
+    '''
+    Reads the manifest of a directory.
+    Inputs:
+        out_dir: str, directory of the results
+    Returns dict of file name to dict w/ file, bytes, sha256 and rows
+        (ints for bytes and rows), empty if there is no manifest
+    '''
+    path = os.path.join(out_dir, MANIFEST)
+    if not os.path.exists(path):
+        return {}
+    with open(path, newline="") as f:
+        manifest = {}
+        for row in csv.DictReader(f):
+            row["bytes"], row["rows"] = int(row["bytes"]), int(row["rows"])
+            manifest[row["file"]] = row
+    return manifest
+
+
+def write_manifest(out_dir, manifest):
+    '''
+    Writes the manifest of a directory, replacing the old one in one
+    step.
+    Inputs:
+        out_dir: str, directory of the results
+        manifest: dict of file name to dict w/ file, bytes, sha256, rows
+    '''
+    os.makedirs(out_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile("w", dir=out_dir, suffix=".tmp",
+                                     delete=False, newline="") as f:
+        writer = csv.DictWriter(f, MANIFEST_FIELDS)
+        writer.writeheader()
+        for name in sorted(manifest):
+            writer.writerow(manifest[name])
+    os.replace(f.name, os.path.join(out_dir, MANIFEST))
+
+
+def add_result(out_dir, entry):
+    '''
+    Adds (or replaces) one file's entry in the manifest of a directory.
+    '''
+    manifest = read_manifest(out_dir)
+    manifest[entry["file"]] = entry
+    write_manifest(out_dir, manifest)
+
+
+def check_file(out_dir, entry):
+    '''
+    Checks a file against its manifest entry.
+    Inputs:
+        out_dir: str, directory of the results
+        entry: dict w/ file, bytes, sha256 and rows
+    Returns bool, True if the file exists and matches
+    '''
+    path = os.path.join(out_dir, entry["file"])
+    if not os.path.isfile(path) or os.path.getsize(path) != entry["bytes"]:
+        return False
+    return file_digest(path).entry(entry["file"]) == entry
+
+
+def is_done(out_dir, info):
+    '''
+    Checks whether a job's result is already downloaded whole.
+    Inputs:
+        out_dir: str, directory of the results
+        info: str, url of the job's status page
+    '''
+    entry = read_manifest(out_dir).get(result_name(info))
+    return entry is not None and check_file(out_dir, entry)
+
+
+def check_results(out_dir):
+    '''
+    Checks every file in the manifest of a directory.
+    Inputs:
+        out_dir: str, directory of the results
+    Returns list of names of files that are missing or do not match
+    '''
+    return [name for name, entry in sorted(read_manifest(out_dir).items())
+            if not check_file(out_dir, entry)]
+
+
+def expected_rows(xml):
+    '''
+    Reads the number of rows of a job's result from its UWS XML, if the
+    job gives it (as an element, or an attribute of its result).
+    Inputs:
+        xml: bytes or str, the job's status page
+    Returns int, or None if the XML has no row count
+    '''
+    for element in ElementTree.fromstring(xml).iter():
+        if element.tag.rpartition("}")[2].lower() in ROW_NAMES and \
+                element.text and element.text.strip().isdigit():
+            return int(element.text)
+        for name, value in element.attrib.items():
+            if name.rpartition("}")[2].lower() in ROW_NAMES and \
+                    value.strip().isdigit():
+                return int(value)
+    return None
+
+
+def resume_offset(path):
+    '''
+    Bytes of a result already downloaded to its .part file.
+    Inputs:
+        path: str, path the result is saved to
+    Returns int
+    '''
+    part = path + PART_SUFFIX
+    return os.path.getsize(part) if os.path.exists(part) else 0
+
+
+def range_start(status, headers, offset):
+    '''
+    Checks how a server answered a request for a result from offset on.
+    Inputs:
+        status: int, HTTP status of the response
+        headers: dict-like of lower case header names to values
+        offset: int, first byte asked for
+    Returns tuple of the first byte the body starts at (offset, 0 if the
+        server sent the whole file, or None if there is nothing after
+        offset and the body is to be ignored), and the result's total
+        size (None if not given)
+    '''
+    if status == 416:
+        # Asked for bytes past the end: the .part file may be whole
+        match = UNSATISFIED_RANGE.match(headers.get("content-range", ""))
+        return None, int(match.group(1)) if match else None
+    if status == 206:
+        match = CONTENT_RANGE.match(headers.get("content-range", ""))
+        if not match or int(match.group(1)) != offset:
+            raise ResultError("unexpected Content-Range: {}".format(
+                headers.get("content-range")))
+        total = match.group(3)
+        return offset, None if total == "*" else int(total)
+    if status == 200:
+        length = headers.get("content-length")
+        return 0, int(length) if length is not None else None
+    raise ResultError("unexpected status {}".format(status))
+
+
+def finish_result(out_dir, info, total=None, rows=None):
+    '''
+    Checks a result whose transfer ended, and if it is whole, renames it
+    from its .part file and adds it to the manifest.
+    Inputs:
+        out_dir: str, directory of the results
+        info: str, url of the job's status page
+        total: int, size of the result given by the server, or None
+        rows: int, number of rows given by the job, or None
+    Returns dict, the result's manifest entry
+    '''
+    name = result_name(info)
+    path = os.path.join(out_dir, name)
+    part = path + PART_SUFFIX
+    digest = file_digest(part)
+    if total is not None and digest.size != total:
+        # Cut off: the .part file is kept to be resumed
+        raise ResultError("{} has {} of {} bytes".format(name, digest.size,
+                                                         total))
+    if rows is not None and digest.rows() != rows:
+        # Whole but wrong: it cannot be resumed
+        os.remove(part)
+        raise RowCountError("{} has {} rows, the job gave {}".format(
+            name, digest.rows(), rows))
+
+    os.replace(part, path)
+    entry = digest.entry(name)
+    add_result(out_dir, entry)
+    return entry
+
+
+if __name__ == "__main__":
+    bad = check_results(sys.argv[1])
+    for name in bad:
+        print("missing or changed:", name)
+    print("{} files do not match the manifest".format(len(bad)))
@@ -1,59 +1,126 @@
-from mrjob.job import MRJob
-from mrjob.protocol import PickleProtocol
 from mrjob.step import MRStep
 from math import sqrt
 
+from astro_protocol import AstroProtocol
+from broadcast import BroadcastMRJob
 
-class StdevMR(MRJob):
+# Key of the mappers' moments in the stdev step
+MOMENTS = "moments"
+
+
+class StdevMR(BroadcastMRJob):
     '''
     MRjob object to find outliers through standard deviation.
+
+    Finds the mean and stdev of dist_from_center for each center in one
+    step. Mappers keep running (count, mean, M2) moments per center and
+    emit them once, and one reducer merges them, while the objects go
+    through unchanged.
     '''
 
-    INTERNAL_PROTOCOL = PickleProtocol
+    # Pass AstroObjects between steps as binary records, not pickles
+    INTERNAL_PROTOCOL = AstroProtocol
+
+    # Objects of each center are spread over this many keys, as there
+    # are only 2 centers
+    STD_PARTITIONS = 256
 
     stdev = {}
     means = {}
 
-    def reducer_std_mean(self, center, astr_gen):
-        total = 0
-        count = 0
+    def mapper_std_init(self):
+        self.moments = {}
+        self.num_objects = 0
 
-        for astr in astr_gen:
-            total += astr.dist_from_center
-            count += 1
-            yield center, astr
+    def mapper_std(self, center, astr):
+        '''
+        Adds the object's distance to the moments of its center and
+        passes the object on.
+        Yields: tuple of center and partition, AstroObject
+        '''
+        moments = self.moments.setdefault(center, [0, 0.0, 0.0])
+        add_moment(moments, astr.dist_from_center)
+        self.num_objects += 1
+        yield (center, self.num_objects % self.STD_PARTITIONS), astr
 
-        self.means[center] = total / count
+    def mapper_std_final(self):
+        yield MOMENTS, self.moments
 
-    def mapper_std_diff(self, center, astr):
+    def reducer_std(self, key, values):
         '''
-        Yields center, object, and difference between mean and distance
+        Merges the moments from all mappers into the mean and stdev of
+        each center, and saves them for later steps. Objects are passed
+        through.
         '''
-        mean = self.means[center]
-        yield center, (astr, astr.dist_from_center - mean)
+        if key != MOMENTS:
+            center = key[0]
+            for astr in values:
+                yield center, astr
+            return
 
-    def reducer_std_diff_init(self):
-        self.count = 0
+        moments = {}
+        for mapper_moments in values:
+            for center, other in mapper_moments.items():
+                merge_moments(moments.setdefault(center, [0, 0.0, 0.0]),
+                              other)
 
-    def reducer_std_diff(self, center, values):
-        self.stdev[center] = 0
-        for item in values:
-            self.stdev[center] += item[1]**2
-            self.count += 1
-            yield center, item[0]
+        self.save_stats("means", {center: m[1]
+                                  for center, m in moments.items()})
+        self.save_stats("stdev", {center: moments_stdev(m)
+                                  for center, m in moments.items()})
 
-        # Get final stdev
-        self.stdev[center] = sqrt(self.stdev[center] / self.count)
+    def std_init(self):
+        '''
+        MRjob mapper init for steps after the stdev step. Loads the means
+        and stdevs it saved.
+        '''
+        self.load_stats("means")
+        self.load_stats("stdev")
 
     def get_steps_std(self):
-        return [MRStep(reducer=self.reducer_std_mean),
-                MRStep(mapper=self.mapper_std_diff,
-                       reducer_init=self.reducer_std_diff_init,
-                       reducer=self.reducer_std_diff)]
+        return [MRStep(mapper_init=self.mapper_std_init,
+                       mapper=self.mapper_std,
+                       mapper_final=self.mapper_std_final,
+                       reducer=self.reducer_std)]
 
     def steps(self):
         return self.get_steps_std()
 
 
+def add_moment(moments, value):
+    '''
+    Adds a value to running moments, in place (Welford's algorithm).
+    Inputs:
+        moments: list of [count, mean, M2], M2 being the sum of squared
+            differences from the mean
+        value: float
+    '''
+    moments[0] += 1
+    delta = value - moments[1]
+    moments[1] += delta / moments[0]
+    moments[2] += delta * (value - moments[1])
+
+
+def merge_moments(moments, other):
+    '''
+    Merges the moments of another set of values into moments, in place
+    (Chan et al.'s parallel algorithm).
+    '''
+    count = moments[0] + other[0]
+    if not count:
+        return
+    delta = other[1] - moments[1]
+    moments[1] += delta * other[0] / count
+    moments[2] += other[2] + delta ** 2 * moments[0] * other[0] / count
+    moments[0] = count
+
+
+def moments_stdev(moments):
+    '''
+    Population stdev of the values in moments.
+    '''
+    return sqrt(moments[2] / moments[0]) if moments[0] else 0.0
+
+
 if __name__ == "__main__":
     StdevMR.run()
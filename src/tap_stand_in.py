@@ -0,0 +1,203 @@
+'''
+CS12300 Spring 2018
+TBD
+Tyler Amos, Ishaan Bhojwani, Kevin Sun, Alexander Tyan
+
+Local stand-in for IRSA's TAP async service, to try irsa_async.py (or
+irsa_api.py) against without waiting hours on real queries. It mimics
+the three endpoints the clients use:
+    - /TAP/async?QUERY=...&PHASE=RUN submits a job and redirects (303)
+      to the job's status page, /TAP/async/<job id>
+    - the status page is UWS XML, whose phase goes from QUEUED to
+      EXECUTING to COMPLETED (or ERROR) as time passes
+    - /TAP/async/<job id>/results/result is the job's csv, with rows of
+      made up objects in the query's ra strip
+Every response can be delayed, to mimic a slow connection. Run with:
+    >>> python3 tap_stand_in.py [port]
+and point the clients at http://localhost:port/TAP/async instead of
+irsa_api.BASE.
+'''
+
+import asyncio
+import re
+import sys
+from time import monotonic
+from urllib.parse import parse_qs, urlsplit
+
+import numpy as np
+
+import catalog_csv
+
+JOB_XML = \
+    '<?xml version="1.0" encoding="UTF-8"?>\n' \
+    '<uws:job xmlns:uws="http://www.ivoa.net/xml/UWS/v1.0">\n' \
+    '  <uws:jobId>{job_id}</uws:jobId>\n' \
+    '  <uws:ownerId xsi:nil="true" ' \
+    'xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance"/>\n' \
+    '  <uws:phase>{phase}</uws:phase>\n' \
+    '  <uws:jobInfo><rowCount>{rows}</rowCount></uws:jobInfo>\n' \
+    '</uws:job>\n'
+
+# Bounds of the ra strip in a query made by irsa_api.build_queries
+RA_STRIP = re.compile(r"ra>=([-\d.]+) AND ra<([-\d.]+)")
+# Range header of a request for a result from some byte on
+RANGE = re.compile(r"bytes=(\d+)-$")
+
+
+class StandInTAP:
+    '''
+    Stand-in TAP async service. Jobs take queue_secs in QUEUED, then
+    run_secs in EXECUTING. Jobs whose number (from 0, in order of
+    submission) is in fail end in ERROR instead of COMPLETED. Results
+    can be asked for from some byte on (with a Range header), and the
+    first cuts transfers of each result are cut off after cut_bytes.
+    '''
+
+    def __init__(self, queue_secs=0.1, run_secs=0.5, rows=1000,
+                 latency=0.0, fail=(), chunked=False, cut_bytes=None,
+                 cuts=1):
+        self.queue_secs = queue_secs
+        self.run_secs = run_secs
+        self.rows = rows
+        self.latency = latency
+        self.fail = set(fail)
+        self.chunked = chunked
+        self.cut_bytes = cut_bytes
+        self.cuts = cuts
+
+        self.jobs = {}  # Job id to (submit time, query)
+        self.transfers = {}  # Job id to number of result transfers
+        self.requests = 0
+        self.bytes_sent = 0  # Bytes of results sent
+        self.max_running = 0  # Most jobs not yet finished at once
+        self.server = None
+
+    def phase(self, job_id):
+        start, _ = self.jobs[job_id]
+        elapsed = monotonic() - start
+        if elapsed < self.queue_secs:
+            return "QUEUED"
+        if elapsed < self.queue_secs + self.run_secs:
+            return "EXECUTING"
+        if int(job_id) - 1000000 in self.fail:
+            return "ERROR"
+        return "COMPLETED"
+
+    def result(self, job_id):
+        '''
+        csv result of a job: the irsa_api.columns header, then rows with
+        positions in the query's ra strip.
+        '''
+        _, query = self.jobs[job_id]
+        strip = RA_STRIP.search(query)
+        ra1, ra2 = map(float, strip.groups()) if strip else (0, 360)
+
+        rand = np.random.RandomState(int(job_id))
+        lines = [",".join(catalog_csv.COLUMN_NAMES)]
+        for i in range(self.rows):
+            ra = rand.uniform(ra1, ra2)
+            dec = np.degrees(np.arcsin(rand.uniform(-1, 1)))
+            pm = rand.normal(0, 50, 2)
+            mags = rand.normal([10, 9.5, 8, 6])
+            lines.append(
+                "J{}{:06d},{:.7f},{:.7f},0.1,0.1,{:.2f},{:.2f},1,1,"
+                "{:.3f},{:.3f},{:.3f},{:.3f},50,40,20,10".format(
+                    job_id, i, ra, dec, pm[0], pm[1], *mags))
+        return ("\n".join(lines) + "\n").encode()
+
+    def running(self):
+        return sum(self.phase(job_id) in ("QUEUED", "EXECUTING")
+                   for job_id in self.jobs)
+
+    async def handle(self, reader, writer):
+        '''
+        Answers one request, then closes the connection.
+        '''
+        request = (await reader.readline()).decode("latin-1").split()
+        request_headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            request_headers[name.strip().lower()] = value.strip()
+        self.requests += 1
+        await asyncio.sleep(self.latency)
+
+        status, headers, body = "404 Not Found", {}, b""
+        cut = None  # Bytes of the body sent before closing
+        parts = urlsplit(request[1] if len(request) > 1 else "/")
+        path = parts.path.rstrip("/").split("/")
+        if path[1:] == ["TAP", "async"]:
+            job_id = str(1000000 + len(self.jobs))
+            query = parse_qs(parts.query).get("QUERY", [""])[0]
+            self.jobs[job_id] = (monotonic(), query)
+            self.max_running = max(self.max_running, self.running())
+            status = "303 See Other"
+            headers["Location"] = "/TAP/async/" + job_id
+        elif path[1:3] == ["TAP", "async"] and path[3] in self.jobs:
+            job_id = path[3]
+            if path[4:] == []:
+                status = "200 OK"
+                headers["Content-Type"] = "text/xml"
+                body = JOB_XML.format(job_id=job_id, rows=self.rows,
+                                      phase=self.phase(job_id)).encode()
+            elif path[4:] == ["results", "result"] and \
+                    self.phase(job_id) == "COMPLETED":
+                status = "200 OK"
+                headers["Content-Type"] = "text/csv"
+                body = self.result(job_id)
+                size = len(body)
+                start = RANGE.match(request_headers.get("range", ""))
+                if start and int(start.group(1)) >= size:
+                    status, body = "416 Range Not Satisfiable", b""
+                    headers["Content-Range"] = "bytes */{}".format(size)
+                elif start:
+                    status = "206 Partial Content"
+                    body = body[int(start.group(1)):]
+                    headers["Content-Range"] = "bytes {}-{}/{}".format(
+                        start.group(1), size - 1, size)
+
+                transfer = self.transfers.get(job_id, 0)
+                self.transfers[job_id] = transfer + 1
+                if self.cut_bytes is not None and transfer < self.cuts:
+                    cut = self.cut_bytes
+                self.bytes_sent += len(body[:cut])
+
+        if self.chunked and body:
+            headers["Transfer-Encoding"] = "chunked"
+            chunks = [body[i:i + 4096] for i in range(0, len(body), 4096)]
+            body = b"".join(b"%x\r\n%s\r\n" % (len(chunk), chunk)
+                            for chunk in chunks + [b""])
+        else:
+            headers["Content-Length"] = str(len(body))
+
+        writer.write("HTTP/1.1 {}\r\n".format(status).encode())
+        for name, value in headers.items():
+            writer.write("{}: {}\r\n".format(name, value).encode())
+        writer.write(b"Connection: close\r\n\r\n" + body[:cut])
+        await writer.drain()
+        writer.close()
+
+    async def start(self, host="localhost", port=0):
+        '''
+        Starts serving.
+        Returns str, url to submit queries to
+        '''
+        self.server = await asyncio.start_server(self.handle, host, port)
+        port = self.server.sockets[0].getsockname()[1]
+        return "http://{}:{}/TAP/async".format(host, port)
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+
+
+async def serve(port):
+    url = await StandInTAP().start(port=port)
+    print("Serving TAP stand-in at", url)
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(serve(int(sys.argv[1]) if len(sys.argv) > 1 else 8080))